@@ -29,6 +29,7 @@ import dx.translator.Extras
 import spray.json._
 import dx.util.{FileSourceResolver, FileUtils, JsUtils, Logger, TraceLevel}
 
+import scala.collection.mutable
 import scala.jdk.CollectionConverters._
 
 object Compiler {
@@ -36,6 +37,28 @@ object Compiler {
   val RegionToProjectFile = "dxCompiler.regionToProject"
 }
 
+/**
+  * Platform lookups that do not depend on the bundle being compiled. A single
+  * instance can be shared by several Compilers (e.g. when compiling a batch of
+  * sources in one process) so that each lookup is only performed once per project.
+  */
+case class CompilerCache() {
+  private val instanceTypeDbs = mutable.HashMap.empty[String, InstanceTypeDB]
+  private val assetLinks = mutable.HashMap.empty[(String, String), JsValue]
+
+  def getInstanceTypeDb(project: DxProject)(create: => InstanceTypeDB): InstanceTypeDB = {
+    synchronized {
+      instanceTypeDbs.getOrElseUpdate(project.id, create)
+    }
+  }
+
+  def getAssetLink(project: DxProject, assetName: String)(create: => JsValue): JsValue = {
+    synchronized {
+      assetLinks.getOrElseUpdate((project.id, assetName), create)
+    }
+  }
+}
+
 /**
   * Compile IR to native applets and workflows.
   * @param extras extra configuration
@@ -50,6 +73,7 @@ object Compiler {
   * @param fileResolver the FileSourceResolver
   * @param dxApi the DxApi
   * @param logger the Logger
+  * @param cache lookups that may be shared with other Compilers
   */
 case class Compiler(extras: Option[Extras],
                     runtimePathConfig: DxWorkerPaths,
@@ -65,7 +89,8 @@ case class Compiler(extras: Option[Extras],
                     streamFiles: StreamFiles.StreamFiles,
                     fileResolver: FileSourceResolver = FileSourceResolver.get,
                     dxApi: DxApi = DxApi.get,
-                    logger: Logger = Logger.get) {
+                    logger: Logger = Logger.get,
+                    cache: CompilerCache = CompilerCache()) {
   // logger for extra trace info
   private val logger2: Logger = logger.withTraceIfContainsKey("Native")
 
@@ -90,8 +115,9 @@ case class Compiler(extras: Option[Extras],
       !instanceType.diskType.contains(DiskType.HDD) &&
       !instanceType.name.contains("fpga")
     }
-    private val instanceTypeDb =
+    private val instanceTypeDb = cache.getInstanceTypeDb(project) {
       InstanceTypeDB.create(project, instanceTypeFilter, Some(dxApi), logger)
+    }
     // directory of the currently existing applets - we don't want to build them
     // if we don't have to.
     private val executableDir =
@@ -160,7 +186,7 @@ case class Compiler(extras: Option[Extras],
     }
 
     private lazy val runtimeAsset: Option[JsValue] = if (includeAsset) {
-      Some(getAssetLink)
+      Some(cache.getAssetLink(project, runtimeAssetName)(getAssetLink))
     } else {
       None
     }
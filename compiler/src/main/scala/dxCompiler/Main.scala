@@ -1,10 +1,11 @@
 package dxCompiler
 
+import java.lang.management.{ManagementFactory, MemoryType}
 import java.nio.file.{Files, Path, Paths}
 
 import com.typesafe.config.ConfigFactory
 import dx.api._
-import dx.compiler.{Compiler, ExecutableTree}
+import dx.compiler.{Compiler, CompilerCache, ExecutableTree}
 import dx.core.getVersion
 import dx.core.CliUtils._
 import dx.core.io.{DxWorkerPaths, StreamFiles}
@@ -14,8 +15,12 @@ import dx.core.Constants
 import dx.dxni.DxNativeInterface
 import dx.translator.{Extras, TranslatorFactory}
 import dx.util.protocols.DxFileAccessProtocol
-import dx.util.{Enum, FileSourceResolver, FileUtils, Logger, TraceLevel}
-import spray.json.{JsNull, JsValue}
+import dx.util.{Enum, FileSourceResolver, FileUtils, JsUtils, Logger, TraceLevel}
+import spray.json.{JsArray, JsNull, JsNumber, JsObject, JsString, JsValue}
+
+import scala.collection.mutable
+import scala.jdk.CollectionConverters._
+import scala.util.control.NonFatal
 
 /**
   * Compiler CLI.
@@ -98,7 +103,7 @@ object Main {
 
   object CompilerAction extends Enum {
     type CompilerAction = Value
-    val Compile, Config, DxNI, Version, Describe = Value
+    val Compile, CompileBatch, Config, DxNI, Version, Describe = Value
   }
 
   object CompilerMode extends Enum {
@@ -144,6 +149,7 @@ object Main {
       "input" -> PathOptionSpec.listMustExist.copy(alias = Some("inputs")),
       "locked" -> FlagOptionSpec.default,
       "leaveWorkflowsOpen" -> FlagOptionSpec.default,
+      "phaseTimings" -> PathOptionSpec.default,
       "imports" -> PathOptionSpec.listMustExist,
       "p" -> PathOptionSpec.listMustExist.copy(alias = Some("imports")),
       "projectWideReuse" -> FlagOptionSpec.default,
@@ -258,7 +264,71 @@ object Main {
     resolveOrCreateDestination(dxApi, project, folder)
   }
 
+  /**
+    * State shared by all the compilations performed in one process.
+    * @param compilerCache platform lookups (instance types, runtime asset)
+    *                      shared by all Compilers
+    */
+  private case class CompileSession(compilerCache: CompilerCache = CompilerCache()) {
+    private val extrasCache = mutable.HashMap.empty[Path, Extras]
+
+    def getExtras(extrasPath: Path): Extras = {
+      extrasCache.getOrElseUpdate(extrasPath.toAbsolutePath.normalize, Extras.parse(extrasPath))
+    }
+  }
+
+  /**
+    * Measures the wall time, and the bytes allocated by the current thread,
+    * of each phase of a compilation.
+    */
+  private case class PhaseTimer() {
+    private val threadBean = ManagementFactory.getThreadMXBean match {
+      case bean: com.sun.management.ThreadMXBean if bean.isThreadAllocatedMemorySupported =>
+        Some(bean)
+      case _ => None
+    }
+    private val phases = mutable.ArrayBuffer.empty[JsObject]
+
+    private def allocatedBytes: Option[Long] = {
+      threadBean.map(_.getThreadAllocatedBytes(Thread.currentThread.getId))
+    }
+
+    def apply[T](name: String)(body: => T): T = {
+      val startNanos = System.nanoTime()
+      val startAllocated = allocatedBytes
+      try {
+        body
+      } finally {
+        val seconds = (System.nanoTime() - startNanos) / 1e9
+        val allocated = startAllocated.flatMap(start => allocatedBytes.map(_ - start))
+        phases += JsObject(
+            Map[String, JsValue]("name" -> JsString(name), "seconds" -> JsNumber(seconds)) ++
+              allocated.map(bytes => "allocatedBytes" -> JsNumber(bytes))
+        )
+      }
+    }
+
+    /**
+      * Writes the phases, and the peak heap usage of the process, to a JSON file.
+      */
+    def write(path: Path): Unit = {
+      val peakHeapBytes = ManagementFactory.getMemoryPoolMXBeans.asScala
+        .filter(_.getType == MemoryType.HEAP)
+        .map(_.getPeakUsage.getUsed)
+        .sum
+      val js = JsObject(
+          "phases" -> JsArray(phases.toVector),
+          "peakHeapBytes" -> JsNumber(peakHeapBytes)
+      )
+      FileUtils.writeFileContent(path, js.prettyPrint)
+    }
+  }
+
   def compile(args: Vector[String]): Termination = {
+    compile(args, CompileSession())
+  }
+
+  private def compile(args: Vector[String], session: CompileSession): Termination = {
     val sourceFile: Path = args.headOption
       .map(Paths.get(_))
       .getOrElse(
@@ -273,12 +343,23 @@ object Main {
         case e: OptionParseException =>
           return BadUsageTermination("Error parsing command line options", Some(e))
       }
+    val timer = PhaseTimer()
+    try {
+      compile(sourceFile, options, session, timer)
+    } finally {
+      options.getValue[Path]("phaseTimings").foreach(timer.write)
+    }
+  }
 
+  private def compile(sourceFile: Path,
+                      options: Options,
+                      session: CompileSession,
+                      timer: PhaseTimer): Termination = {
     val (baseFileResolver, logger) = initCommon(options)
     val dxApi = DxApi()(logger)
 
     val extras: Option[Extras] =
-      options.getValue[Path]("extras").map(extrasPath => Extras.parse(extrasPath))
+      options.getValue[Path]("extras").map(session.getExtras)
     if (extras.exists(_.customReorgAttributes.isDefined)) {
       val conflictingOpts = Set("reorg", "locked").filter(options.contains)
       if (conflictingOpts.nonEmpty) {
@@ -313,15 +394,18 @@ object Main {
       try {
         val language = options.getValue[Language.Language]("language")
         val reorg = options.getFlag("reorg")
-        TranslatorFactory.createTranslator(
-            sourceFile,
-            language,
-            extras,
-            defaultScatterChunkSize,
-            locked,
-            if (reorg) Some(true) else None,
-            baseFileResolver
-        )
+        // parses and type-checks the source
+        timer("parse") {
+          TranslatorFactory.createTranslator(
+              sourceFile,
+              language,
+              extras,
+              defaultScatterChunkSize,
+              locked,
+              if (reorg) Some(true) else None,
+              baseFileResolver
+          )
+        }
       } catch {
         case e: Throwable =>
           return Failure(s"Error creating translator for ${sourceFile}", exception = Some(e))
@@ -330,7 +414,9 @@ object Main {
     // generate IR
     val rawBundle =
       try {
-        translator.apply
+        timer("translate") {
+          translator.apply
+        }
       } catch {
         case e: Throwable =>
           return Failure(s"Error translating ${sourceFile} to IR", exception = Some(e))
@@ -367,7 +453,9 @@ object Main {
     val (bundle, fileResolver) = if (hasInputs) {
       val (bundleWithDefaults, fileResolver) =
         try {
-          translator.translateInputs(rawBundle, inputs, defaults, project)
+          timer("translateInputs") {
+            translator.translateInputs(rawBundle, inputs, defaults, project)
+          }
         } catch {
           case ex: Throwable =>
             return Failure("Error translating inputs", Some(ex))
@@ -419,9 +507,12 @@ object Main {
           locked,
           projectWideReuse,
           streamFiles,
-          fileResolver
+          fileResolver,
+          cache = session.compilerCache
       )
-      val results = compiler.apply(bundle, project, folder)
+      val results = timer("generate") {
+        compiler.apply(bundle, project, folder)
+      }
       // generate the execution tree if requested
       (results.primary, options.getValue[ExecTreeFormat.ExecTreeFormat]("execTree")) match {
         case (Some(primary), Some(format)) =>
@@ -445,6 +536,126 @@ object Main {
 
   }
 
+  // compile-batch
+
+  case class SuccessBatch(results: Vector[JsObject]) extends SuccessfulTermination {
+    lazy val message: String = JsArray(results).prettyPrint
+  }
+
+  /**
+    * Converts a manifest entry to the arguments of the compile action.
+    * An entry is an object with a required `source` (path to the source
+    * file), and optional `flags` (compile options), `folder` and `project`.
+    */
+  private def manifestEntryToArgs(entry: JsValue): (String, Vector[String]) = {
+    val fields = entry match {
+      case JsObject(fields) => fields
+      case other =>
+        throw OptionParseException(s"Invalid manifest entry ${other}")
+    }
+    def getString(key: String): Option[String] = {
+      fields.get(key) match {
+        case Some(JsString(value)) => Some(value)
+        case None | Some(JsNull)   => None
+        case Some(other) =>
+          throw OptionParseException(s"Invalid value ${other} for ${key} in manifest entry")
+      }
+    }
+    val source = getString("source").getOrElse(
+        throw OptionParseException(s"Manifest entry ${entry} is missing 'source'")
+    )
+    val flags = fields.get("flags") match {
+      case Some(JsArray(values)) =>
+        values.map {
+          case JsString(flag) => flag
+          case other =>
+            throw OptionParseException(s"Invalid flag ${other} in manifest entry ${source}")
+        }
+      case None | Some(JsNull) => Vector.empty
+      case Some(other) =>
+        throw OptionParseException(s"Invalid flags ${other} in manifest entry ${source}")
+    }
+    // every entry would overwrite the timings of the previous ones
+    if (flags.exists(_.replaceFirst("^-+", "") == "phaseTimings")) {
+      throw OptionParseException(
+          s"-phaseTimings is not supported by compile-batch, in manifest entry ${source}"
+      )
+    }
+    val destination = Vector("folder", "project").flatMap { key =>
+      getString(key).map(value => Vector(s"-${key}", value)).getOrElse(Vector.empty)
+    }
+    (source, source +: (flags ++ destination))
+  }
+
+  /**
+    * Compiles all the sources listed in a JSON manifest in this process. The
+    * parsed extras, the instance type database and the runtime asset lookup
+    * are shared by all the entries. The output is an array with one record
+    * per entry, in the order of the manifest, including the time it took.
+    */
+  def compileBatch(args: Vector[String]): Termination = {
+    val manifestPath: Path = args.headOption
+      .map(Paths.get(_))
+      .getOrElse(
+          throw OptionParseException(
+              "Missing required positional argument <manifest file>"
+          )
+      )
+    val options =
+      try {
+        parseCommandLine(args.tail, Map.empty)
+      } catch {
+        case e: OptionParseException =>
+          return BadUsageTermination("Error parsing command line options", Some(e))
+      }
+    val logger = initLogger(options)
+    val entries = JsUtils.jsFromFile(manifestPath) match {
+      case JsArray(entries) => entries
+      case _ =>
+        return BadUsageTermination(s"Manifest ${manifestPath} must be a JSON array")
+    }
+    val session = CompileSession()
+    val results = entries.zipWithIndex.map {
+      case (entry, index) =>
+        val startNanos = System.nanoTime()
+        val (source, termination) =
+          try {
+            val (entrySource, entryArgs) = manifestEntryToArgs(entry)
+            logger.trace(s"Compiling manifest entry ${index}: ${entryArgs.mkString(" ")}")
+            val termination =
+              try {
+                compile(entryArgs, session)
+              } catch {
+                case NonFatal(e) => Failure(exception = Some(e))
+              }
+            (entrySource, termination)
+          } catch {
+            case e: OptionParseException =>
+              (s"entry ${index}", BadUsageTermination(exception = Some(e)))
+          }
+        // the compile time of this entry alone
+        val seconds = JsNumber((System.nanoTime() - startNanos) / 1e9)
+        termination match {
+          case success: SuccessfulTermination =>
+            JsObject("source" -> JsString(source),
+                     "status" -> JsString("success"),
+                     "result" -> JsString(success.message),
+                     "seconds" -> seconds)
+          case failure: UnsuccessfulTermination =>
+            logger.error(s"Failed to compile ${source}")
+            // the message and the exception message, without the stack trace
+            val error = (Vector(failure.message) ++ failure.exception.map(e =>
+              Option(e.getMessage).getOrElse(e.getClass.getName)
+            )).filter(_.nonEmpty).mkString(": ")
+            JsObject("source" -> JsString(source),
+                     "status" -> JsString("failure"),
+                     "error" -> JsString(error),
+                     "seconds" -> seconds)
+        }
+    }
+    SuccessBatch(results)
+  }
+
   // DxNI
 
   private object AppsOption extends Enum {
@@ -623,18 +834,19 @@ object Main {
     }
     val action =
       try {
-        CompilerAction.withNameIgnoreCase(args.head.replaceAll("_", ""))
+        CompilerAction.withNameIgnoreCase(args.head.replaceAll("[_-]", ""))
       } catch {
         case _: NoSuchElementException =>
           return BadUsageTermination()
       }
     try {
       action match {
-        case CompilerAction.Compile  => compile(args.tail)
-        case CompilerAction.Describe => describe(args.tail)
-        case CompilerAction.DxNI     => dxni(args.tail)
-        case CompilerAction.Config   => Success(ConfigFactory.load().toString)
-        case CompilerAction.Version  => Success(getVersion)
+        case CompilerAction.Compile      => compile(args.tail)
+        case CompilerAction.CompileBatch => compileBatch(args.tail)
+        case CompilerAction.Describe     => describe(args.tail)
+        case CompilerAction.DxNI         => dxni(args.tail)
+        case CompilerAction.Config       => Success(ConfigFactory.load().toString)
+        case CompilerAction.Version      => Success(getVersion)
       }
     } catch {
       case e: Throwable =>
@@ -673,6 +885,8 @@ object Main {
         |      -inputs <string>           File with Cromwell formatted inputs
         |      -locked                    Create a locked-down workflow
         |      -leaveWorkflowsOpen        Leave created workflows open (otherwise they are closed)
+        |      -phaseTimings <path>       Write the time and memory allocated by each compilation
+        |                                 phase to a JSON file, a debugging flag
         |      -p | -imports <string>     Directory to search for imported WDL files
         |      -projectWideReuse          Look for existing applets/workflows in the entire project
         |                                 before generating new ones. The normal search scope is the
@@ -686,6 +900,15 @@ object Main {
         |                                 download agent); this setting overrides any per-file settings
         |                                 in WDL parameter_meta sections.
         |
+        |  compile-batch <manifest file>
+        |    Compile several source files in a single process. The manifest is a
+        |    JSON array of objects, each with the keys 'source' (path to a WDL/CWL
+        |    file), and optionally 'flags' (array of compile options), 'folder' and
+        |    'project'. Prints a JSON array with one record per entry, holding the
+        |    'status' (success or failure), either the 'result' or the 'error', and
+        |    the compile time of the entry in 'seconds'.
+        |    The -phaseTimings option is not supported in the flags.
+        |
         |  dxni
         |    Dx Native call Interface. Create stubs for calling dx
         |    executables (apps/applets/workflows), and store them as WDL
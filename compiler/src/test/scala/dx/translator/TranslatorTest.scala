@@ -1,8 +1,8 @@
 package dx.translator
 
-import java.nio.file.{Path, Paths}
+import java.nio.file.{Files, Path, Paths}
 import dxCompiler.Main
-import dxCompiler.Main.SuccessIR
+import dxCompiler.Main.{SuccessBatch, SuccessIR}
 import dx.Tags.EdgeTest
 import dx.api._
 import dx.core.Constants
@@ -14,10 +14,11 @@ import dx.core.CliUtils.{Failure, UnsuccessfulTermination}
 import dx.core.languages.wdl.WdlDocumentSource
 import dx.translator.CallableAttributes._
 import dx.translator.ParameterAttributes._
-import dx.util.Logger
+import dx.util.{FileUtils, JsUtils, Logger}
 import org.scalatest.Inside._
 import org.scalatest.flatspec.AnyFlatSpec
 import org.scalatest.matchers.should.Matchers
+import spray.json.{JsArray, JsNumber, JsObject, JsString}
 import wdlTools.generators.code.WdlGenerator
 
 import scala.collection.immutable.TreeSeqMap
@@ -1521,4 +1522,82 @@ Main.compile(args.toVector) shouldBe a[SuccessIR]
     val args = path.toString :: cFlags
     Main.compile(args.toVector) shouldBe a[SuccessIR]
   }
+
+  it should "compile a batch of sources, recording each failure in order" in {
+    val good = pathFromBasename("compiler", "add.wdl")
+    val bad = pathFromBasename("compiler", "choices_type_mismatch.wdl")
+    val manifest = JsArray(
+        Vector(bad, good).map { path =>
+          JsObject("source" -> JsString(path.toString),
+                   "flags" -> JsArray(cFlags.map(JsString(_)).toVector))
+        }
+    )
+    val manifestPath = Files.createTempFile("compile_manifest", ".json")
+    try {
+      FileUtils.writeFileContent(manifestPath, manifest.prettyPrint)
+      Main.compileBatch(Vector(manifestPath.toString, "-quiet")) match {
+        case SuccessBatch(results) =>
+          results.map(_.fields("source")) shouldBe Vector(JsString(bad.toString),
+                                                          JsString(good.toString))
+          results.map(_.fields("status")) shouldBe Vector(JsString("failure"),
+                                                          JsString("success"))
+          results.foreach(_.fields("seconds") shouldBe a[JsNumber])
+          inside(results(0).fields("error")) {
+            case JsString(error) =>
+              error should not be empty
+              error should not include "\tat "
+          }
+        case other =>
+          throw new AssertionError(s"expected SuccessBatch, not ${other}")
+      }
+    } finally {
+      Files.delete(manifestPath)
+    }
+  }
+
+  it should "write the time of each compilation phase" in {
+    val path = pathFromBasename("compiler", "add.wdl")
+    val timingsPath = Files.createTempFile("phase_timings", ".json")
+    try {
+      val args = path.toString :: "-phaseTimings" :: timingsPath.toString :: cFlags
+      Main.compile(args.toVector) shouldBe a[SuccessIR]
+      val timings = JsUtils.jsFromFile(timingsPath).asJsObject.fields
+      val phases = timings("phases") match {
+        case JsArray(phases) => phases.map(_.asJsObject.fields)
+        case other           => throw new AssertionError(s"expected an array of phases, not ${other}")
+      }
+      // without inputs, IR mode stops after the translation
+      phases.map(_("name")) shouldBe Vector(JsString("parse"), JsString("translate"))
+      phases.foreach { phase =>
+        inside(phase("seconds")) {
+          case JsNumber(seconds) => seconds should be >= BigDecimal(0)
+        }
+      }
+      timings("peakHeapBytes") shouldBe a[JsNumber]
+    } finally {
+      Files.delete(timingsPath)
+    }
+  }
+
+  it should "reject -phaseTimings in the flags of a compile-batch entry" in {
+    val path = pathFromBasename("compiler", "add.wdl")
+    val manifest = JsArray(
+        JsObject("source" -> JsString(path.toString),
+                 "flags" -> JsArray(
+                     ("-phaseTimings" :: "timings.json" :: cFlags).map(JsString(_)).toVector
+                 ))
+    )
+    val manifestPath = Files.createTempFile("compile_manifest", ".json")
+    try {
+      FileUtils.writeFileContent(manifestPath, manifest.prettyPrint)
+      Main.compileBatch(Vector(manifestPath.toString, "-quiet")) match {
+        case SuccessBatch(results) =>
+          results.map(_.fields("status")) shouldBe Vector(JsString("failure"))
+        case other =>
+          throw new AssertionError(s"expected SuccessBatch, not ${other}")
+      }
+    } finally {
+      Files.delete(manifestPath)
+    }
+  }
 }
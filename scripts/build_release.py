@@ -3,14 +3,15 @@
 # which is uploaded to
 
 import argparse
+import concurrent.futures
 import dxpy
-from dxpy.exceptions import DXJobFailureError
 import json
 import os
-import subprocess
+import random
 import time
 import sys
 
+import exec_monitor
 import util
 
 here = os.path.dirname(sys.argv[0])
@@ -21,7 +22,6 @@ URL_DURATION = 60 * 60 * 24
 SLEEP_TIME = 5
 COPY_FILE_APP_NAME = "dxwdl_copy"
 COPY_FILE_APP = dxpy.find_one_app(zero_ok=False, more_ok=False, name=COPY_FILE_APP_NAME, return_handler=True)
-NUM_RETRIES = 1
 
 TEST_DICT = {
     "aws:us-east-1" :  "dxCompiler_playground"
@@ -39,132 +39,242 @@ RELEASE_DICT = {
     "aws:eu-west-2": "dxCompiler_London"
 }
 
-# 1. Use the clone-asset app to copy the file into [region].
-# 2. Create a record pointing to the hidden file in [region].
+# Number of times a copy into a region is attempted
+NUM_COPY_ATTEMPTS = 3
+# Base of the exponential backoff between attempts, in seconds
+COPY_RETRY_DELAY = 30
+# Maximal number of concurrent API requests
+MAX_WORKERS = 8
+
+
+class Replication(object):
+    """The copy of the asset of one language into one region"""
+    def __init__(self, lang, region, dest_proj_id):
+        self.lang = lang
+        self.region = region
+        self.dest_proj_id = dest_proj_id
+        self.attempts = 0
+        self.job_id = None
+        self.started = None
+        self.copy_time = None
+        self.finished = None
+        self.record_id = None
+        self.error = None
+
+
+# Call fn on every item concurrently, returns a dictionary from item to result
+def _map_concurrently(fn, items):
+    items = list(items)
+    if not items:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(items))) as executor:
+        return dict(zip(items, executor.map(fn, items)))
+
+
+def _find_hidden_files(dest_proj_id, folder, asset_file_name):
+    results = dxpy.find_data_objects(classname = "file",
+                                     visibility = "hidden",
+                                     name = asset_file_name,
+                                     project = dest_proj_id,
+                                     folder = folder)
+    return [p["id"] for p in results]
+
+
+# Use the clone-asset app to copy the file into [region].
 def _clone_asset_into_region(region, dest_proj_id, asset_file_name, dest_folder, url):
     """
     Clone file into a remote region.
     """
-    dxjob = COPY_FILE_APP.run(app_input = { "url" : url,
-                                            "folder" : dest_folder,
-                                            "filename" : asset_file_name },
-                              name = "copy to region {}".format(region),
-                              project = dest_proj_id)
+    dxjob = util.with_backoff(
+        lambda: COPY_FILE_APP.run(app_input = { "url" : url,
+                                                "folder" : dest_folder,
+                                                "filename" : asset_file_name },
+                                  name = "copy to region {}".format(region),
+                                  project = dest_proj_id),
+        "starting the copy to {}".format(region))
     print('{region}: {job_id}'.format(region=region, job_id=dxjob.get_id()),
           file=sys.stderr)
     return dxjob
 
 
-def _wait_for_completion(jobs):
-    print("awaiting completion ...")
-    # wait for analysis to finish while working around Travis 10m console inactivity timeout
-    noise = subprocess.Popen(["/bin/bash", "-c", "while true; do sleep 60; date; done"])
-    success = True
-    try:
-        for j in jobs:
-            try:
-                j.wait_on_done()
-            except DXJobFailureError:
-                print("job {} failed".format(j.get_id()))
-                success = False
-    finally:
-        noise.kill()
+# Start copying the asset file into the region of [rep]. Returns False if
+# the file is already there, and no copy is needed.
+def _start_copy(rep, source, folder):
+    file_ids = _find_hidden_files(rep.dest_proj_id, folder, source["file_name"])
+    if len(file_ids) == 1:
+        return False
+    if len(file_ids) > 1:
+        print("cleanup in {}, found {} files instead of 0/1".format(rep.dest_proj_id, len(file_ids)))
+        dxpy.DXProject(rep.dest_proj_id).remove_objects(file_ids)
+    rep.attempts += 1
+    rep.started = time.time()
+    rep.job_id = _clone_asset_into_region(rep.region, rep.dest_proj_id, source["file_name"],
+                                          folder, source["url"]).get_id()
+    return True
+
+
+# Create a record pointing to the hidden file in the region of [rep].
+def _create_record(rep, source, folder):
+    file_ids = _find_hidden_files(rep.dest_proj_id, folder, source["file_name"])
+    if len(file_ids) == 0:
+        raise RuntimeError("Found no files {}:{}/{}".format(rep.dest_proj_id, folder, source["file_name"]))
+    if len(file_ids) > 1:
+        raise RuntimeError("Found {} files {}:{}/{}, instead of just one"
+                           .format(len(file_ids), rep.dest_proj_id, folder, source["file_name"]))
+    dest_asset = dxpy.new_dxrecord(name=source["name"],
+                                   types=['AssetBundle'],
+                                   details={'archiveFileId': dxpy.dxlink(file_ids[0])},
+                                   properties=source["properties"],
+                                   project=rep.dest_proj_id,
+                                   folder=folder,
+                                   close=True)
+    rep.record_id = dest_asset.get_id()
+    print("{} {}: created asset {}".format(rep.region, rep.lang, rep.record_id))
+
+
+def _wait_for_completion(jobs, on_complete):
+    print("awaiting completion of {} copies ...".format(len(jobs)))
+    # the progress reports keep the CI console alive
+    monitor = exec_monitor.ExecutionMonitor(jobs, on_complete=on_complete,
+                                            progress_interval=exec_monitor.DEFAULT_PROGRESS_INTERVAL)
+    monitor.wait()
     print("done")
-    return success
-
-def _clone_to_all_regions(region2projid, regions, asset_file_name, folder, url):
-    jobs = []
-    for region in regions:
-        dest_proj_id = region2projid[region]
-        results = list(dxpy.find_data_objects(classname = "file",
-                                              visibility = "hidden",
-                                              name = asset_file_name,
-                                              project = dest_proj_id,
-                                              folder = folder))
-        file_ids = [p["id"] for p in results]
-        nfiles = len(file_ids)
-        if nfiles == 1:
-            continue
-        if nfiles > 1:
-            print("cleanup in {}, found {} files instead of 0/1".format(dest_proj_id, nfiles))
-            dxpy.DXProject(dest_proj_id).remove_objects(file_ids)
-        dxjob = _clone_asset_into_region(region,
-                                         dest_proj_id,
-                                         asset_file_name,
-                                         folder,
-                                         url)
-        jobs.append(dxjob)
-    return jobs
-
-def _clone_asset(record, folder, regions, project_dict):
-    """
-    This function will attempt to clone the given record into all of the given regions.
-    It will return a dictionary with the regions as keys and the record-ids of the
-    corresponding asset as the values.  If an asset is not able to be created in a given
-    region, the value will be set to None.
-    """
-    # Get the asset record
-    fid = record.get_details()['archiveFileId']['$dnanexus_link']
-    curr_region = dxpy.describe(record.project)['region']
-
-    # Only run once per region
-    regions = set(regions) - set([curr_region])
-    if len(regions) == 0:
-        # there is nothing to do
-        return
 
-    app_supported_regions = set(COPY_FILE_APP.describe()['regionalOptions'].keys())
-    if len(regions - app_supported_regions) > 0:
-        print('Currently no support for the following region(s): [{regions}]'
-              .format(regions=', '.join(regions - app_supported_regions)),
-              file=sys.stderr)
-        sys.exit(1)
 
-    # Get information about the asset
+# The asset file of [record], and what is needed to copy it
+def _describe_source(record):
+    fid = record.get_details()['archiveFileId']['$dnanexus_link']
     asset_properties = record.get_properties()
     asset_properties['cloned_from'] = record.get_id()
-    asset_file_name = dxpy.describe(fid)['name']
     url = dxpy.DXFile(fid).get_download_url(preauthenticated=True,
                                             project=dxpy.DXFile.NO_PROJECT_HINT,
                                             duration=URL_DURATION)[0]
+    return {
+        "name": record.name,
+        "file_name": dxpy.describe(fid)['name'],
+        "properties": asset_properties,
+        "url": url
+    }
+
+
+def _print_summary(reps, start):
+    print("{:<22} {:<5} {:>8} {:>9} {:>9}  {}".format("region", "lang", "attempts", "copy(s)", "total(s)",
+                                                      "status"))
+    for rep in sorted(reps, key=lambda r: (r.region, r.lang)):
+        copy_time = "{:.0f}".format(rep.copy_time) if rep.copy_time is not None else "-"
+        total_time = "{:.0f}".format(rep.finished - start) if rep.record_id else "-"
+        status = "ok" if rep.record_id else "failed: {}".format(rep.error)
+        print("{:<22} {:<5} {:>8} {:>9} {:>9}  {}".format(rep.region, rep.lang, rep.attempts, copy_time,
+                                                          total_time, status))
+
+
+def _replicate_assets(home_ad, folder, project_dict):
+    """
+    Clone the asset of every language into every region where it is missing.
+    All the (language, region) pairs are copied at once; the record of each
+    copy is created as soon as its copy job is done, and only the failed
+    pairs are retried.
+    """
+    start = time.time()
+    home_regions = set(ad.region for ad in home_ad.values())
+    regions = [region for region in project_dict.keys() if region not in home_regions]
 
     # setup target folders
-    region2projid = {}
-    for region in regions:
-        dest_proj = util.get_project(project_dict[region])
-        dest_proj.new_folder(folder, parents=True)
-        region2projid[region] = dest_proj.get_id()
+    def setup_region(region):
+        def setup(dest_proj):
+            dest_proj.new_folder(folder, parents=True)
+            return dest_proj.get_id()
+        proj_id = util.with_project(project_dict[region], setup)
+        if proj_id is None:
+            raise RuntimeError("Could not find project {}".format(project_dict[region]))
+        return proj_id
+    region2projid = _map_concurrently(setup_region, regions)
     print(region2projid)
 
-    # Fire off a clone process for each region
-    # Wait for the cloning to complete
-    for i in [1, 2, 3]:
-        jobs = _clone_to_all_regions(region2projid, regions, asset_file_name, folder, url)
-        retval = _wait_for_completion(jobs)
-        if retval:
+    # Leave only the pairs where the asset is missing, or is a copy of
+    # another home asset. Applets compiled by users depend on the archives
+    # of the existing copies, so they are never removed: a stale copy is
+    # renamed out of the way, together with its archive file, which would
+    # otherwise be taken for the file of the new copy. Copies without a
+    # cloned_from property predate it, and are kept as they are.
+    existing = _map_concurrently(
+        lambda region: util.find_assets(dxpy.DXProject(region2projid[region]), folder, list(home_ad)), regions)
+    copies = [(lang, region, existing[region][lang])
+              for lang in home_ad for region in regions if existing[region][lang] is not None]
+    copy_properties = _map_concurrently(lambda copy: copy[2].get_properties(), copies)
+    for (lang, region, asset) in copies:
+        cloned_from = copy_properties[(lang, region, asset)].get("cloned_from")
+        if cloned_from is not None and cloned_from != home_ad[lang].asset_id:
+            stale_name = "dx{}rt.copy_of_{}".format(lang.upper(), cloned_from)
+            print("{} {}: replacing asset {}, a copy of {}; renaming it to {}".format(
+                region, lang, asset.get_id(), cloned_from, stale_name))
+            archive = dxpy.DXFile(asset.get_details()["archiveFileId"]["$dnanexus_link"],
+                                  project=region2projid[region])
+            archive.rename("{}.{}".format(stale_name, archive.describe()["name"]))
+            asset.rename(stale_name)
+            existing[region][lang] = None
+    reps = [Replication(lang, region, region2projid[region])
+            for lang in home_ad for region in regions if existing[region][lang] is None]
+    if not reps:
+        # there is nothing to do
+        return
+
+    target_regions = set(rep.region for rep in reps)
+    app_supported_regions = set(COPY_FILE_APP.describe()['regionalOptions'].keys())
+    if len(target_regions - app_supported_regions) > 0:
+        print('Currently no support for the following region(s): [{regions}]'
+              .format(regions=', '.join(target_regions - app_supported_regions)),
+              file=sys.stderr)
+        sys.exit(1)
+
+    sources = _map_concurrently(
+        lambda lang: _describe_source(dxpy.DXRecord(home_ad[lang].asset_id)),
+        set(rep.lang for rep in reps))
+
+    def finish(rep):
+        try:
+            _create_record(rep, sources[rep.lang], folder)
+            rep.finished = time.time()
+        except Exception as e:
+            rep.error = str(e)
+
+    pending = reps
+    for attempt in range(NUM_COPY_ATTEMPTS):
+        if attempt > 0:
+            delay = random.uniform(0, COPY_RETRY_DELAY * 2 ** attempt)
+            print("retrying {} failed copies in {:.0f} seconds".format(len(pending), delay))
+            time.sleep(delay)
+        for rep in pending:
+            rep.job_id = None
+            rep.error = None
+        started = _map_concurrently(lambda rep: _start_copy(rep, sources[rep.lang], folder), pending)
+
+        # the file is already there, only the record is missing
+        for rep in pending:
+            if not started[rep]:
+                finish(rep)
+
+        jobs = dict((rep.job_id, rep) for rep in pending if rep.job_id is not None)
+
+        def on_complete(job_id, desc):
+            rep = jobs[job_id]
+            rep.copy_time = time.time() - rep.started
+            if desc["state"] == "done":
+                finish(rep)
+            else:
+                print("job {} {}".format(job_id, desc["state"]))
+                rep.error = "copy job {} {}".format(job_id, desc["state"])
+
+        if jobs:
+            _wait_for_completion(jobs.keys(), on_complete)
+        pending = [rep for rep in pending if rep.record_id is None]
+        if not pending:
             break
 
-    # make records for each file
-    for region in regions:
-        dest_proj_id = region2projid[region]
-        results = list(dxpy.find_data_objects(classname = "file",
-                                              visibility = "hidden",
-                                              name = asset_file_name,
-                                              project = dest_proj_id,
-                                              folder = folder))
-        file_ids = [p["id"] for p in results]
-        if len(file_ids) == 0:
-            raise RuntimeError("Found no files {}:{}/{}".format(dest_proj_id, folder, asset_file_name))
-        if len(file_ids) > 1:
-            raise RuntimeError("Found {} files {}:{}/{}, instead of just one"
-                               .format(len(dxfiles), dest_proj_id, folder, asset_file_name))
-        dest_asset = dxpy.new_dxrecord(name=record.name,
-                                       types=['AssetBundle'],
-                                       details={'archiveFileId': dxpy.dxlink(file_ids[0])},
-                                       properties=record.get_properties(),
-                                       project=dest_proj_id,
-                                       folder=folder,
-                                       close=True)
+    _print_summary(reps, start)
+    if pending:
+        raise RuntimeError("Failed to copy the assets into {}".format(
+            ", ".join("{} ({})".format(rep.region, rep.lang) for rep in pending)))
 
 
 def main():
@@ -193,7 +303,9 @@ def main():
     else:
         project_dict = TEST_DICT
 
-    project = util.get_project(project_dict[HOME_REGION])
+    # resolve all the projects at once
+    util.resolve_projects(project_dict.values())
+    project = util.get_live_project(project_dict[HOME_REGION])
     print("project: {} ({})".format(project.name, project.get_id()))
 
     # Figure out what the current version is
@@ -226,22 +338,16 @@ def main():
     if args.dry_run:
         return
 
-    home_ad = util.build(project, folder, version_id, top_dir, path_dict)
+    # A release only bundles binaries whose checksums are pinned in
+    # bundled_dependencies.json
+    os.environ[util.REQUIRE_PINNED_ENV] = "1"
+
+    # The assets of a release are never replaced, unless it is rebuilt from
+    # scratch with --force
+    home_ad = util.build(project, folder, version_id, top_dir, path_dict, keep_existing=True)
 
     if multi_region:
-        for lang, asset_desc in home_ad.items():
-            home_rec = dxpy.DXRecord(asset_desc.asset_id)
-            all_regions = project_dict.keys()
-
-            # Leave only regions where the asset is missing
-            target_regions = []
-            for dest_region in all_regions:
-                dest_proj = util.get_project(project_dict[dest_region])
-                dest_asset = util.find_asset(dest_proj, folder, lang)
-                if dest_asset == None:
-                    target_regions.append(dest_region)
-
-            _clone_asset(home_rec, folder, target_regions, project_dict)
+        _replicate_assets(home_ad, folder, project_dict)
 
 if __name__ == '__main__':
     main()
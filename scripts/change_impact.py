@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Select the tests affected by the changes since a git revision. A test is
+# affected if one of its own files changed (source, imports, inputs, expected
+# results, extras), or if a component that the test exercises changed.
+import os
+import subprocess
+
+import source_deps
+
+# Map source directories to the tests they affect. The first matching
+# prefix wins; paths that match no prefix do not affect any test.
+#   wdl     all WDL tests
+#   cwl     all CWL tests
+#   native  the native app(let) calling tests
+#   all     all tests
+COMPONENT_TAGS = [
+    ("executorWdl/src/main/", "wdl"),
+    ("executorCwl/src/main/", "cwl"),
+    ("compiler/src/main/scala/dx/translator/wdl/", "wdl"),
+    ("compiler/src/main/scala/dx/translator/cwl/", "cwl"),
+    ("core/src/main/scala/dx/core/languages/wdl/", "wdl"),
+    ("core/src/main/scala/dx/core/languages/cwl/", "cwl"),
+    ("compiler/src/main/scala/dx/dxni/", "native"),
+    ("compiler/src/main/", "all"),
+    ("core/src/main/", "all"),
+    ("executorCommon/src/main/", "all"),
+    ("build.sbt", "all"),
+    ("project/", "all"),
+]
+
+NATIVE_TESTS = ["call_native", "call_native_v1", "call_native_app"]
+
+
+def changed_files(top_dir, ref):
+    """Files that differ between [ref] and the working tree, including
+    untracked files. Returns absolute paths."""
+    diff = subprocess.check_output(["git", "diff", "--name-only", ref, "--"], cwd=top_dir)
+    untracked = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard"],
+                                        cwd=top_dir)
+    paths = set()
+    for line in (diff + b"\n" + untracked).decode("utf-8").splitlines():
+        if line.strip():
+            paths.add(os.path.normpath(os.path.join(top_dir, line.strip())))
+    return paths
+
+
+def component_tag(top_dir, path):
+    rel_path = os.path.relpath(path, top_dir)
+    for prefix, tag in COMPONENT_TAGS:
+        if rel_path.startswith(prefix):
+            return tag
+    return None
+
+
+def _test_tags(tname, desc):
+    tags = set(["all"])
+    if desc.source_file.endswith(".wdl"):
+        tags.add("wdl")
+    elif desc.source_file.endswith(".cwl"):
+        tags.add("cwl")
+    if tname in NATIVE_TESTS:
+        tags.add("native")
+    return tags
+
+
+# The files that belong to a test: its source and the sources it imports,
+# and its inputs, expected results and extras.
+def test_own_files(desc, import_dirs):
+    files = [desc.source_file]
+    files += source_deps.transitive_dependencies(desc.source_file, import_dirs)
+    files += desc.raw_input + desc.dx_input + desc.results
+    if desc.extras is not None:
+        files.append(desc.extras)
+    return [os.path.normpath(os.path.abspath(f)) for f in files]
+
+
+def select_affected(top_dir, test_names, test_files, import_paths, changed):
+    """
+    Select the tests among [test_names] that are affected by the [changed]
+    files. import_paths(tname) returns the import directories of a test.
+    Returns a list of (test name, reasons) in the order of test_names.
+    """
+    changed_by_tag = {}
+    for path in sorted(changed):
+        tag = component_tag(top_dir, path)
+        if tag is not None:
+            changed_by_tag.setdefault(tag, []).append(os.path.relpath(path, top_dir))
+
+    selected = []
+    for tname in dict.fromkeys(test_names):
+        desc = test_files[tname]
+        reasons = []
+        for path in test_own_files(desc, import_paths(tname)):
+            if path in changed:
+                reasons.append("changed {}".format(os.path.relpath(path, top_dir)))
+        for tag in sorted(_test_tags(tname, desc) & set(changed_by_tag.keys())):
+            paths = changed_by_tag[tag]
+            more = " (and {} more)".format(len(paths) - 1) if len(paths) > 1 else ""
+            reasons.append("{} component changed: {}{}".format(tag, paths[0], more))
+        if reasons:
+            selected.append((tname, reasons))
+    return selected
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# A local cache of compiled tests. The key is a hash of everything that
+# goes into a compilation: the source file and the files it imports,
+# the compiler flags (including the contents of any file they point to,
+# e.g. extras and inputs), the destination, the dxCompiler version and
+# the fingerprint of the jar, and the runtime assets it links to.
+# The value is the ID of the resulting executable(s).
+import hashlib
+import json
+import os
+import threading
+import time
+
+import dxpy
+
+import source_deps
+import util
+
+# maximal number of IDs in one system/describeDataObjects call
+DESCRIBE_CHUNK_SIZE = 1000
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "dxCompiler", "compile_cache.json")
+
+
+class CompileCache(object):
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, max_age=DEFAULT_MAX_AGE):
+        self.path = path or default_cache_path()
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.file_digests = {}
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as fd:
+                    self.entries = json.load(fd).get("entries", {})
+            except (OSError, ValueError):
+                util.info("Ignoring unreadable compile cache {}".format(self.path))
+
+    def _file_digest(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            digest = self.file_digests.get(path)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            with self.lock:
+                self.file_digests[path] = digest
+        return digest
+
+    def key(self, source_file, flags, version_id, import_dirs=(), compiler_fingerprint=None,
+            asset_ids=()):
+        """Compute the cache key of compiling [source_file] with [flags], by
+        the compiler jar with [compiler_fingerprint], against the runtime
+        assets [asset_ids]"""
+        h = hashlib.sha256()
+
+        def add(*parts):
+            for part in parts:
+                h.update(part.encode("utf-8"))
+                h.update(b"\0")
+
+        add("version", version_id)
+        add("compiler", compiler_fingerprint or "")
+        for asset_id in sorted(asset_ids):
+            add("asset", asset_id)
+        add("source", os.path.basename(source_file), self._file_digest(source_file))
+        source_dir = os.path.dirname(os.path.abspath(source_file))
+        for dep in source_deps.transitive_dependencies(source_file, import_dirs):
+            add("dependency", os.path.relpath(dep, source_dir), self._file_digest(dep))
+        for flag in flags:
+            add("flag", flag)
+            if os.path.isfile(flag):
+                add("contents", self._file_digest(flag))
+        return h.hexdigest()
+
+    def lookup_all(self, keys, project_id, folder):
+        """
+        Look up the cache entries of several tests. [keys] maps a test name to
+        its cache key. All the hits are validated with bulk describe calls, and
+        only those whose executables still exist in [project_id]:[folder] are
+        returned, as a mapping from test name to executable ID(s).
+        """
+        candidates = {}
+        for tname, key in keys.items():
+            entry = self.entries.get(key)
+            if entry is not None:
+                candidates[tname] = (key, entry["oid"].split(","))
+        all_ids = sorted(set(oid for _, oids in candidates.values() for oid in oids))
+        valid_ids = set()
+        for i in range(0, len(all_ids), DESCRIBE_CHUNK_SIZE):
+            chunk = all_ids[i:i + DESCRIBE_CHUNK_SIZE]
+            response = dxpy.api.system_describe_data_objects({
+                "objects": [{"id": oid, "project": project_id} for oid in chunk],
+                "classDescribeOptions": {
+                    "*": {"fields": {"id": True, "project": True, "folder": True}}
+                }
+            })
+            for result in response["results"]:
+                desc = result.get("describe")
+                if desc is not None and desc.get("project") == project_id and desc.get("folder") == folder:
+                    valid_ids.add(desc["id"])
+
+        hits = {}
+        now = time.time()
+        with self.lock:
+            for tname, (key, oids) in candidates.items():
+                if all(oid in valid_ids for oid in oids):
+                    self.entries[key]["last_used"] = now
+                    hits[tname] = ",".join(oids)
+                else:
+                    # the executable was removed or moved since it was cached
+                    del self.entries[key]
+        return hits
+
+    def put(self, key, oid, source_file):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = {
+                "oid": oid,
+                "source": source_file,
+                "created": now,
+                "last_used": now
+            }
+
+    def _evict(self):
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.entries.items()
+                       if now - entry["last_used"] <= self.max_age)
+        if len(entries) > self.max_entries:
+            newest = sorted(entries.items(), key=lambda kv: kv[1]["last_used"], reverse=True)
+            entries = dict(newest[:self.max_entries])
+        self.entries = entries
+
+    def save(self):
+        with self.lock:
+            self._evict()
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp_path, 'w') as fd:
+                json.dump({"entries": self.entries}, fd, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# Measure how long the compiler takes on our workflows, offline. Every
+# registered test source under test/, the sources under contrib/, and a set
+# of synthetic workflows of growing size are compiled to IR (-compileMode IR,
+# which does not need the platform), each in its own JVM. For each file the
+# wall time and peak RSS of the process are recorded, as well as the time and
+# memory allocated by each compilation phase, as reported by -phaseTimings:
+#
+#   parse      parsing and type-checking the source
+#   translate  translating it to IR
+#
+# Code generation is not measured, it requires the platform.
+#
+# The compiler runs with its class-data sharing archive when there is one
+# (see util.create_cds_archive), unless --no-cds is given. --startup-runs
+# measures what the archive saves on JVM startup, by running the smallest
+# compilation with and without it.
+#
+#   ./compiler_benchmark.py --scales 10 50 200 --json compile_times.json
+import argparse
+import concurrent.futures
+import fnmatch
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import run_tests
+import util
+
+here = os.path.dirname(os.path.abspath(__file__))
+top_dir = os.path.dirname(here)
+
+SYNTHETIC_SHAPES = ["wide_scatter", "deep_nesting", "many_tasks"]
+
+INC_TASK = """task inc{suffix} {{
+  input {{
+    Int x
+  }}
+  command <<<
+    echo ~{{x}}
+  >>>
+  output {{
+    Int y = x + 1
+  }}
+}}
+"""
+
+
+# A scatter with [n] independent calls in its body
+def wide_scatter(n):
+    calls = "\n".join("    call inc as c{} {{ input: x = x }}".format(i) for i in range(n))
+    return "version 1.0\n\n" + INC_TASK.format(suffix="") + (
+        "\nworkflow wide_scatter_{n} {{\n"
+        "  input {{\n"
+        "    Array[Int] xs = [1, 2, 3]\n"
+        "  }}\n"
+        "  scatter (x in xs) {{\n"
+        "{calls}\n"
+        "  }}\n"
+        "  output {{\n"
+        "    Array[Int] ys = c{last}.y\n"
+        "  }}\n"
+        "}}\n").format(n=n, calls=calls, last=n - 1)
+
+
+# [n] levels of alternating scatter and conditional blocks, with a call at
+# the bottom
+def deep_nesting(n):
+    lines = []
+    var = "x"
+    for level in range(n):
+        indent = "  " * (level + 1)
+        if level % 2 == 0:
+            lines.append("{}scatter (x{} in xs) {{".format(indent, level))
+            var = "x{}".format(level)
+        else:
+            lines.append("{}if (b) {{".format(indent))
+    lines.append("{}call inc {{ input: x = {} }}".format("  " * (n + 1), var))
+    for level in reversed(range(n)):
+        lines.append("{}}}".format("  " * (level + 1)))
+    return "version 1.0\n\n" + INC_TASK.format(suffix="") + (
+        "\nworkflow deep_nesting_{n} {{\n"
+        "  input {{\n"
+        "    Array[Int] xs = [1, 2]\n"
+        "    Boolean b = true\n"
+        "    Int x = 0\n"
+        "  }}\n"
+        "{body}\n"
+        "}}\n").format(n=n, body="\n".join(lines))
+
+
+# A chain of calls to [n] distinct tasks
+def many_tasks(n):
+    tasks = "\n".join(INC_TASK.format(suffix=i) for i in range(n))
+    calls = ["  call inc0 as c0 { input: x = x }"]
+    calls += ["  call inc{i} as c{i} {{ input: x = c{j}.y }}".format(i=i, j=i - 1) for i in range(1, n)]
+    return "version 1.0\n\n" + tasks + (
+        "\nworkflow many_tasks_{n} {{\n"
+        "  input {{\n"
+        "    Int x = 0\n"
+        "  }}\n"
+        "{calls}\n"
+        "  output {{\n"
+        "    Int y = c{last}.y\n"
+        "  }}\n"
+        "}}\n").format(n=n, calls="\n".join(calls), last=n - 1)
+
+
+def write_synthetic_workflows(out_dir, scales):
+    generators = {"wide_scatter": wide_scatter, "deep_nesting": deep_nesting, "many_tasks": many_tasks}
+    sources = []
+    for shape in SYNTHETIC_SHAPES:
+        for n in scales:
+            name = "{}_{}".format(shape, n)
+            path = os.path.join(out_dir, name + ".wdl")
+            with open(path, "w") as fd:
+                fd.write(generators[shape](n))
+            sources.append((name, "synthetic", path, []))
+    return sources
+
+
+# The compiler flags of a test that apply to the translation to IR; inputs
+# and defaults are left out, translating them requires the platform.
+def ir_flags(tname):
+    flags = []
+    skip = False
+    for flag in run_tests.compiler_per_test_flags(tname):
+        if skip:
+            skip = False
+        elif flag in ("-inputs", "-defaults"):
+            skip = True
+        else:
+            flags.append(flag)
+    return flags
+
+
+# The sources to compile, as (name, origin, path, compiler flags)
+def find_sources(include_tests, include_contrib):
+    sources = []
+    if include_tests:
+        run_tests.register_all_tests(False)
+        for tname in sorted(run_tests.test_files.keys()):
+            sources.append((tname, "test", run_tests.test_files[tname].source_file, ir_flags(tname)))
+        run_tests.test_files.save()
+    if include_contrib:
+        for ext in ("wdl", "cwl"):
+            for path in sorted(glob.glob(os.path.join(top_dir, "contrib", "**", "*." + ext),
+                                         recursive=True)):
+                name = os.path.relpath(path, top_dir)
+                sources.append((name, "contrib", path, ["-imports", os.path.dirname(path)]))
+    return sources
+
+
+def _max_rss_bytes(rusage):
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+# The exit code of a process from its wait status, negative if it was
+# killed by a signal, as in Popen.returncode
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def java_cmdline(jar, java_opts, use_cds):
+    cmdline = util.java_command(jar) if use_cds else ["java", "-jar", jar]
+    return cmdline[:1] + java_opts + cmdline[1:]
+
+
+# Compile one source to IR in its own JVM
+def measure(jar, java_opts, name, origin, path, flags, work_dir, use_cds=True):
+    timings_path = os.path.join(work_dir, "{}.timings.json".format(abs(hash((name, path)))))
+    cmdline = (java_cmdline(jar, java_opts, use_cds) +
+               ["compile", path, "-compileMode", "IR", "-phaseTimings", timings_path, "-quiet"] + flags)
+    start = time.time()
+    with tempfile.TemporaryFile() as log:
+        proc = subprocess.Popen(cmdline, stdout=subprocess.DEVNULL, stderr=log)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = _exit_code(status)
+        wall = time.time() - start
+        log.seek(0)
+        stderr = log.read().decode("utf-8", errors="replace")
+    result = {
+        "name": name,
+        "origin": origin,
+        "source": os.path.relpath(path, top_dir) if path.startswith(top_dir) else path,
+        "status": "success" if proc.returncode == 0 else "failure",
+        "wall_time": wall,
+        "peak_rss_bytes": _max_rss_bytes(rusage),
+        "phases": {}
+    }
+    if proc.returncode != 0:
+        result["error"] = stderr.strip().splitlines()[-1] if stderr.strip() else ""
+    if os.path.exists(timings_path):
+        with open(timings_path) as fd:
+            timings = json.load(fd)
+        os.remove(timings_path)
+        result["peak_heap_bytes"] = timings.get("peakHeapBytes")
+        for phase in timings["phases"]:
+            result["phases"][phase["name"]] = {
+                "seconds": phase["seconds"],
+                "allocated_bytes": phase.get("allocatedBytes")
+            }
+    return result
+
+
+def _phase(result, name, key):
+    value = result["phases"].get(name, {}).get(key)
+    return value if value is not None else float("nan")
+
+
+def print_results(results):
+    mb = 1024.0 * 1024.0
+    print("{:<50} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10}  {}".format(
+        "source", "wall(s)", "parse(s)", "transl(s)", "alloc(MB)", "heap(MB)", "rss(MB)", "status"))
+    for r in results:
+        allocated = sum(p["allocated_bytes"] or 0 for p in r["phases"].values())
+        print("{:<50} {:>8.2f} {:>8.2f} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+            r["name"][:50], r["wall_time"], _phase(r, "parse", "seconds"),
+            _phase(r, "translate", "seconds"), allocated / mb,
+            (r.get("peak_heap_bytes") or 0) / mb, r["peak_rss_bytes"] / mb, r["status"]))
+    failed = [r for r in results if r["status"] != "success"]
+    print("{} sources, {} failed".format(len(results), len(failed)))
+
+
+# The wall time of compiling a small workflow [runs] times, with and without
+# the class-data sharing archive
+def measure_startup(jar, java_opts, runs, work_dir):
+    if len(util.java_command(jar)) == 3:
+        print("No class-data sharing archive for {}, create it with util.create_compiler_cds_archive"
+              .format(jar), file=sys.stderr)
+        return None
+    path = os.path.join(work_dir, "startup.wdl")
+    with open(path, "w") as fd:
+        fd.write(many_tasks(1))
+    startup = {}
+    for label, use_cds in [("without_cds", False), ("with_cds", True)]:
+        times = [measure(jar, java_opts, "startup", "synthetic", path, [], work_dir, use_cds)["wall_time"]
+                 for _ in range(runs)]
+        startup[label] = {"mean": sum(times) / len(times), "min": min(times)}
+    saving = startup["without_cds"]["mean"] - startup["with_cds"]["mean"]
+    print("startup over {} runs: {:.2f}s without class-data sharing, {:.2f}s with it, {:.2f}s ({:.0f}%) saved"
+          .format(runs, startup["without_cds"]["mean"], startup["with_cds"]["mean"], saving,
+                  100.0 * saving / startup["without_cds"]["mean"]))
+    return startup
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark compiling workflows to IR, offline")
+    argparser.add_argument("--jar", help="The compiler JAR (by default, the one built by run_tests.py)")
+    argparser.add_argument("--java-opts", help="Options for the JVM, e.g. '-Xmx4g'", default="")
+    argparser.add_argument("--jobs", help="Number of compilations to run concurrently", type=int, default=1)
+    argparser.add_argument("--filter", help="Only compile the sources whose name matches this glob")
+    argparser.add_argument("--no-tests", help="Do not compile the test sources", action="store_true")
+    argparser.add_argument("--no-contrib", help="Do not compile the contrib sources", action="store_true")
+    argparser.add_argument("--scales", help="Sizes of the synthetic workflows (none to skip them)",
+                           type=int, nargs="*", default=[10, 50, 200])
+    argparser.add_argument("--no-cds", help="Do not use the class-data sharing archive of the compiler",
+                           action="store_true")
+    argparser.add_argument("--startup-runs", help="Also measure the JVM startup time saved by the "
+                           "class-data sharing archive, over this many runs", type=int, default=0)
+    argparser.add_argument("--json", help="Write the results to this JSON file")
+    args = argparser.parse_args()
+
+    jar = args.jar or os.path.join(top_dir, "dxCompiler-{}.jar".format(util.get_version_id(top_dir)))
+    if not os.path.exists(jar):
+        raise RuntimeError("Compiler JAR {} not found, build it first or use --jar".format(jar))
+
+    java_opts = args.java_opts.split()
+    startup = None
+    with tempfile.TemporaryDirectory(prefix="compiler_benchmark_") as work_dir:
+        if args.startup_runs > 0:
+            startup = measure_startup(jar, java_opts, args.startup_runs, work_dir)
+        sources = find_sources(not args.no_tests, not args.no_contrib)
+        sources += write_synthetic_workflows(work_dir, args.scales)
+        if args.filter:
+            sources = [s for s in sources if fnmatch.fnmatch(s[0], args.filter)]
+        print("Compiling {} sources to IR".format(len(sources)), file=sys.stderr)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            results = list(executor.map(
+                lambda s: measure(jar, java_opts, s[0], s[1], s[2], s[3], work_dir, not args.no_cds),
+                sources
+            ))
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as fd:
+            # startup is null unless --startup-runs is given
+            json.dump({"startup": startup, "sources": results}, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Track many jobs and analyses at once. Instead of waiting on each
+# execution in turn, all the executions that are still running are
+# described together on every poll, and each one is reported as soon as
+# it reaches a terminal state. A ProgressReporter prints a summary of the
+# executions being waited on at regular intervals, which also keeps CI logs
+# alive.
+import collections
+import sys
+import threading
+import time
+
+import dxpy
+
+TERMINAL_STATES = frozenset(["done", "failed", "terminated"])
+FAILED_STATES = frozenset(["failed", "terminated"])
+# maximal number of executions in one system/describeExecutions call
+DESCRIBE_CHUNK_SIZE = 1000
+DEFAULT_FIELDS = {"id": True, "name": True, "state": True, "class": True}
+# fields the progress reporter needs, on top of the monitor's
+PROGRESS_FIELDS = {"created": True, "modified": True, "startedRunning": True, "stoppedRunning": True}
+DEFAULT_PROGRESS_INTERVAL = 60
+
+
+def _get_id(execution):
+    return execution if isinstance(execution, str) else execution.get_id()
+
+
+# Describe executions (jobs and/or analyses) in bulk. Returns a dictionary
+# from execution ID to description, in the order of [exec_ids]. Fields can
+# be limited with [fields], otherwise the default describe is returned.
+def describe_executions(exec_ids, fields=None):
+    descs = {}
+    exec_ids = list(exec_ids)
+    for i in range(0, len(exec_ids), DESCRIBE_CHUNK_SIZE):
+        chunk = exec_ids[i:i + DESCRIBE_CHUNK_SIZE]
+        request = {"executions": chunk}
+        if fields is not None:
+            request["fields"] = fields
+        response = dxpy.api.system_describe_executions(request)
+        for exec_id, result in zip(chunk, response["results"]):
+            descs[exec_id] = result["describe"]
+    return dict((exec_id, descs[exec_id]) for exec_id in exec_ids)
+
+
+def terminate(exec_id):
+    if exec_id.startswith("analysis-"):
+        dxpy.api.analysis_terminate(exec_id)
+    else:
+        dxpy.api.job_terminate(exec_id)
+
+
+# The (queue time, run time) of a finished execution, in seconds. An
+# execution that never started running spent its whole lifetime queued, and
+# has a run time of 0. The run time of an analysis is
+# measured on its jobs, from the first one that started running to the last
+# one that stopped, so that the time before its first job ran counts as queue
+# time.
+def execution_times(exec_id, desc):
+    if exec_id.startswith("analysis-"):
+        jobs = [result["describe"] for result in dxpy.find_executions(
+            root_execution=exec_id, classname="job",
+            describe={"fields": {"startedRunning": True, "stoppedRunning": True}})]
+    else:
+        jobs = [desc]
+    started = [job for job in jobs if job.get("startedRunning")]
+    if not started:
+        return (desc["modified"] - desc["created"]) / 1000.0, 0.0
+    first = min(job["startedRunning"] for job in started)
+    last = max(job.get("stoppedRunning") or desc["modified"] for job in started)
+    return (first - desc["created"]) / 1000.0, (last - first) / 1000.0
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+    return "{}s".format(seconds)
+
+
+# When an execution started running, in seconds since the epoch, or None
+# if it has not started (e.g. it is still queued)
+def _started(desc):
+    started = desc.get("startedRunning")
+    return started / 1000.0 if started is not None else None
+
+
+class ProgressReporter(object):
+    """
+    Prints one status line about the executions of a monitor every
+    [interval] seconds, from a background thread: the number of executions
+    in each state, the one that has been running the longest, and an
+    estimate of the time left, based on how long the executions that
+    completed took. Use it as a context manager; the thread is stopped,
+    and a last status line printed, on exit.
+    """
+    def __init__(self, monitor, interval=DEFAULT_PROGRESS_INTERVAL, out=None):
+        self.monitor = monitor
+        self.interval = interval
+        self.out = out or sys.stdout
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def eta(self, descs, now):
+        """Estimate the time left from the durations of the executions that
+        completed: each pending execution is expected to take as long as the
+        average completed execution that ran longer than it has so far.
+        Returns the seconds until the last one completes (None if nothing
+        completed yet), and the number of executions that already ran longer
+        than any completed one."""
+        durations = []
+        for desc in descs.values():
+            started = _started(desc)
+            stopped = desc.get("stoppedRunning") or desc.get("modified")
+            if desc["state"] in TERMINAL_STATES and started is not None and stopped is not None:
+                durations.append(stopped / 1000.0 - started)
+        if not durations:
+            return None, 0
+        eta = 0.0
+        overdue = 0
+        for exec_id in self.monitor.exec_ids:
+            desc = descs.get(exec_id)
+            if desc is not None and desc["state"] in TERMINAL_STATES:
+                continue
+            started = _started(desc) if desc is not None else None
+            elapsed = now - started if started is not None else 0.0
+            longer = [d for d in durations if d > elapsed]
+            if longer:
+                eta = max(eta, sum(longer) / len(longer) - elapsed)
+            else:
+                overdue += 1
+        return eta, overdue
+
+    def status_line(self, now=None):
+        now = now or time.time()
+        # a snapshot, the monitor keeps polling
+        descs = dict(self.monitor.descs)
+        total = len(self.monitor.exec_ids)
+        counts = collections.Counter(desc["state"] for desc in descs.values())
+        if total > len(descs):
+            counts["not polled yet"] = total - len(descs)
+        completed = sum(n for state, n in counts.items() if state in TERMINAL_STATES)
+        line = "[{}] {}/{} complete: {}".format(
+            _format_duration(now - self.start_time), completed, total,
+            ", ".join("{} {}".format(n, state) for state, n in sorted(counts.items())))
+        running = [(exec_id, desc) for exec_id, desc in descs.items()
+                   if desc["state"] not in TERMINAL_STATES and _started(desc) is not None]
+        if running:
+            exec_id, desc = min(running, key=lambda item: _started(item[1]))
+            line += "; longest running: {} ({}) for {}".format(
+                desc.get("name", exec_id), exec_id, _format_duration(now - _started(desc)))
+        if completed < total:
+            eta, overdue = self.eta(descs, now)
+            line += "; ETA {}".format(_format_duration(eta) if eta is not None else "unknown")
+            if overdue:
+                line += " ({} running longer than any completed execution)".format(overdue)
+        return line
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.status_line(), file=self.out, flush=True)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, name="progress-reporter", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        print(self.status_line(), file=self.out, flush=True)
+        return False
+
+
+class ExecutionMonitor(object):
+    """
+    Polls a set of executions until all of them finish.
+
+    on_complete(exec_id, desc) is called once for every execution, as soon
+    as it is seen in a terminal state. is_expected_failure(exec_id, desc)
+    decides whether a failure is part of the test; with fail_fast, the first
+    unexpected failure terminates all the executions that are still running.
+    The polling interval starts at min_interval and grows up to max_interval
+    while nothing changes, and goes back to min_interval on every change.
+    With progress_interval, a ProgressReporter prints a status line every
+    progress_interval seconds while waiting.
+    """
+    def __init__(self,
+                 executions,
+                 on_complete=None,
+                 is_expected_failure=None,
+                 fail_fast=False,
+                 min_interval=2,
+                 max_interval=60,
+                 fields=None,
+                 progress_interval=None):
+        self.exec_ids = [_get_id(e) for e in executions]
+        self.on_complete = on_complete
+        self.is_expected_failure = is_expected_failure or (lambda exec_id, desc: False)
+        self.fail_fast = fail_fast
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.fields = fields or DEFAULT_FIELDS
+        self.progress_interval = progress_interval
+        if progress_interval is not None:
+            self.fields = dict(self.fields, **PROGRESS_FIELDS)
+        self.descs = {}
+        self.completed = {}
+        self.aborted = False
+        self.num_polls = 0
+
+    def pending(self):
+        return [exec_id for exec_id in self.exec_ids if exec_id not in self.completed]
+
+    def poll(self):
+        """Describe all the running executions once. Returns the number of
+        executions that completed since the last poll."""
+        pending = self.pending()
+        self.num_polls += 1
+        newly_completed = 0
+        unexpected_failure = False
+        for exec_id, desc in describe_executions(pending, self.fields).items():
+            self.descs[exec_id] = desc
+            if desc["state"] not in TERMINAL_STATES:
+                continue
+            self.completed[exec_id] = desc
+            newly_completed += 1
+            if self.on_complete is not None:
+                self.on_complete(exec_id, desc)
+            if desc["state"] in FAILED_STATES and not self.is_expected_failure(exec_id, desc):
+                unexpected_failure = True
+        # every execution that finished in this batch is reported before
+        # the rest are terminated
+        if self.fail_fast and unexpected_failure:
+            self.abort()
+        return newly_completed
+
+    def abort(self):
+        remaining = self.pending()
+        if remaining:
+            print("fail-fast: terminating {} remaining executions".format(len(remaining)),
+                  file=sys.stderr)
+        for exec_id in remaining:
+            try:
+                terminate(exec_id)
+            except dxpy.DXError as e:
+                print("could not terminate {}: {}".format(exec_id, e), file=sys.stderr)
+        self.aborted = True
+
+    def wait(self):
+        """Poll until every execution has completed (or the monitor was aborted).
+        Returns a dictionary from execution ID to its last description."""
+        if self.progress_interval is None:
+            return self._wait()
+        with ProgressReporter(self, self.progress_interval):
+            return self._wait()
+
+    def _wait(self):
+        interval = self.min_interval
+        while not self.aborted and self.pending():
+            if self.poll() > 0:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * 1.5)
+            if not self.aborted and self.pending():
+                time.sleep(interval)
+        return self.descs
+
+    def failed(self):
+        return [exec_id for exec_id, desc in self.completed.items()
+                if desc["state"] in FAILED_STATES]
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+# A local, in-memory stand-in for the DNAnexus API server, implementing the
+# subset of the API that the scripts in this directory use: finding
+# projects and data objects, folders, files (including downloads), records,
+# applets and workflows, and the jobs and analyses they run. API latency,
+# queueing and job durations are configurable, which makes it possible to
+# measure the overhead of the scripts themselves, offline.
+#
+# Run it as a server, and point dxpy or dx at it with the environment
+# variables it prints:
+#   ./fake_platform.py --port 8124 --job-duration 5 --project dxCompiler_playground
+#
+# or start it in-process with FakePlatformServer (see harness_benchmark.py).
+import argparse
+import fnmatch
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+
+DEFAULT_REGION = "aws:us-east-1"
+DEFAULT_INSTANCE_TYPE = "mem1_ssd1_x4"
+
+
+class APIError(Exception):
+    def __init__(self, status, error_type, message):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+
+def _not_found(oid):
+    return APIError(404, "ResourceNotFound", "{} could not be found".format(oid))
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _name_matches(pattern, name):
+    if pattern is None:
+        return True
+    if isinstance(pattern, dict):
+        if "glob" in pattern:
+            return fnmatch.fnmatchcase(name, pattern["glob"])
+        if "regexp" in pattern:
+            return re.search(pattern["regexp"], name) is not None
+        raise APIError(422, "InvalidInput", "unsupported name query {}".format(pattern))
+    return name == pattern
+
+
+def _in_folder(folder, scope_folder, recurse):
+    if scope_folder is None:
+        return True
+    if folder == scope_folder:
+        return True
+    return recurse and folder.startswith(scope_folder.rstrip("/") + "/")
+
+
+def _select_fields(desc, fields):
+    if not fields:
+        return desc
+    return dict((k, v) for k, v in desc.items() if k == "id" or fields.get(k))
+
+
+class FakePlatform(object):
+    """
+    The state of the fake platform, and the implementation of the API routes.
+
+    latency       seconds added to every API call
+    queue_time    seconds an execution waits before it starts running
+    job_duration  seconds an execution runs; each execution runs for a time
+                  drawn uniformly from job_duration * (1 +/- jitter)
+    failure_rate  fraction of the executions that fail
+    """
+    def __init__(self, latency=0.0, queue_time=0.0, job_duration=1.0, jitter=0.0,
+                 failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.queue_time = queue_time
+        self.job_duration = job_duration
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.counter = 0
+        self.projects = {}
+        self.objects = {}
+        self.contents = {}
+        self.executions = {}
+        self.request_counts = {}
+        self.download_url = None
+
+    def new_id(self, cls):
+        with self.lock:
+            self.counter += 1
+            return "{}-{:024d}".format(cls, self.counter)
+
+    # Setting up the platform, in-process
+
+    def add_project(self, name, region=DEFAULT_REGION):
+        pid = self.new_id("project")
+        with self.lock:
+            self.projects[pid] = {"id": pid, "class": "project", "name": name, "region": region,
+                                  "folders": set(["/"]), "created": _now_ms()}
+        return pid
+
+    def new_folder(self, project, folder):
+        with self.lock:
+            folders = self._project(project)["folders"]
+            parts = [p for p in folder.split("/") if p]
+            for i in range(len(parts)):
+                folders.add("/" + "/".join(parts[:i + 1]))
+
+    def _add_object(self, cls, project, folder, name, state="closed", **fields):
+        oid = self.new_id(cls)
+        self.new_folder(project, folder)
+        now = _now_ms()
+        obj = {"id": oid, "class": cls, "project": project, "folder": folder, "name": name,
+               "state": state, "created": now, "modified": now, "types": [], "tags": [],
+               "properties": {}, "hidden": False}
+        obj.update(fields)
+        with self.lock:
+            self.objects[oid] = obj
+        return oid
+
+    def add_file(self, project, folder, name, contents=b"", **fields):
+        if isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        oid = self._add_object("file", project, folder, name, size=len(contents), media="text/plain",
+                               **fields)
+        with self.lock:
+            self.contents[oid] = contents
+        return oid
+
+    def add_record(self, project, folder, name, details=None, types=None):
+        return self._add_object("record", project, folder, name, details=details or {},
+                                types=types or [])
+
+    # [outputs] is the output of every execution of the applet
+    def add_applet(self, project, folder, name, outputs=None):
+        return self._add_object("applet", project, folder, name, outputs=outputs or {})
+
+    def add_workflow(self, project, folder, name, outputs=None):
+        return self._add_object("workflow", project, folder, name, outputs=outputs or {})
+
+    # Executions
+
+    def run(self, executable_id, body):
+        executable = self._object(executable_id)
+        cls = "analysis" if executable["class"] == "workflow" else "job"
+        eid = self.new_id(cls)
+        now = _now_ms()
+        duration = self.job_duration * (1 + self.jitter * (2 * self.random.random() - 1))
+        execution = {
+            "id": eid,
+            "class": cls,
+            "name": body.get("name", executable["name"]),
+            "project": body.get("project", executable["project"]),
+            "folder": body.get("folder", "/"),
+            "executable": executable_id,
+            "executableName": executable["name"],
+            "input": body.get("input", {}),
+            "created": now,
+            "started": now + int(self.queue_time * 1000),
+            "stopped": now + int((self.queue_time + max(duration, 0)) * 1000),
+            "fails": self.random.random() < self.failure_rate,
+            "terminated": None,
+            "outputs": executable.get("outputs", {})
+        }
+        with self.lock:
+            self.executions[eid] = execution
+        return eid
+
+    def _execution_desc(self, eid):
+        with self.lock:
+            execution = self.executions.get(eid)
+        if execution is None:
+            raise _not_found(eid)
+        now = _now_ms()
+        desc = dict((k, execution[k]) for k in ("id", "class", "name", "project", "folder",
+                                                   "executable", "executableName", "input", "created"))
+        stopped = execution["stopped"]
+        if execution["terminated"] is not None and execution["terminated"] < stopped:
+            state, stopped = "terminated", execution["terminated"]
+        elif now >= stopped:
+            state = "failed" if execution["fails"] else "done"
+        elif now >= execution["started"]:
+            state = "running"
+        else:
+            state = "runnable"
+        desc["state"] = state
+        desc["modified"] = min(now, stopped) if state in ("done", "failed", "terminated") else now
+        output = execution["outputs"] if state == "done" else None
+        desc["output"] = output
+        if state == "failed":
+            desc["failureReason"] = "AppError"
+            desc["failureMessage"] = "the fake execution failed"
+        if execution["class"] == "job":
+            desc["applet"] = execution["executable"]
+            desc["instanceType"] = DEFAULT_INSTANCE_TYPE
+            if now >= execution["started"]:
+                desc["startedRunning"] = min(execution["started"], stopped)
+            if state in ("done", "failed", "terminated"):
+                desc["stoppedRunning"] = stopped
+        else:
+            desc["workflow"] = {"id": execution["executable"]}
+            desc["stages"] = [{"id": "stage-outputs",
+                               "execution": {"id": eid, "state": state, "output": output}}]
+        return desc
+
+    def terminate(self, eid):
+        with self.lock:
+            execution = self.executions.get(eid)
+            if execution is None:
+                raise _not_found(eid)
+            if execution["terminated"] is None:
+                execution["terminated"] = _now_ms()
+
+    # Describing objects
+
+    def _project(self, pid):
+        project = self.projects.get(pid)
+        if project is None:
+            raise _not_found(pid)
+        return project
+
+    def _object(self, oid):
+        with self.lock:
+            obj = self.objects.get(oid)
+        if obj is None:
+            raise _not_found(oid)
+        return obj
+
+    def describe(self, oid, fields=None):
+        if oid.startswith("project-") or oid.startswith("container-"):
+            project = self._project(oid)
+            desc = dict((k, v) for k, v in project.items() if k != "folders")
+            desc["level"] = "ADMINISTER"
+            return _select_fields(desc, fields)
+        if oid.startswith("job-") or oid.startswith("analysis-"):
+            return _select_fields(self._execution_desc(oid), fields)
+        desc = dict((k, v) for k, v in self._object(oid).items() if k != "outputs")
+        return _select_fields(desc, fields)
+
+    def _describe_option(self, option):
+        """The fields requested by a describe option, or None for the default"""
+        if isinstance(option, dict):
+            return option.get("fields")
+        return None
+
+    # API routes
+
+    def find_projects(self, body):
+        results = []
+        with self.lock:
+            projects = list(self.projects.values())
+        for project in projects:
+            if not _name_matches(body.get("name"), project["name"]):
+                continue
+            result = {"id": project["id"], "level": "ADMINISTER", "permissionSources": [],
+                      "public": False}
+            if body.get("describe"):
+                result["describe"] = self.describe(project["id"],
+                                                   self._describe_option(body["describe"]))
+            results.append(result)
+        return {"results": results[:body.get("limit", 1000)], "next": None}
+
+    def find_data_objects(self, body):
+        scope = body.get("scope") or {}
+        results = []
+        with self.lock:
+            objects = list(self.objects.values())
+        for obj in objects:
+            if body.get("class") and obj["class"] != body["class"]:
+                continue
+            if scope.get("project") and obj["project"] != scope["project"]:
+                continue
+            if not _in_folder(obj["folder"], scope.get("folder"), scope.get("recurse", True)):
+                continue
+            if not _name_matches(body.get("name"), obj["name"]):
+                continue
+            if body.get("state") and body["state"] != "any" and obj["state"] != body["state"]:
+                continue
+            if body.get("visibility") == "visible" and obj["hidden"]:
+                continue
+            if any(obj["properties"].get(k) != v for k, v in (body.get("properties") or {}).items()
+                   if v is not True):
+                continue
+            result = {"project": obj["project"], "id": obj["id"]}
+            if body.get("describe"):
+                result["describe"] = self.describe(obj["id"], self._describe_option(body["describe"]))
+            results.append(result)
+        return {"results": results[:body.get("limit", 1000)], "next": None}
+
+    def describe_data_objects(self, body):
+        options = body.get("classDescribeOptions", {})
+        results = []
+        for item in body.get("objects", []):
+            oid = item if isinstance(item, str) else item["id"]
+            try:
+                cls = oid.split("-")[0]
+                option = options.get(cls, options.get("*"))
+                results.append({"describe": self.describe(oid, self._describe_option(option))})
+            except APIError as e:
+                results.append({"error": {"type": e.error_type, "message": str(e)}})
+        return {"results": results}
+
+    def describe_executions(self, body):
+        results = []
+        for eid in body.get("executions", []):
+            results.append({"describe": self.describe(eid, body.get("fields"))})
+        return {"results": results}
+
+    # The executions of the fake have no subjobs: each one is its own root
+    def find_executions(self, body):
+        with self.lock:
+            eids = list(self.executions.keys())
+        results = []
+        for eid in eids:
+            if body.get("rootExecution") and eid != body["rootExecution"]:
+                continue
+            if body.get("class") and not eid.startswith(body["class"] + "-"):
+                continue
+            result = {"id": eid}
+            if body.get("describe"):
+                result["describe"] = self.describe(eid, self._describe_option(body["describe"]))
+            results.append(result)
+        return {"results": results[:body.get("limit", 1000)], "next": None}
+
+    def remove_folder(self, pid, body):
+        folder = body["folder"]
+        recurse = body.get("recurse", False)
+        with self.lock:
+            project = self._project(pid)
+            for oid, obj in list(self.objects.items()):
+                if obj["project"] == pid and _in_folder(obj["folder"], folder, recurse):
+                    del self.objects[oid]
+                    self.contents.pop(oid, None)
+            project["folders"] = set(f for f in project["folders"]
+                                     if f == "/" or not _in_folder(f, folder, True))
+        return {"id": pid, "completed": True}
+
+    def list_folder(self, pid, body):
+        folder = body.get("folder", "/")
+        with self.lock:
+            project = self._project(pid)
+            folders = sorted(f for f in project["folders"]
+                             if f != folder and f.rsplit("/", 1)[0] == folder.rstrip("/"))
+            objects = [obj for obj in self.objects.values()
+                       if obj["project"] == pid and obj["folder"] == folder]
+        results = []
+        for obj in objects:
+            result = {"id": obj["id"]}
+            if body.get("describe"):
+                result["describe"] = self.describe(obj["id"], self._describe_option(body["describe"]))
+            results.append(result)
+        return {"objects": results, "folders": folders}
+
+    def new_object(self, cls, body):
+        project = body.get("project")
+        folder = body.get("folder", "/")
+        name = body.get("name", cls)
+        if cls == "file":
+            if "symlinkPath" in body:
+                oid = self.add_file(project, folder, name, b"", symlinkPath=body["symlinkPath"],
+                                    md5=body.get("md5sum"))
+            else:
+                oid = self.add_file(project, folder, name, b"")
+                self._object(oid)["state"] = "open"
+        elif cls == "record":
+            oid = self.add_record(project, folder, name, body.get("details"), body.get("types"))
+            if not body.get("close"):
+                self._object(oid)["state"] = "open"
+        else:
+            raise APIError(422, "InvalidInput", "cannot create a {} here".format(cls))
+        obj = self._object(oid)
+        for key in ("properties", "tags", "types", "details", "hidden"):
+            if key in body:
+                obj[key] = body[key]
+        return {"id": oid}
+
+    def handle(self, route, body):
+        """Dispatch an API call. Returns the JSON response, or raises APIError."""
+        with self.lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+        m = re.match(r"^/([a-z]+)(?:-([0-9A-Za-z]+))?/([A-Za-z]+)$", route)
+        if m is None:
+            raise APIError(404, "InvalidInput", "unknown route {}".format(route))
+        cls, suffix, method = m.group(1), m.group(2), m.group(3)
+        oid = "{}-{}".format(cls, suffix) if suffix else None
+
+        if cls == "system":
+            handlers = {
+                "findProjects": self.find_projects,
+                "findDataObjects": self.find_data_objects,
+                "describeDataObjects": self.describe_data_objects,
+                "describeExecutions": self.describe_executions,
+                "findExecutions": self.find_executions,
+                "whoami": lambda body: {"id": "user-fake"}
+            }
+            if method not in handlers:
+                raise APIError(404, "InvalidInput", "unknown route {}".format(route))
+            return handlers[method](body)
+        if oid is None:
+            if method == "new":
+                return self.new_object(cls, body)
+            raise APIError(404, "InvalidInput", "unknown route {}".format(route))
+        if method == "describe":
+            return self.describe(oid, body.get("fields"))
+        if cls in ("project", "container"):
+            if method == "newFolder":
+                folders = self._project(oid)["folders"]
+                parent = body["folder"].rstrip("/").rsplit("/", 1)[0] or "/"
+                if not body.get("parents") and parent not in folders:
+                    raise APIError(404, "ResourceNotFound",
+                                   "the parent folder {} does not exist".format(parent))
+                self.new_folder(oid, body["folder"])
+                return {"id": oid}
+            if method == "removeFolder":
+                return self.remove_folder(oid, body)
+            if method == "listFolder":
+                return self.list_folder(oid, body)
+        if cls in ("applet", "workflow") and method == "run":
+            return {"id": self.run(oid, body)}
+        if cls in ("job", "analysis") and method == "terminate":
+            self.terminate(oid)
+            return {"id": oid}
+        if method == "close":
+            self._object(oid)["state"] = "closed"
+            return {"id": oid}
+        if cls == "record" and method == "getDetails":
+            return self._object(oid).get("details", {})
+        if cls == "file" and method == "download":
+            self._object(oid)
+            return {"url": "{}/F/{}".format(self.download_url, oid), "headers": {},
+                    "expires": _now_ms() + 24 * 3600 * 1000}
+        raise APIError(404, "InvalidInput", "unknown route {}".format(route))
+
+    def read_range(self, oid, range_header):
+        with self.lock:
+            data = self.contents.get(oid)
+        if data is None:
+            raise _not_found(oid)
+        m = re.match(r"^bytes=(\d+)-(\d*)$", range_header or "")
+        if m is None:
+            return data
+        start = int(m.group(1))
+        end = int(m.group(2)) + 1 if m.group(2) else len(data)
+        return data[start:end]
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload, content_type="application/json"):
+        if content_type == "application/json":
+            payload = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        platform = self.server.platform
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        if platform.latency > 0:
+            time.sleep(platform.latency)
+        try:
+            body = json.loads(raw.decode("utf-8")) if raw else {}
+            self._send(200, platform.handle(self.path, body))
+        except APIError as e:
+            self._send(e.status, {"error": {"type": e.error_type, "message": str(e)}})
+        except Exception as e:
+            self._send(500, {"error": {"type": "InternalError", "message": repr(e)}})
+
+    def do_GET(self):
+        platform = self.server.platform
+        if not self.path.startswith("/F/"):
+            self._send(404, {"error": {"type": "ResourceNotFound", "message": self.path}})
+            return
+        if platform.latency > 0:
+            time.sleep(platform.latency)
+        try:
+            data = platform.read_range(self.path[len("/F/"):], self.headers.get("Range"))
+        except APIError as e:
+            self._send(e.status, {"error": {"type": e.error_type, "message": str(e)}})
+            return
+        status = 206 if self.headers.get("Range") else 200
+        self._send(status, data, "application/octet-stream")
+
+
+# http.server.ThreadingHTTPServer needs Python 3.7, CI runs 3.6
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class FakePlatformServer(object):
+    """Serve a FakePlatform over HTTP on localhost, from a background thread"""
+    def __init__(self, platform=None, port=0):
+        self.platform = platform or FakePlatform()
+        self.httpd = _ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self.httpd.platform = self.platform
+        self.port = self.httpd.server_address[1]
+        self.platform.download_url = "http://127.0.0.1:{}".format(self.port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def env(self, project_id=None):
+        """The environment variables that point dxpy and dx to this server"""
+        env = {
+            "DX_APISERVER_PROTOCOL": "http",
+            "DX_APISERVER_HOST": "127.0.0.1",
+            "DX_APISERVER_PORT": str(self.port),
+            "DX_SECURITY_CONTEXT": json.dumps({"auth_token_type": "Bearer", "auth_token": "fake"}),
+        }
+        if project_id is not None:
+            env["DX_PROJECT_CONTEXT_ID"] = project_id
+        return env
+
+    def configure_dxpy(self, project_id=None):
+        """Point the dxpy of this process to the server"""
+        import dxpy
+        dxpy.set_api_server_info(host="127.0.0.1", port=self.port, protocol="http")
+        dxpy.set_security_context({"auth_token_type": "Bearer", "auth_token": "fake"})
+        if project_id is not None:
+            dxpy.set_workspace_id(project_id)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Run a local fake DNAnexus API server")
+    argparser.add_argument("--port", type=int, default=8124)
+    argparser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API call")
+    argparser.add_argument("--queue-time", type=float, default=0.0,
+                           help="Seconds an execution waits before it runs")
+    argparser.add_argument("--job-duration", type=float, default=1.0, help="Seconds an execution runs")
+    argparser.add_argument("--jitter", type=float, default=0.0,
+                           help="Relative variation of the job duration")
+    argparser.add_argument("--failure-rate", type=float, default=0.0,
+                           help="Fraction of the executions that fail")
+    argparser.add_argument("--project", action="append", default=[],
+                           help="Create a project with this name")
+    argparser.add_argument("--region", default=DEFAULT_REGION)
+    args = argparser.parse_args()
+
+    platform = FakePlatform(latency=args.latency,
+                            queue_time=args.queue_time,
+                            job_duration=args.job_duration,
+                            jitter=args.jitter,
+                            failure_rate=args.failure_rate)
+    project_ids = [platform.add_project(name, args.region) for name in args.project]
+    server = FakePlatformServer(platform, args.port)
+    for name, pid in zip(args.project, project_ids):
+        print("# project {} = {}".format(name, pid))
+    for key, value in server.env(project_ids[0] if project_ids else None).items():
+        print("export {}='{}'".format(key, value))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
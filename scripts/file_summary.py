@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Read platform files in a single streaming pass that counts their size,
+# computes their digests and keeps their contents (up to a limit), without
+# writing them to disk. Each file is read at most once, and reads run on a
+# bounded thread pool.
+from collections import namedtuple
+import concurrent.futures
+import hashlib
+import threading
+
+import dxpy
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256")
+CHUNK_SIZE = 1 << 20
+# only this much of a file's contents is kept in memory
+MAX_CONTENTS_SIZE = 1 << 20
+# maximal number of objects in one system/describeDataObjects call
+DESCRIBE_CHUNK_SIZE = 1000
+
+# contents_complete is False if the file has more than MAX_CONTENTS_SIZE bytes,
+# not counting trailing whitespace; [contents] is then only the head of the file
+FileSummary = namedtuple('FileSummary',
+                         ['file_id', 'size', 'digests', 'contents', 'contents_complete'])
+
+
+def parse_link(link):
+    """Returns the (file ID, project ID or None) of a $dnanexus_link value"""
+    value = link["$dnanexus_link"]
+    if isinstance(value, dict):
+        return value["id"], value.get("project")
+    return value, None
+
+
+def summarize(file_id, project=None):
+    hashes = dict((algo, hashlib.new(algo)) for algo in HASH_ALGORITHMS)
+    size = 0
+    contents = bytearray()
+    contents_complete = True
+    with dxpy.DXFile(file_id, project=project, mode="rb") as fd:
+        while True:
+            chunk = fd.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            for h in hashes.values():
+                h.update(chunk)
+            room = MAX_CONTENTS_SIZE - len(contents)
+            if room > 0:
+                contents += chunk[:room]
+                chunk = chunk[room:]
+            if chunk.strip():
+                contents_complete = False
+    return FileSummary(file_id=file_id,
+                       size=size,
+                       digests=dict((algo, h.hexdigest()) for algo, h in hashes.items()),
+                       contents=bytes(contents),
+                       contents_complete=contents_complete)
+
+
+class FileSummaryCache(object):
+    def __init__(self, max_workers=8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def _future(self, link):
+        file_id, project = parse_link(link)
+        with self.lock:
+            future = self.futures.get(file_id)
+            if future is None:
+                future = self.executor.submit(summarize, file_id, project)
+                self.futures[file_id] = future
+            return future
+
+    def prefetch(self, links):
+        """Start reading the files in the background"""
+        for link in links:
+            self._future(link)
+
+    def get(self, link):
+        return self._future(link).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# The sizes of the files in [links], described in bulk. Returns a dictionary
+# from file ID to size; files that cannot be described are left out.
+def file_sizes(links):
+    ids = sorted(set(parse_link(link)[0] for link in links))
+    sizes = {}
+    for i in range(0, len(ids), DESCRIBE_CHUNK_SIZE):
+        chunk = ids[i:i + DESCRIBE_CHUNK_SIZE]
+        response = dxpy.api.system_describe_data_objects({
+            "objects": chunk,
+            "classDescribeOptions": {"file": {"fields": {"size": True}}}
+        })
+        for file_id, result in zip(chunk, response["results"]):
+            desc = result.get("describe")
+            if desc is not None and "size" in desc:
+                sizes[file_id] = desc["size"]
+    return sizes
+
+
+# Find all the file links in a (possibly nested) value
+def find_links(value):
+    if isinstance(value, dict):
+        if "$dnanexus_link" in value:
+            return [value]
+        return [link for v in value.values() for link in find_links(v)]
+    if isinstance(value, list):
+        return [link for v in value for link in find_links(v)]
+    return []
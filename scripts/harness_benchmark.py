@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Measure the overhead of the test harness itself, offline: run_tests.py is
+# driven against a local fake platform (fake_platform.py) with synthetic
+# tests, and the time spent in each of its phases is reported:
+#
+#   register  finding and parsing the tests, with a cold and a warm index
+#   launch    starting one execution per test
+#   poll      waiting for the executions; the time spent describing them, and
+#             how long after the last execution finished the wait returned
+#   verify    reading the outputs and checking them against the expected results
+#
+#   ./harness_benchmark.py --sizes 10 100 1000 --latency 0.01 --job-duration 5
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import dxpy
+
+import exec_monitor
+import fake_platform
+import run_tests
+
+
+class TimedMonitor(exec_monitor.ExecutionMonitor):
+    """An ExecutionMonitor that counts the time spent polling"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_time = 0.0
+
+    def poll(self):
+        start = time.time()
+        try:
+            return super().poll()
+        finally:
+            self.poll_time += time.time() - start
+
+
+# Create [n] synthetic WDL tests in [test_dir], with one input each, and an
+# applet on the platform for each of them that returns the expected outputs.
+# Returns a dictionary from test name to applet ID.
+def make_tests(test_dir, platform, project_id, folder, n):
+    runnable = {}
+    for i in range(n):
+        tname = "bench_{}".format(i)
+        with open(os.path.join(test_dir, tname + ".wdl"), "w") as fd:
+            fd.write("version 1.0\n\n"
+                     "task {} {{\n"
+                     "  input {{ Int x }}\n"
+                     "  command <<< echo hello ~{{x}} > out.txt >>>\n"
+                     "  output {{ File out = \"out.txt\"\n"
+                     "           Int n = x }}\n"
+                     "}}\n".format(tname))
+        for suffix, value in [("_input.json", {"{}.x".format(tname): i}),
+                              ("_input.dx.json", {"x": i}),
+                              ("_results.json", {"{}.out".format(tname): "hello {}".format(i),
+                                                 "{}.n".format(tname): i})]:
+            with open(os.path.join(test_dir, tname + suffix), "w") as fd:
+                json.dump(value, fd)
+        file_id = platform.add_file(project_id, folder + "/outputs", "out_{}.txt".format(i),
+                                    "hello {}\n".format(i))
+        runnable[tname] = platform.add_applet(project_id, folder, tname,
+                                              {"out": {"$dnanexus_link": file_id}, "n": i})
+    return runnable
+
+
+def _api_calls(platform):
+    return sum(platform.request_counts.values())
+
+
+def benchmark(platform, n, args):
+    results = {"tests": n}
+    work_dir = tempfile.mkdtemp(prefix="harness_benchmark_")
+    try:
+        project_id = platform.add_project("harness_benchmark_{}".format(n))
+        project = dxpy.DXProject(project_id)
+        test_dir = os.path.join(work_dir, "test")
+        os.makedirs(test_dir)
+        runnable = make_tests(test_dir, platform, project_id, "/applets", n)
+        run_tests.test_dir = test_dir
+        index_path = os.path.join(work_dir, "test_index.json")
+        log = io.StringIO()
+
+        for phase in ("register_cold", "register_warm"):
+            start = time.time()
+            run_tests.register_all_tests(False, index_path)
+            num_tests = len(run_tests.test_files)
+            run_tests.test_files.save()
+            results[phase] = time.time() - start
+        assert num_tests == n, "registered {} of {} tests".format(num_tests, n)
+
+        calls = _api_calls(platform)
+        start = time.time()
+        with contextlib.redirect_stdout(log):
+            registry = run_tests.launch_tests(project, runnable, "/test", False, False, args.launch_jobs)
+        results["launch"] = time.time() - start
+        results["launch_rate"] = n / max(results["launch"], 1e-6)
+        results["launch_api_calls"] = _api_calls(platform) - calls
+
+        calls = _api_calls(platform)
+        monitor = TimedMonitor(registry.keys(), min_interval=args.poll_interval,
+                               max_interval=args.max_poll_interval)
+        monitor.wait()
+        finished = time.time()
+        descs = exec_monitor.describe_executions(registry.keys())
+        last_stop = max(desc.get("stoppedRunning", desc["modified"]) for desc in descs.values()) / 1000.0
+        results["polls"] = monitor.num_polls
+        results["poll_time"] = monitor.poll_time
+        results["poll_api_calls"] = _api_calls(platform) - calls
+        results["completion_lag"] = max(0.0, finished - last_stop)
+
+        calls = _api_calls(platform)
+        start = time.time()
+        with contextlib.redirect_stdout(log):
+            failures = run_tests.verify_executions(registry, descs, args.verify_jobs)
+        results["verify"] = time.time() - start
+        results["verify_api_calls"] = _api_calls(platform) - calls
+        assert not failures, "verification failed: {}".format(failures)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_results(all_results):
+    # (name, number of decimals)
+    columns = [("tests", 0), ("register_cold", 3), ("register_warm", 3), ("launch", 2),
+               ("launch_rate", 1), ("polls", 0), ("poll_time", 2), ("completion_lag", 2),
+               ("verify", 2)]
+    print(" ".join("{:>14}".format(name) for name, _ in columns))
+    for results in all_results:
+        print(" ".join("{:>14.{}f}".format(results[name], decimals) for name, decimals in columns))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark the test harness against a fake platform")
+    argparser.add_argument("--sizes", help="Numbers of synthetic tests", type=int, nargs="+",
+                           default=[10, 100, 1000])
+    argparser.add_argument("--latency", help="Seconds added to every API call", type=float, default=0.005)
+    argparser.add_argument("--queue-time", help="Seconds an execution is queued", type=float, default=0.0)
+    argparser.add_argument("--job-duration", help="Seconds an execution runs", type=float, default=2.0)
+    argparser.add_argument("--jitter", help="Relative variation of the job duration", type=float,
+                           default=0.5)
+    argparser.add_argument("--launch-jobs", type=int, default=8)
+    argparser.add_argument("--verify-jobs", type=int, default=8)
+    argparser.add_argument("--poll-interval", help="Initial polling interval", type=float, default=2)
+    argparser.add_argument("--max-poll-interval", type=float, default=60)
+    argparser.add_argument("--json", help="Also write the results to this JSON file")
+    args = argparser.parse_args()
+
+    platform = fake_platform.FakePlatform(latency=args.latency,
+                                          queue_time=args.queue_time,
+                                          job_duration=args.job_duration,
+                                          jitter=args.jitter)
+    all_results = []
+    with fake_platform.FakePlatformServer(platform) as server:
+        server.configure_dxpy()
+        for n in args.sizes:
+            print("Benchmarking {} tests".format(n), file=sys.stderr)
+            all_results.append(benchmark(platform, n, args))
+    print_results(all_results)
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump(all_results, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,136 +1,356 @@
 #!/usr/bin/env python
 import argparse
+import base64
+import binascii
+import collections
 from collections import namedtuple
+import concurrent.futures
 import dxpy
+import hashlib
+import itertools
 import json
 import multiprocessing
 import pprint
 import os
-import subprocess
+import random
+import re
+import threading
+import urllib.error
+import urllib.request
 
 from typing import Callable, Iterator, Union, Optional, List
 import time
 
+import util
 
-def get_project(project_name):
-    '''Try to find the project with the given name or id.'''
 
-    # First, see if the project is a project-id.
-    try:
-        project = dxpy.DXProject(project_name)
-        return project
-    except dxpy.DXError:
-        pass
+# The checksum is computed while the object is streamed, nothing is written
+# to disk. Objects larger than PARALLEL_THRESHOLD are fetched in ranges of
+# RANGE_SIZE bytes on several connections; the ranges are fed to the hash
+# in order, so at most [connections] ranges are held in memory.
+CHUNK_SIZE = 1024 * 1024
+RANGE_SIZE = 16 * 1024 * 1024
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+# servers do not like more than 16 connections from one client
+DEFAULT_CONNECTIONS = min(16, multiprocessing.cpu_count())
+TIMEOUT = 60
+
+
+def _is_transient(e):
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, OSError)
 
-    project = dxpy.find_projects(name=project_name, return_handler=True, level="VIEW")
-    project = [p for p in project]
-    if len(project) == 0:
-        print('Did not find project {0}'.format(project_name), file=sys.stderr)
+
+def _open(url, headers=None, method="GET"):
+    request = urllib.request.Request(url, headers=headers or {}, method=method)
+    return urllib.request.urlopen(request, timeout=TIMEOUT)
+
+
+# The response headers of [url], or None if it does not answer HEAD requests
+# (e.g. URLs presigned for GET only). Transient errors are retried.
+def _head(url):
+    def head():
+        with _open(url, method="HEAD") as response:
+            return response.headers
+    try:
+        return util.with_backoff(head, "fetching the headers of {}".format(url),
+                                 is_transient=_is_transient)
+    except urllib.error.HTTPError:
         return None
-    elif len(project) == 1:
-        return project[0]
-    else:
-        raise Exception('Found more than 1 project matching {0}'.format(project_name))
-
-
-def err_exit(msg):
-    print(msg)
-    exit(1)
-
-# Check if a program (wget, curl, etc.) is on the path, and
-# can be called.
-def _which(program):
-    def is_exe(fpath):
-        return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
-
-    for path in os.environ["PATH"].split(os.pathsep):
-        exe_file = os.path.join(path, program)
-        if is_exe(exe_file):
-            return exe_file
-    return None
-
-def download_and_calc_md5sum(url):
-    print("downloading {} and calculating checksum".format(url))
-    dest_filename = "/tmp/A"
-    if os.path.exists(dest_filename):
-        os.remove(dest_filename)
-
-    # Check if aria2 present
-    # Use that instead of wget
-    aria2c_exe = _which("aria2c")
-    if aria2c_exe is None:
-        wget_exe = _which("wget")
-        if wget_exe is None:
-            err_exit("wget is not installed on this system")
-
-        cmd = ["wget", "--tries=5", "--quiet"]
-        cmd += ["-O", dest_filename, url]
+
+
+def _stream_md5(url):
+    md5 = hashlib.md5()
+    size = 0
+    with _open(url) as response:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+            size += len(chunk)
+    return md5, size
+
+
+def _fetch_range(url, start, end):
+    with _open(url, {"Range": "bytes={}-{}".format(start, end)}) as response:
+        if response.status != 206:
+            raise Exception("{} does not support range requests".format(url))
+        data = response.read()
+    if len(data) != end - start + 1:
+        raise IOError("short read of bytes {}-{} of {}".format(start, end, url))
+    return data
+
+
+def _parallel_md5(url, size, connections):
+    md5 = hashlib.md5()
+    ranges = iter([(start, min(size, start + RANGE_SIZE) - 1) for start in range(0, size, RANGE_SIZE)])
+
+    def fetch(byte_range):
+        return util.with_backoff(lambda: _fetch_range(url, *byte_range),
+                                 "fetching bytes {}-{} of {}".format(byte_range[0], byte_range[1], url),
+                                 is_transient=_is_transient)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+        in_flight = collections.deque(executor.submit(fetch, r) for r in itertools.islice(ranges, connections))
+        while in_flight:
+            md5.update(in_flight.popleft().result())
+            byte_range = next(ranges, None)
+            if byte_range is not None:
+                in_flight.append(executor.submit(fetch, byte_range))
+    return md5
+
+
+# Hash the contents of [url], reporting the throughput
+def _hash_object(url, headers, connections):
+    print("calculating the checksum of {}".format(url))
+    start = time.time()
+    size = int(headers["Content-Length"]) if headers and headers.get("Content-Length") else None
+    accepts_ranges = headers is not None and headers.get("Accept-Ranges") == "bytes"
+    if size is not None and size > PARALLEL_THRESHOLD and accepts_ranges and connections > 1:
+        md5 = _parallel_md5(url, size, connections)
     else:
-        print("aria2c found in path so using that instead of wget \n")
-        # aria2c does not allow more than 16 connections per server
-        max_connections = min(16, multiprocessing.cpu_count())
-        cmd = ["aria2c", "--check-certificate=false", "-s", str(max_connections), "-x", str(max_connections)]
-        # Split path properly for aria2c
-        # If '-d' arg not provided, aria2c uses current working directory
-        cwd = os.getcwd()
-        directory, filename = os.path.split(dest_filename)
-        directory = cwd if directory in ["", cwd] else directory
-        cmd += ["-o", filename, "-d", os.path.abspath(directory), url]
+        md5, size = util.with_backoff(lambda: _stream_md5(url), "downloading {}".format(url),
+                                      is_transient=_is_transient)
+    elapsed = max(time.time() - start, 1e-6)
+    print("{}: {:.1f} MB in {:.1f} seconds ({:.1f} MB/s)".format(
+        url, size / 1e6, elapsed, size / 1e6 / elapsed))
+    return md5.hexdigest()
+
 
+def _base64_to_hex(value):
     try:
-        if aria2c_exe is not None:
-            print("Downloading symbolic link with aria2c")
+        digest = base64.b64decode(value.strip(), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return digest.hex() if len(digest) == 16 else None
+
+
+# The MD5 of an object as published by its store, and where it was found,
+# or (None, None). Only checksums that are the MD5 of the whole object are
+# trusted: Content-MD5 (S3 when set on upload, Azure), the md5 in GCS's
+# x-goog-hash, and the ETag of a single-part, unencrypted or SSE-S3, S3
+# object. Multipart ETags ("<hex>-<parts>") and SSE-KMS/SSE-C ETags are not
+# MD5s of the contents.
+def metadata_md5(headers):
+    if headers.get("Content-MD5"):
+        md5sum = _base64_to_hex(headers["Content-MD5"])
+        if md5sum is not None:
+            return md5sum, "Content-MD5 header"
+    for part in headers.get_all("x-goog-hash") or []:
+        for item in part.split(","):
+            key, _, value = item.strip().partition("=")
+            if key == "md5":
+                md5sum = _base64_to_hex(value)
+                if md5sum is not None:
+                    return md5sum, "x-goog-hash header"
+    is_s3 = headers.get("x-amz-request-id") is not None or headers.get("Server") == "AmazonS3"
+    etag = (headers.get("ETag") or "").strip().strip('"').lower()
+    encrypted = (headers.get("x-amz-server-side-encryption") == "aws:kms" or
+                 headers.get("x-amz-server-side-encryption-customer-algorithm") is not None)
+    if is_s3 and not encrypted and re.fullmatch(r"[0-9a-f]{32}", etag):
+        return etag, "single-part S3 ETag"
+    return None, None
+
+
+# The MD5 of the object at [url]. The checksum published by the store is
+# used when there is a trustworthy one (see metadata_md5), unless
+# [use_metadata] is False; otherwise the object is hashed. With
+# [verify_sample], that fraction of the published checksums is checked
+# against a real hash.
+def calc_md5sum(url, connections=DEFAULT_CONNECTIONS, use_metadata=True, verify_sample=0.0):
+    headers = _head(url)
+    if use_metadata and headers is not None:
+        md5sum, source = metadata_md5(headers)
+        if md5sum is not None:
+            if random.random() < verify_sample:
+                actual = _hash_object(url, headers, connections)
+                if actual != md5sum:
+                    raise Exception("the {} of {} is {}, but its contents hash to {}".format(
+                        source, url, md5sum, actual))
+                print("{}: verified the md5 from its {}".format(url, source))
+            else:
+                print("{}: using the md5 from its {}".format(url, source))
+            return md5sum
+    return _hash_object(url, headers, connections)
+
+
+# create a symlink on the platform, with the correct checksum. Returns its ID.
+def create_symlink(project_id, url, folder, name, md5sum):
+    input_params = {
+        'name' : name,
+        'project': project_id,
+        'drive': "drive-PUBLISHED",
+        'md5sum': md5sum,
+        'symlinkPath': {
+            'object': url
+        },
+        'folder' : folder,
+        'parents': True
+    }
+    # dxpy retries file/new itself, with a nonce, so that a retried call
+    # does not create a second file
+    result = dxpy.api.file_new(input_params=input_params)
+    return result["id"]
+
+
+# The entries of a manifest, as dictionaries with the keys url, folder, name
+# and md5 (None if not given). A manifest is either a JSON list of such
+# objects, or a TSV file with one "url [folder [name [md5]]]" entry per line.
+# The folder defaults to [default_folder], the name to the last part of the URL.
+def read_manifest(path, default_folder):
+    with open(path) as fd:
+        if path.endswith(".json"):
+            rows = json.load(fd)
         else:
-            print("Downloading symbolic link with wget")
-        subprocess.check_call(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        msg = ""
-        if e and e.output:
-            msg = e.output.strip()
-        err_exit("Failed to call download: {cmd}\n{msg}\n".format(cmd=str(cmd), msg=msg))
-
-    result = subprocess.run(["md5sum", "-b", dest_filename], stdout=subprocess.PIPE)
-    output=result.stdout.decode('utf-8')
-    os.remove(dest_filename)
-    return output.split()[0]
+            rows = []
+            for line in fd:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                rows.append(dict(zip(["url", "folder", "name", "md5"], fields)))
+    entries = []
+    for row in rows:
+        url = row["url"]
+        entries.append({
+            "url": url,
+            "folder": row.get("folder") or default_folder,
+            "name": row.get("name") or os.path.basename(url),
+            "md5": row.get("md5") or None
+        })
+    return entries
+
+
+def _entry_key(entry):
+    return (entry["url"], entry["folder"], entry["name"])
+
+
+# The entries of a manifest, keeping only the first one for each destination
+# (folder and name): the others would create more files with the same path
+def dedup_entries(entries):
+    first = {}
+    for entry in entries:
+        dest = (entry["folder"], entry["name"])
+        if dest not in first:
+            first[dest] = entry
+        elif entry["url"] != first[dest]["url"] or entry["md5"] != first[dest]["md5"]:
+            print("WARNING: skipping {}, {} {} is already the destination of {}".format(
+                entry["url"], entry["folder"], entry["name"], first[dest]["url"]))
+    return list(first.values())
+
+
+# The entries already registered by a previous run, from its results file
+def read_results(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path) as fd:
+            for line in fd:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run may be truncated
+                    continue
+                if result["status"] in ("created", "exists"):
+                    done.add(_entry_key(result))
+    return done
+
+
+# The md5 of the files in [folder], by name
+def _existing_files(project_id, folder):
+    existing = {}
+    try:
+        for result in dxpy.find_data_objects(classname="file", project=project_id, folder=folder,
+                                             recurse=False, describe={"fields": {"name": True, "md5": True}}):
+            existing.setdefault(result["describe"]["name"], set()).add(result["describe"].get("md5"))
+    except dxpy.exceptions.ResourceNotFound:
+        # the folder does not exist yet, it is created with the first file
+        pass
+    return existing
+
+
+def register_manifest(project_id, entries, results_path, jobs, connections,
+                      use_metadata=True, verify_sample=0.0):
+    entries = dedup_entries(entries)
+    done = read_results(results_path)
+    pending = [entry for entry in entries if _entry_key(entry) not in done]
+    print("{} entries, {} already registered".format(len(entries), len(entries) - len(pending)))
+    existing = dict((folder, _existing_files(project_id, folder))
+                    for folder in set(entry["folder"] for entry in pending))
+    lock = threading.Lock()
+
+    def register(entry):
+        result = dict(entry)
+        try:
+            names = existing[entry["folder"]]
+            if entry["md5"] is None or entry["md5"] not in names.get(entry["name"], set()):
+                md5sum = entry["md5"] or calc_md5sum(entry["url"], connections, use_metadata,
+                                                    verify_sample)
+                result["md5"] = md5sum
+            if result["md5"] in names.get(entry["name"], set()):
+                result["status"] = "exists"
+            else:
+                result["id"] = create_symlink(project_id, entry["url"], entry["folder"], entry["name"],
+                                              result["md5"])
+                result["status"] = "created"
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+        with lock:
+            results_fd.write(json.dumps(result) + "\n")
+            results_fd.flush()
+            print("{}: {} {}".format(result["status"], entry["folder"], entry["name"]))
+        return result
+
+    with open(results_path, "a") as results_fd:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(register, pending))
+    counts = collections.Counter(result["status"] for result in results)
+    print("created {}, already present {}, failed {}; results in {}".format(
+        counts["created"], counts["exists"], counts["failed"], results_path))
+    return counts["failed"] == 0
+
 
 def main():
     argparser = argparse.ArgumentParser(description="Create symbolic link")
     argparser.add_argument("--project", help="DNAnexus project")
     argparser.add_argument("--folder", help="folder in project")
     argparser.add_argument("--url", help="the url to reference")
+    argparser.add_argument("--manifest", help="Create a symlink for every entry of this TSV or JSON file")
+    argparser.add_argument("--results", help="Results file of --manifest, entries already registered in it "
+                           "are skipped (default: <manifest>.results.jsonl)")
+    argparser.add_argument("--jobs", help="Number of manifest entries registered concurrently",
+                           type=int, default=8)
+    argparser.add_argument("--connections", help="Number of connections used to fetch large objects",
+                           type=int, default=DEFAULT_CONNECTIONS)
+    argparser.add_argument("--no-metadata-md5", help="Always hash the objects, even when their store "
+                           "publishes their md5", action="store_true")
+    argparser.add_argument("--verify-sample", help="Fraction of the md5s taken from object metadata "
+                           "that are checked against a real hash (0 to 1)", type=float, default=0.0)
 
     args = argparser.parse_args()
     if args.project is None:
         print("Must provide project")
         exit(1)
-    if args.url is None:
-        print("Must provide url")
+    if args.url is None and args.manifest is None:
+        print("Must provide url or manifest")
         exit(1)
 
-    name = os.path.basename(args.url)
-    dx_proj = get_project(args.project)
+    dx_proj = util.get_project(args.project)
 
     folder = "/"
     if args.folder is not None:
         folder = args.folder
 
-    md5sum = download_and_calc_md5sum(args.url)
+    if args.manifest is not None:
+        entries = read_manifest(args.manifest, folder)
+        results_path = args.results or args.manifest + ".results.jsonl"
+        if not register_manifest(dx_proj.get_id(), entries, results_path, args.jobs, args.connections,
+                                 not args.no_metadata_md5, args.verify_sample):
+            exit(1)
+        return
 
-    # create a symlink on the platform, with the correct checksum
-    input_params = {
-        'name' : name,
-        'project': dx_proj.get_id(),
-        'drive': "drive-PUBLISHED",
-        'md5sum': md5sum,
-        'symlinkPath': {
-            'object': args.url
-        },
-        'folder' : folder
-    }
-
-    result = dxpy.api.file_new(input_params=input_params)
-    f = dxpy.DXFile(dxid = result["id"], project = dx_proj.get_id())
+    name = os.path.basename(args.url)
+    md5sum = calc_md5sum(args.url, args.connections, not args.no_metadata_md5, args.verify_sample)
+    file_id = create_symlink(dx_proj.get_id(), args.url, folder, name, md5sum)
+    f = dxpy.DXFile(dxid = file_id, project = dx_proj.get_id())
 
     desc = f.describe()
     print(desc)
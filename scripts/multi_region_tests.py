@@ -2,6 +2,7 @@
 from __future__ import print_function
 
 import argparse
+import concurrent.futures
 import dxpy
 import json
 import pprint
@@ -9,8 +10,8 @@ import os
 import time
 import sys
 import subprocess
+import exec_monitor
 import util
-from dxpy.exceptions import DXJobFailureError
 
 ######################################################################
 # multi-region test.
@@ -29,16 +30,30 @@ projects = ["dxCompiler",
 
 target_folder = "/release_test"
 
+class RegionRun(object):
+    """The compilation and execution of the test workflow in one project"""
+    def __init__(self, proj_name):
+        self.proj_name = proj_name
+        self.region = None
+        self.compile_time = None
+        self.analysis_id = None
+        self.state = None
+        self.queue_time = None
+        self.run_time = None
+        self.error = None
+
+
+# Wait for all the analyses together. Returns a dictionary from analysis ID
+# to its last description.
 def wait_for_completion(test_exec_objs):
     print("awaiting completion ...")
-    # wait for analysis to finish while working around Travis 10m console inactivity timeout
-    noise = subprocess.Popen(["/bin/bash", "-c", "while true; do sleep 60; date; done"])
-    try:
-        for exec_obj in test_exec_objs:
-            exec_obj.wait_on_done()
-    finally:
-        noise.kill()
+    # the progress reports keep the CI console alive, and include the
+    # created and modified times of the analyses
+    monitor = exec_monitor.ExecutionMonitor(test_exec_objs,
+                                            progress_interval=exec_monitor.DEFAULT_PROGRESS_INTERVAL)
+    descs = monitor.wait()
     print("done")
+    return descs
 
 # Run [workflow] on several inputs, return the analysis ID.
 def run_workflow(dx_proj, test_folder, oid):
@@ -56,9 +71,8 @@ def run_workflow(dx_proj, test_folder, oid):
 def build_test(source_file, dx_proj, folder, version_id):
     dx_proj.new_folder(folder, parents=True)
     print("Compiling {} to project {}:/{}".format(source_file, dx_proj.name, folder))
-    cmdline = [ "java", "-jar",
-                os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
-                "compile",
+    cmdline = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+    cmdline += [ "compile",
                 source_file,
                 "-force",
                 "-locked",
@@ -68,6 +82,40 @@ def build_test(source_file, dx_proj, folder, version_id):
     oid = subprocess.check_output(cmdline).strip()
     return oid
 
+# Compile the workflow in the project of [run], and start it right away
+# unless [compile_only]. Errors are recorded in [run].
+def compile_and_run(run, source_file, version_id, compile_only):
+    try:
+        dx_proj = util.get_live_project(run.proj_name)
+        if dx_proj is None:
+            raise RuntimeError("Could not find project {}".format(run.proj_name))
+        run.region = util.get_project_region(dx_proj.get_id())
+        start = time.time()
+        oid = build_test(source_file, dx_proj, target_folder, version_id)
+        run.compile_time = time.time() - start
+        if compile_only:
+            return
+        run.analysis_id = run_workflow(dx_proj, target_folder, oid).get_id()
+        print("{}: running {}".format(run.proj_name, run.analysis_id))
+    except Exception as e:
+        run.error = str(e)
+        print("{}: {}".format(run.proj_name, e), file=sys.stderr)
+
+
+def _seconds(value):
+    return "{:.0f}".format(value) if value is not None else "-"
+
+
+def print_summary(runs):
+    print("{:<22} {:<20} {:>10} {:>9} {:>7}  {}".format("project", "region", "compile(s)", "queue(s)",
+                                                        "run(s)", "status"))
+    for run in runs:
+        status = run.error or run.state or "compiled"
+        print("{:<22} {:<20} {:>10} {:>9} {:>7}  {}".format(run.proj_name, run.region or "-",
+                                                            _seconds(run.compile_time), _seconds(run.queue_time),
+                                                            _seconds(run.run_time), status))
+
+
 def main():
     argparser = argparse.ArgumentParser(description="Run compiler tests on the platform")
     argparser.add_argument("--compile-only", help="Only compile the workflows, don't run them",
@@ -76,24 +124,31 @@ def main():
 
     version_id = util.get_version_id(top_dir)
     wdl_source_file = os.path.join(test_dir, "multi_region/trivial.wdl")
-    dx_objects = []
-    test_exec_objs=[]
-
-    # build version of the applet on all regions
-    for proj_name in projects:
-        dx_proj = util.get_project(proj_name)
-        if dx_proj is None:
-            raise RuntimeError("Could not find project {}".format(proj_name))
-        oid = build_test(wdl_source_file, dx_proj, target_folder, version_id)
-        if args.compile_only:
-            continue
-        anl = run_workflow(dx_proj, target_folder, oid)
-        print("Running {}".format(oid))
-        test_exec_objs.append(anl)
+    # build version of the applet on all regions at once, each region
+    # starts its analysis as soon as its compilation is done
+    util.resolve_projects(projects)
+    runs = [RegionRun(proj_name) for proj_name in projects]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(runs)) as executor:
+        for _ in executor.map(lambda run: compile_and_run(run, wdl_source_file, version_id, args.compile_only),
+                              runs):
+            pass
 
     # Wait for completion
-    print("executables: " + ", ".join([a.get_id() for a in test_exec_objs]))
-    wait_for_completion(test_exec_objs)
+    started = [run for run in runs if run.analysis_id is not None]
+    if started:
+        print("executables: " + ", ".join(run.analysis_id for run in started))
+        descs = wait_for_completion([run.analysis_id for run in started])
+        for run in started:
+            desc = descs[run.analysis_id]
+            run.state = desc["state"]
+            run.queue_time, run.run_time = exec_monitor.execution_times(run.analysis_id, desc)
+            if run.state != "done":
+                run.error = "analysis {} {}".format(run.analysis_id, run.state)
+
+    print_summary(runs)
+    failed = [run.proj_name for run in runs if run.error]
+    if failed:
+        raise RuntimeError("multi-region test failed in: {}".format(", ".join(failed)))
 
 if __name__ == '__main__':
     main()
@@ -87,9 +87,7 @@ def compile(project, folder, version_id, proxy = None):
             os.environ["HTTP_PROXY_DOMAIN"] = "dnanexus.com"
         else:
             os.environ["HTTP_PROXY"] = "localhost:3128"
-    cmdline = [
-        "java", "-jar",
-        os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
+    cmdline = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id))) + [
         "compile",
         os.path.join(test_dir,"draft2","hello.wdl"),
         "-force",
@@ -1,24 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 from collections import namedtuple
+import concurrent.futures
 import dxpy
 import fnmatch
 import glob
 import hashlib
+import inspect
 import json
 import os
 import pprint
 import re
 import sys
 import subprocess
-import tempfile
 from typing import Callable, Iterator, Union, Optional, List
 from termcolor import colored, cprint
 import time
 import traceback
 import yaml
-from dxpy.exceptions import DXJobFailureError
 
+import change_impact
+import compile_cache
+import exec_monitor
+import file_summary
+import test_history
+import test_index
+import test_report
 import util
 
 here = os.path.dirname(sys.argv[0])
@@ -214,6 +221,11 @@ test_import_dirs = ["A"]
 TestMetaData = namedtuple('TestMetaData', ['name', 'kind'])
 TestDesc = namedtuple('TestDesc',
                       ['name', 'kind', 'source_file', 'raw_input', 'dx_input', 'results', 'extras'])
+# An execution launched by the test runner. input_index is the index of the
+# input file in the test's dx_input list, or None if it was run without inputs.
+# launch_time is the number of seconds it took to start it, including retries.
+ExecRecord = namedtuple('ExecRecord', ['exec_id', 'tname', 'input_index', 'kind', 'locked',
+                                       'launch_time'])
 
 ######################################################################
 # Read a JSON file
@@ -272,9 +284,8 @@ def get_cwl_metadata(filename, tname):
 
     raise RuntimeError("{} is not a valid CWL test".format(filename))
 
-# Register a test name, find its inputs and expected results files.
-def register_test(dir_path, tname, ext):
-    global test_files
+# Describe a test, find its inputs and expected results files.
+def describe_test(dir_path, tname, ext):
     if tname in test_suites.keys():
         raise RuntimeError("Test name {} is already used by a test-suite, it is reserved".format(tname))
     source_file = os.path.join(dir_path, tname + ext)
@@ -320,8 +331,11 @@ def register_test(dir_path, tname, ext):
     if os.path.exists(extras):
         desc = desc._replace(extras=extras)
 
-    test_files[tname] = desc
-    desc
+    return desc
+
+# The files, other than the source, that a test description is derived from
+def test_aux_files(desc):
+    return desc.raw_input + ([desc.extras] if desc.extras is not None else [])
 
 ######################################################################
 
@@ -332,27 +346,36 @@ def read_json_file_maybe_empty(path):
     else:
         return read_json_file(path)
 
-def find_test_from_exec(exec_obj):
-    dx_desc = exec_obj.describe()
-    exec_name = dx_desc["name"].split(' ')[0]
-    for tname, desc in test_files.items():
-        if desc.name == exec_name:
-            return tname
-    raise RuntimeError("Test for {} {} not found".format(exec_obj, exec_name))
-
-# Check that a workflow returned the expected result for
-# a [key]
-def validate_result(tname, exec_outputs, key, expected_val):
-    desc = test_files[tname]
-    # Extract the key. For example, for workflow "math" returning
-    # output "count":
-    #    'math.count' -> count
+# Extract the key. For example, for workflow "math" returning
+# output "count":
+#    'math.count' -> count
+# Returns the executable name, and the field name with dots and with
+# dots converted to ___
+def split_result_key(key):
     exec_name = key.split('.')[0]
     field_name_parts = key.split('.')[1:]
+    return exec_name, ".".join(field_name_parts), "___".join(field_name_parts)
+
+# The files among the outputs that validate_result reads: only outputs that
+# are a single file are compared by their contents, files nested in arrays
+# and maps are compared by their links
+def expected_result_files(exec_outputs, shouldbe):
+    links = []
+    for key in shouldbe.keys():
+        _, field_name1, field_name2 = split_result_key(key)
+        for field_name in (field_name1, field_name2):
+            if exec_outputs and field_name in exec_outputs:
+                result = exec_outputs[field_name]
+                if isinstance(result, dict) and "$dnanexus_link" in result:
+                    links.append(result)
+                break
+    return links
 
-    field_name1 = ".".join(field_name_parts)
-    # convert dots to ___
-    field_name2 = "___".join(field_name_parts)
+# Check that a workflow returned the expected result for
+# a [key]. Files are read through [file_cache], a FileSummaryCache.
+def validate_result(tname, exec_outputs, key, expected_val, file_cache):
+    desc = test_files[tname]
+    exec_name, field_name1, field_name2 = split_result_key(key)
     if exec_name != tname:
         raise RuntimeError("Key {} is invalid, must start with {} name".format(key, desc.kind))
     try:
@@ -368,33 +391,52 @@ def validate_result(tname, exec_outputs, key, expected_val):
         if isinstance(result, list) and isinstance(expected_val, list):
             result.sort()
             expected_val.sort()
+        summary = None
+        expects_file = isinstance(expected_val, dict) and expected_val.get("class") == "File"
         if isinstance(result, dict) and "$dnanexus_link" in result:
-            # the result is a file - download it and extract the contents
-            dlpath = os.path.join(tempfile.mkdtemp(), 'result.txt')
-            dxpy.download_dxfile(result["$dnanexus_link"], dlpath)
-            with open(dlpath, "r") as inp:
-                result = inp.read()
-        if isinstance(expected_val, dict) and expected_val.get("class") == "File":
+            # the result is a file - its size and digests are always known, its
+            # contents only up to MAX_CONTENTS_SIZE, which matters only if they
+            # are compared
+            summary = file_cache.get(result)
+            compares_contents = not expects_file or "contents" in expected_val
+            if compares_contents and not summary.contents_complete:
+                cprint("Analysis {} gave unexpected results".format(tname), "red")
+                cprint("Field {} is a file of {} bytes, which is too large to compare".format(
+                    field_name1, summary.size
+                ), "red")
+                return False
+            result = summary.contents.decode("utf-8", errors="replace")
+        if expects_file:
             contents = str(result).strip()
+            size = summary.size if summary is not None else len(contents.encode("utf-8"))
             # the result is a cwl File - match the contents, checksum, and/or size
-            if "contents" in result and len(contents) != result["size"]:
+            if "contents" in expected_val and contents != str(expected_val["contents"]).strip():
                 cprint("Analysis {} gave unexpected results".format(tname), "red")
                 cprint("Field {} should have contents ({}), actual = ({})".format(
-                    field_name1, result["contents"], contents
+                    field_name1, expected_val["contents"], contents
                 ), "red")
                 return False
-            if "size" in result and len(contents) != result["size"]:
+            if "size" in expected_val and size != expected_val["size"]:
                 cprint("Analysis {} gave unexpected results".format(tname), "red")
                 cprint("Field {} should have size ({}), actual = ({})".format(
-                    field_name1, result["size"], len(contents)
+                    field_name1, expected_val["size"], size
                 ), "red")
                 return False
-            if "checksum" in result:
-                algo, expected_digest = result["checksum"].split("$")
-                actual_digest = get_checksum(contents, algo)
-                if actual_digest not in (expected_digest, None):
+            if "checksum" in expected_val:
+                algo, expected_digest = expected_val["checksum"].split("$")
+                if summary is not None:
+                    actual_digest = summary.digests.get(algo)
+                elif algo in hashlib.algorithms_available:
+                    actual_digest = hashlib.new(algo, contents.encode("utf-8")).hexdigest()
+                else:
+                    actual_digest = None
+                if actual_digest is None:
+                    print("digest algorithm {} is not supported, not checking field {}".format(
+                        algo, field_name1
+                    ))
+                elif actual_digest != expected_digest:
                     cprint("Analysis {} gave unexpected results".format(tname), "red")
-                    cprint("Field {} should have size ({}), actual = ({})".format(
+                    cprint("Field {} should have checksum ({}), actual = ({})".format(
                         field_name1, expected_digest, actual_digest
                     ), "red")
                     return False
@@ -408,47 +450,36 @@ def validate_result(tname, exec_outputs, key, expected_val):
         return False
 
 
-def get_checksum(contents, algo):
-    try:
-        m = hashlib.new(algo)
-        m.update(contents)
-        return m.digest()
-    except:
-        println("python does not support digest algorithm {}".format(algo))
-        return None
-
-
-def lookup_dataobj(tname, project, folder):
-    desc = test_files[tname]
-    wfgen = dxpy.bindings.search.find_data_objects(classname= desc.kind,
-                                                   name= desc.name,
-                                                   folder= folder,
-                                                   project= project.get_id(),
-                                                   limit= 1)
-    objs = [item for item in wfgen]
-    if len(objs) > 0:
-        return objs[0]['id']
-    return None
-
 # Build a workflow.
 #
 # wf             workflow name
 # classpath      java classpath needed for running compilation
 # folder         destination folder on the platform
-def build_test(tname, project, folder, version_id, compiler_flags):
+# log            if not None, a list that collects the progress messages and the
+#                compiler's stderr, instead of printing them as they happen
+def build_test(tname, project, folder, version_id, compiler_flags, log=None):
     desc = test_files[tname]
-    print("build {} {}".format(desc.kind, desc.name))
-    print("Compiling {} to a {}".format(desc.source_file, desc.kind))
-    cmdline = [ "java", "-jar",
-                os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
-                "compile",
+    emit = print if log is None else log.append
+    emit("build {} {}".format(desc.kind, desc.name))
+    emit("Compiling {} to a {}".format(desc.source_file, desc.kind))
+    cmdline = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+    cmdline += [ "compile",
                 desc.source_file,
                 "-force",
                 "-folder", folder,
                 "-project", project.get_id() ]
     cmdline += compiler_flags
-    print(" ".join(cmdline))
-    oid = subprocess.check_output(cmdline).strip()
+    emit(" ".join(cmdline))
+    if log is None:
+        oid = subprocess.check_output(cmdline).strip()
+    else:
+        proc = subprocess.run(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = proc.stderr.decode("utf-8", errors="replace").rstrip()
+        if stderr:
+            log.append(stderr)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmdline, proc.stdout, proc.stderr)
+        oid = proc.stdout.strip()
     return oid.decode("ascii")
 
 def ensure_dir(path):
@@ -456,137 +487,240 @@ def ensure_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def wait_for_completion(test_exec_objs):
+# Wait for all the executions together, reporting each one as soon as it
+# completes. With fail_fast, the first unexpected failure terminates all
+# the executions that are still running.
+#
+# registry: dictionary from execution ID to ExecRecord
+def wait_for_completion(registry, fail_fast=False):
     print("awaiting completion ...")
     failures = []
-    for exec_obj in test_exec_objs:
-        tname = find_test_from_exec(exec_obj)
+
+    def is_expected_failure(exec_id, exec_desc):
+        return registry[exec_id].tname in test_failing
+
+    def on_complete(exec_id, exec_desc):
+        tname = registry[exec_id].tname
         desc = test_files[tname]
-        try:
-            exec_obj.wait_on_done()
+        if exec_desc["state"] == "done":
             print("Executable {} succeeded".format(desc.name))
-        except DXJobFailureError:
-            if tname in test_failing:
-                print("Executable {} failed as expected".format(desc.name))
-            else:
-                cprint("Error: executable {} failed".format(desc.name), "red")
-                failures.append(tname)
+        elif tname in test_failing:
+            print("Executable {} failed as expected".format(desc.name))
+        else:
+            cprint("Error: executable {} {}".format(desc.name, exec_desc["state"]), "red")
+            failures.append(tname)
+
+    monitor = exec_monitor.ExecutionMonitor(registry.keys(),
+                                            on_complete=on_complete,
+                                            is_expected_failure=is_expected_failure,
+                                            fail_fast=fail_fast,
+                                            progress_interval=exec_monitor.DEFAULT_PROGRESS_INTERVAL)
+    monitor.wait()
+    if monitor.aborted:
+        raise RuntimeError("Failed: {}; the remaining executions were terminated".format(
+            ", ".join(failures)
+        ))
     print("tools execution completed")
     return failures
 
-# Run [workflow] on several inputs, return the analysis ID.
-def run_executable(project, test_folder, tname, oid, debug_flag, delay_workspace_destruction):
+# A handler for the executable [oid] of test [tname]
+def executable_handler(project, tname, oid):
     desc = test_files[tname]
-
-    def once(i):
-        try:
-            if tname in test_defaults:
-                inputs = {}
-            elif i < 0:
-                inputs = {}
-            else:
-                inputs = read_json_file(desc.dx_input[i])
-            project.new_folder(test_folder, parents=True)
-            if desc.kind == "workflow":
-                exec_obj = dxpy.DXWorkflow(project=project.get_id(), dxid=oid)
-            elif desc.kind == "applet":
-                exec_obj = dxpy.DXApplet(project=project.get_id(), dxid=oid)
-            else:
-                raise RuntimeError("Unknown kind {}".format(desc.kind))
-
-            run_kwargs = {}
-            if debug_flag:
-                run_kwargs = {
-                    "debug": {"debugOn": ['AppError', 'AppInternalError', 'ExecutionError'] },
-                    "allow_ssh" : [ "*" ]
-                }
-            if delay_workspace_destruction:
-                run_kwargs["delay_workspace_destruction"] = True
-
-            return exec_obj.run(inputs,
-                                project=project.get_id(),
-                                folder=test_folder,
-                                name="{} {}".format(desc.name, git_revision),
-                                instance_type="mem1_ssd1_x4",
-                                **run_kwargs)
-        except Exception as e:
-            print("exception message={}".format(e))
-            return None
-
-    def run(i):
-        for _ in range(1,5):
-            retval = once(i)
-            if retval is not None:
-                return retval
-            print("Sleeping for 5 seconds before trying again")
-            time.sleep(5)
-        else:
-            raise RuntimeError("running workflow")
-
-    n = len(desc.dx_input)
-    if n == 0:
-        return [run(-1)]
+    if desc.kind == "workflow":
+        return dxpy.DXWorkflow(project=project.get_id(), dxid=oid)
+    elif desc.kind == "applet":
+        return dxpy.DXApplet(project=project.get_id(), dxid=oid)
     else:
-        return [run(i) for i in range(n)]
+        raise RuntimeError("Unknown kind {}".format(desc.kind))
 
 
-def extract_outputs(tname, exec_obj):
+# Launch test [tname] (executable handler [exec_obj]) on its input file
+# number [i], or without inputs if [i] is None. Return an ExecRecord.
+def run_executable(project, test_folder, tname, exec_obj, i, run_kwargs):
     desc = test_files[tname]
-    if desc.kind == "workflow":
-        locked = tname not in test_unlocked
-        if locked:
-            return exec_obj['output']
+    if tname in test_defaults or i is None:
+        inputs = {}
+    else:
+        inputs = read_json_file(desc.dx_input[i])
+
+    start = time.time()
+    exec_handler = util.with_backoff(
+        lambda: exec_obj.run(inputs,
+                             project=project.get_id(),
+                             folder=test_folder,
+                             name="{} {}".format(desc.name, git_revision),
+                             instance_type="mem1_ssd1_x4",
+                             **run_kwargs),
+        "running {} on input {}".format(tname, i)
+    )
+    return ExecRecord(exec_id=exec_handler.get_id(),
+                      tname=tname,
+                      input_index=i,
+                      kind=desc.kind,
+                      locked=(tname not in test_unlocked),
+                      launch_time=time.time() - start)
+
+
+# Launch all the [runnable] tests, once for each of their inputs, with up to
+# [launch_jobs] launches at a time. Returns a registry: a dictionary from
+# execution ID to ExecRecord, in the order of [runnable].
+def launch_tests(project, runnable, test_folder, debug_flag, delay_workspace_destruction, launch_jobs=8):
+    run_kwargs = {}
+    if debug_flag:
+        run_kwargs = {
+            "debug": {"debugOn": ['AppError', 'AppInternalError', 'ExecutionError'] },
+            "allow_ssh" : [ "*" ]
+        }
+    if delay_workspace_destruction:
+        run_kwargs["delay_workspace_destruction"] = True
+
+    project.new_folder(test_folder, parents=True)
+    launches = []
+    for tname, oid in runnable.items():
+        desc = test_files[tname]
+        print("Running {} {} {}".format(desc.kind, desc.name, oid))
+        # one handler per test, shared by the launches on all its inputs
+        exec_obj = executable_handler(project, tname, oid)
+        n = len(desc.dx_input)
+        launches += [(tname, exec_obj, i) for i in (range(n) if n > 0 else [None])]
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, launch_jobs)) as executor:
+        futures = [
+            executor.submit(run_executable, project, test_folder, tname, exec_obj, i, run_kwargs)
+            for tname, exec_obj, i in launches
+        ]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+    elapsed = time.time() - start
+    print("Launched {} executions in {:.1f} seconds ({:.1f} per second)".format(
+        len(launches), elapsed, len(launches) / max(elapsed, 1e-3)))
+    return dict((record.exec_id, record) for record in (f.result() for f in futures))
+
+
+def extract_outputs(record, exec_desc):
+    if record.kind == "workflow":
+        if record.locked:
+            return exec_desc['output']
         else:
-            stages = exec_obj['stages']
+            stages = exec_desc['stages']
             for snum in range(len(stages)):
                 crnt = stages[snum]
                 if crnt['id'] == 'stage-outputs':
                     return stages[snum]['execution']['output']
-            raise RuntimeError("Analysis for test {} does not have stage 'outputs'".format(tname))
-    elif desc.kind == "applet":
-        return exec_obj['output']
+            raise RuntimeError("Analysis for test {} does not have stage 'outputs'".format(record.tname))
+    elif record.kind == "applet":
+        return exec_desc['output']
     else:
-        raise RuntimeError("Unknown kind {}".format(desc.kind))
+        raise RuntimeError("Unknown kind {}".format(record.kind))
+
+# Add the outcome, timings, instance type and output size of the
+# executions to the report
+def record_executions(report, registry, exec_descs):
+    output_links = {}
+    for exec_id, record in registry.items():
+        exec_desc = exec_descs[exec_id]
+        if exec_desc["state"] == "done":
+            try:
+                output_links[exec_id] = file_summary.find_links(extract_outputs(record, exec_desc))
+            except (KeyError, RuntimeError):
+                pass
+    sizes = file_summary.file_sizes(link for links in output_links.values() for link in links)
+    # the run time of an analysis is measured on its jobs, which are listed
+    # with one call per analysis
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        times = dict(zip(registry.keys(), executor.map(
+            lambda exec_id: exec_monitor.execution_times(exec_id, exec_descs[exec_id]), registry.keys())))
+    for exec_id, record in registry.items():
+        exec_desc = exec_descs[exec_id]
+        queue_time, run_time = times[exec_id]
+        output_size = None
+        if exec_id in output_links:
+            file_ids = set(file_summary.parse_link(link)[0] for link in output_links[exec_id])
+            output_size = sum(sizes.get(file_id, 0) for file_id in file_ids)
+        report.record_execution(record.tname,
+                                record.input_index,
+                                exec_id,
+                                exec_desc["state"],
+                                exec_desc["state"] == "done" or record.tname in test_failing,
+                                run_time,
+                                queue_time,
+                                record.launch_time,
+                                exec_desc.get("instanceType"),
+                                output_size)
+
+# Check the outputs of the finished executions in [registry] against the
+# expected results. Returns the names of the executions with wrong outputs.
+def verify_executions(registry, exec_descs, verify_jobs=8, report=None):
+    # the outputs and expected results of the executions to verify
+    to_verify = []
+    for exec_id, record in registry.items():
+        exec_desc = exec_descs[exec_id]
+        if record.tname in test_failing or exec_desc["state"] != "done":
+            # failed executions have already been reported
+            continue
+        i = record.input_index
+        if i is None or len(test_files[record.tname].results) <= i:
+            continue
+        exec_outputs = extract_outputs(record, exec_desc)
+        shouldbe = read_json_file_maybe_empty(test_files[record.tname].results[i])
+        to_verify.append((record, exec_outputs, shouldbe))
+
+    def verify_test(record, exec_outputs, shouldbe, file_cache):
+        tname = record.tname
+        i = record.input_index
+        correct = True
+        print("Checking results for workflow {} job {}".format(test_files[tname].name, i))
+        for key, expected_val in shouldbe.items():
+            # check all the keys, so that every mismatch is reported
+            if not validate_result(tname, exec_outputs, key, expected_val, file_cache):
+                correct = False
+        anl_name = "{}.{}".format(tname, i)
+        if correct:
+            print("Analysis {} passed".format(anl_name))
+            return None
+        else:
+            return anl_name
 
-def run_test_subset(project, runnable, test_folder, debug_flag, delay_workspace_destruction):
-    # Run the workflows
-    test_exec_objs=[]
-    for tname, oid in runnable.items():
-        desc = test_files[tname]
-        print("Running {} {} {}".format(desc.kind, desc.name, oid))
-        anl = run_executable(project, test_folder, tname, oid, debug_flag, delay_workspace_destruction)
-        test_exec_objs.extend(anl)
-    print("executables: " + ", ".join([a.get_id() for a in test_exec_objs]))
+    failed_verification = []
+    file_cache = file_summary.FileSummaryCache(max_workers=verify_jobs)
+    try:
+        # start reading all the output files that need to be checked
+        for record, exec_outputs, shouldbe in to_verify:
+            file_cache.prefetch(expected_result_files(exec_outputs, shouldbe))
+        for record, exec_outputs, shouldbe in to_verify:
+            start = time.time()
+            failed_name = verify_test(record, exec_outputs, shouldbe, file_cache)
+            if report is not None:
+                report.record_verification(record.tname, record.exec_id, failed_name is None,
+                                           time.time() - start)
+            if failed_name is not None:
+                failed_verification.append(failed_name)
+    finally:
+        file_cache.close()
+    return failed_verification
+
+def run_test_subset(project, runnable, test_folder, debug_flag, delay_workspace_destruction,
+                    fail_fast=False, verify_jobs=8, report=None, launch_jobs=8):
+    # Run the workflows, and record what each execution is testing
+    registry = launch_tests(project, runnable, test_folder, debug_flag, delay_workspace_destruction,
+                            launch_jobs)
+    print("executables: " + ", ".join(registry.keys()))
 
     # Wait for completion
-    failed_execution = wait_for_completion(test_exec_objs)
+    failed_execution = wait_for_completion(registry, fail_fast)
 
     print("Verifying results")
-    def verify_test(exec_obj, i):
-        exec_desc = exec_obj.describe()
-        tname = find_test_from_exec(exec_obj)
-        if tname in test_failing:
-            return None
-        test_desc = test_files[tname]
-        exec_outputs = extract_outputs(tname, exec_desc)
-        if len(test_desc.results) > i:
-            shouldbe = read_json_file_maybe_empty(test_desc.results[i])
-            correct = True
-            print("Checking results for workflow {} job {}".format(test_desc.name, i))
-            for key, expected_val in shouldbe.items():
-                correct = validate_result(tname, exec_outputs, key, expected_val)
-            anl_name = "{}.{}".format(tname, i)
-            if correct:
-                print("Analysis {} passed".format(anl_name))
-                return None
-            else:
-                return anl_name
-
-    failed_verification = []
-    for i, exec_obj in enumerate(test_exec_objs):
-        failed_name = verify_test(exec_obj, i)
-        if failed_name is not None:
-            failed_verification.append(failed_name)
+    # the final descriptions, including the outputs
+    exec_descs = exec_monitor.describe_executions(registry.keys())
+    if report is not None:
+        record_executions(report, registry, exec_descs)
+    failed_verification = verify_executions(registry, exec_descs, verify_jobs, report)
 
     if failed_execution or failed_verification:
         all_failures = failed_execution + failed_verification
@@ -597,7 +731,7 @@ def run_test_subset(project, runnable, test_folder, debug_flag, delay_workspace_
         if failed_verification:
             fveri = '\n'.join(failed_verification)
             print(f"Tools failed results verification: {len(failed_verification)}:\n{fveri}")
-        raise RuntimeError("Failed")
+        raise RuntimeError("{} executions failed".format(len(all_failures)))
 
 def print_test_list():
     l = [key for key in test_files.keys()]
@@ -622,24 +756,86 @@ def choose_tests(name):
         raise RuntimeError("Test prefix {} is unknown".format(name))
     return matches
 
-# Find all the WDL test files, these are located in the 'test'
-# directory. A test file must have some support files.
-def register_all_tests(verbose : bool) -> None :
-    for root, dirs, files in os.walk(test_dir):
-        for t_file in files:
-            if t_file.endswith(".wdl") or t_file.endswith(".cwl"):
-                base = os.path.basename(t_file)
-                (fname, ext) = os.path.splitext(base)
-                if fname.startswith("library_"):
-                    continue
-                if fname.endswith("_extern"):
-                    continue
-                try:
-                    register_test(root, fname, ext)
-                except Exception as e:
-                    if verbose:
-                        print("Skipping WDL file {} error={}".format(fname, e))
-
+def is_test_source(t_file):
+    if not (t_file.endswith(".wdl") or t_file.endswith(".cwl")):
+        return False
+    fname = os.path.splitext(t_file)[0]
+    return not (fname.startswith("library_") or fname.endswith("_extern"))
+
+# Keep only the tests that are affected by the changes since git revision [ref],
+# and explain why each one was selected
+def select_affected_tests(test_names, ref):
+    changed = change_impact.changed_files(top_dir, ref)
+    selected = change_impact.select_affected(top_dir, test_names, test_files,
+                                             test_import_paths, changed)
+    print("{} of {} tests are affected by {} changed files since {}".format(
+        len(selected), len(set(test_names)), len(changed), ref
+    ))
+    for tname, reasons in selected:
+        print("  {}: {}".format(tname, "; ".join(reasons)))
+    return [tname for tname, _ in selected]
+
+# Fail if the compile or execution time of a test regressed compared to a
+# baseline results file
+def check_performance(report, baseline_path, max_slowdown,
+                      min_seconds=test_report.DEFAULT_MIN_REGRESSION_SECONDS):
+    baseline = test_report.TestReport.load(baseline_path)
+    regressions = test_report.find_regressions(report, baseline, max_slowdown, min_seconds)
+    if not regressions:
+        print("No performance regressions above {:.0%} (and {}s) compared to {}".format(
+            max_slowdown, min_seconds, baseline_path))
+        return
+    print("-----------------------------")
+    print("Performance regressions above {:.0%} (and {}s) compared to {}:".format(
+        max_slowdown, min_seconds, baseline_path))
+    for tname, phase, before, after in regressions:
+        change = "{:+.0%}".format((after - before) / before) if before > 0 else "new"
+        print("  {} {}: {:.1f}s -> {:.1f}s ({})".format(tname, phase, before, after, change))
+    raise RuntimeError("{} performance regressions".format(len(regressions)))
+
+# Parse a shard specification i/N
+def parse_shard(spec):
+    m = re.match(r"^(\d+)/(\d+)$", spec)
+    if m is None:
+        raise RuntimeError("Invalid shard {}, expected i/N".format(spec))
+    index, count = int(m.group(1)), int(m.group(2))
+    if not 1 <= index <= count:
+        raise RuntimeError("Invalid shard {}, i must be between 1 and N".format(spec))
+    return index, count
+
+# Find all the WDL and CWL test files, these are located in the 'test'
+# directory. A test file must have some support files. The tests are
+# kept in an on-disk index, and are only parsed when they are looked up
+# and have changed since they were indexed.
+def register_all_tests(verbose : bool, index_path : Optional[str] = None) -> None :
+    global test_files
+    test_files = test_index.TestIndex(test_dir,
+                                      describe_test,
+                                      TestDesc,
+                                      is_test_source,
+                                      test_aux_files,
+                                      index_path=index_path,
+                                      verbose=verbose,
+                                      key=test_index_key())
+
+# A hash of the code that test descriptions are derived from, and of the
+# suite names (which cannot be test names), so that the index is rebuilt
+# when they change
+def test_index_key():
+    h = hashlib.sha1()
+    for fn in (describe_test, get_wdl_metadata, get_cwl_metadata, verify_json_file, is_test_source,
+               test_aux_files):
+        h.update(inspect.getsource(fn).encode("utf-8"))
+    h.update(json.dumps([list(TestDesc._fields), sorted(test_suites.keys())]).encode("utf-8"))
+    return h.hexdigest()
+
+
+# Directories to search for imported files, in addition to the directory of
+# the test itself
+def test_import_paths(tname):
+    if tname in test_import_dirs:
+        return [os.path.join(top_dir, "test/imports/lib")]
+    return []
 
 # Some compiler flags are test specific
 def compiler_per_test_flags(tname):
@@ -660,8 +856,8 @@ def compiler_per_test_flags(tname):
             flags.append(i)
     if desc.extras is not None:
         flags += ["--extras", os.path.join(top_dir, desc.extras)]
-    if tname in test_import_dirs:
-        flags += ["--imports", os.path.join(top_dir, "test/imports/lib")]
+    for path in test_import_paths(tname):
+        flags += ["--imports", path]
     return flags
 
 # Which project to use for a test
@@ -671,9 +867,8 @@ def compiler_per_test_flags(tname):
 
 def native_call_dxni(project, applet_folder, version_id, verbose: bool):
     # build WDL wrapper tasks in test/dx_extern.wdl
-    cmdline_common = [ "java", "-jar",
-                       os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
-                       "dxni",
+    cmdline_common = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+    cmdline_common += [ "dxni",
                        "-force",
                        "-folder", applet_folder,
                        "-project", project.get_id()]
@@ -694,10 +889,7 @@ def native_call_dxni(project, applet_folder, version_id, verbose: bool):
 
 def dxni_call_with_path(project, path, version_id, verbose):
     # build WDL wrapper tasks in test/dx_extern.wdl
-    cmdline = [
-        "java",
-        "-jar",
-        os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
+    cmdline = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id))) + [
         "dxni",
         "-force",
         "-path",
@@ -763,9 +955,8 @@ def native_call_app_setup(project, version_id, verbose):
 
     # build WDL wrapper tasks in test/dx_extern.wdl
     header_file = os.path.join(top_dir, "test/wdl_1_0/dx_app_extern.wdl")
-    cmdline = [ "java", "-jar",
-                os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)),
-                "dxni",
+    cmdline = util.java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+    cmdline += [ "dxni",
                 "-apps",
                 "only",
                 "-force",
@@ -786,31 +977,131 @@ def native_call_app_setup(project, version_id, verbose):
 # Compile the WDL files to dx:workflows and dx:applets
 # delay_compile_errors: whether to aggregate all compilation errors
 #   and only raise an Exception after trying to compile all the tests
+# compile_jobs: maximal number of compiler processes to run concurrently.
+#   With more than one job, the output of each compilation is captured
+#   and printed as one block when that compilation finishes.
+# compile_batch: compile all the tests with a single compiler process
+# report: if not None, a TestReport in which to record the compilations
+# asset_ids: the runtime assets the executables link to, part of the cache key
 def compile_tests_to_project(trg_proj,
                              test_names,
                              applet_folder,
                              compiler_flags,
                              version_id,
                              lazy_flag,
-                             delay_compile_errors=False):
-    runnable = {}
+                             delay_compile_errors=False,
+                             compile_jobs=1,
+                             compile_batch=False,
+                             report=None,
+                             asset_ids=()):
+    # the same test may be selected by more than one --test argument
+    c_flags = dict((tname, compiler_flags[:] + compiler_per_test_flags(tname))
+                   for tname in test_names)
+    oids = {}
+    cache = None
+    cache_keys = {}
+    if lazy_flag:
+        # reuse the executables of tests whose sources and flags have not changed
+        cache = compile_cache.CompileCache()
+        destination = ["-folder", applet_folder, "-project", trg_proj.get_id()]
+        # the jar may be rebuilt, and the assets replaced, without a new version
+        compiler_fingerprint = util.read_fingerprint(
+            os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+        for tname, flags in c_flags.items():
+            cache_keys[tname] = cache.key(test_files[tname].source_file,
+                                          flags + destination,
+                                          version_id,
+                                          test_import_paths(tname),
+                                          compiler_fingerprint,
+                                          asset_ids)
+        oids = cache.lookup_all(cache_keys, trg_proj.get_id(), applet_folder)
+        for tname, oid in oids.items():
+            if report is not None:
+                report.record_compile(tname, True, None)
+            print("runnable({}) = {} (cached)".format(tname, oid))
+    to_compile = [tname for tname in c_flags.keys() if tname not in oids]
+
+    def timed_build(tname, log=None):
+        start = time.time()
+        oid = build_test(tname, trg_proj, applet_folder, version_id, c_flags[tname], log)
+        return oid, time.time() - start
+
+    def compiled(tname, oid, seconds=None):
+        oids[tname] = oid
+        if cache is not None and oid is not None:
+            cache.put(cache_keys[tname], oid, test_files[tname].source_file)
+        if report is not None:
+            report.record_compile(tname, oid is not None, seconds)
+        print("runnable({}) = {}".format(tname, oid))
+
     has_errors = False
-    for tname in test_names:
-        oid = None
-        if lazy_flag:
-            oid = lookup_dataobj(tname, trg_proj, applet_folder)
-        if oid is None:
-            c_flags = compiler_flags[:] + compiler_per_test_flags(tname)
-            try:
-                oid = build_test(tname, trg_proj, applet_folder, version_id, c_flags)
-            except subprocess.CalledProcessError:
-                if delay_compile_errors:
-                    traceback.print_exc()
-                    has_errors = True
+    try:
+        if compile_batch:
+            entries = [
+                {
+                    "source": test_files[tname].source_file,
+                    "flags": ["-force"] + c_flags[tname],
+                    "folder": applet_folder,
+                    "project": trg_proj.get_id()
+                }
+                for tname in to_compile
+            ]
+            print("Compiling {} tests in a single batch".format(len(entries)))
+            results = util.compile_batch(top_dir, version_id, entries) if entries else []
+            for tname, result in zip(to_compile, results):
+                if result["status"] == "success":
+                    compiled(tname, result["result"].strip(), result.get("seconds"))
                 else:
+                    print("Error compiling {}:\n{}".format(tname, result["error"]))
+                    if not delay_compile_errors:
+                        raise RuntimeError("failed to compile test {}".format(tname))
+                    has_errors = True
+                    compiled(tname, None, result.get("seconds"))
+        elif compile_jobs <= 1:
+            for tname in to_compile:
+                oid, seconds = None, None
+                try:
+                    oid, seconds = timed_build(tname)
+                except subprocess.CalledProcessError:
+                    if delay_compile_errors:
+                        traceback.print_exc()
+                        has_errors = True
+                    else:
+                        raise
+                compiled(tname, oid, seconds)
+        else:
+            print("Compiling {} tests with {} concurrent jobs".format(len(to_compile), compile_jobs))
+            logs = dict((tname, []) for tname in to_compile)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=compile_jobs) as executor:
+                futures = dict(
+                    (executor.submit(timed_build, tname, logs[tname]), tname)
+                    for tname in to_compile
+                )
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        tname = futures[future]
+                        print("==== compile {} ====".format(tname))
+                        print("\n".join(logs[tname]))
+                        oid, seconds = None, None
+                        try:
+                            oid, seconds = future.result()
+                        except subprocess.CalledProcessError as e:
+                            if not delay_compile_errors:
+                                raise
+                            traceback.print_exception(type(e), e, e.__traceback__)
+                            has_errors = True
+                        compiled(tname, oid, seconds)
+                except BaseException:
+                    # do not start compiling any test that is still waiting for a worker
+                    for future in futures:
+                        future.cancel()
                     raise
-        runnable[tname] = oid
-        print("runnable({}) = {}".format(tname, oid))
+    finally:
+        if cache is not None:
+            cache.save()
+
+    # keep the order in which the tests were requested
+    runnable = dict((tname, oids[tname]) for tname in test_names)
     if has_errors:
         raise RuntimeError("failed to compile one or more tests")
     return runnable
@@ -821,59 +1112,135 @@ def compile_tests_to_project(trg_proj,
 def main():
     global test_unlocked
     argparser = argparse.ArgumentParser(description="Run WDL compiler tests on the platform")
+    argparser.add_argument("--affected-since",
+                           help="Only run the selected tests (by default, the L suite) that are affected "
+                                "by the changes since this git revision")
     argparser.add_argument("--archive", help="Archive old applets",
                            action="store_true", default=False)
     argparser.add_argument("--compile-only", help="Only compile the workflows, don't run them",
                            action="store_true", default=False)
     argparser.add_argument("--compile-mode", help="Compilation mode")
+    argparser.add_argument("--compile-jobs", help="Number of tests to compile concurrently",
+                           type=int, default=1)
+    argparser.add_argument("--compile-batch", help="Compile all tests with a single compiler process",
+                           action="store_true", default=False)
     argparser.add_argument("--debug", help="Run applets with debug-hold, and allow ssh",
                            action="store_true", default=False)
     argparser.add_argument("--delay-workspace-destruction", help="Run applets with delayWorkspaceDestruction",
                            action="store_true", default=False)
     argparser.add_argument("--force", help="Remove old versions of applets and workflows",
                            action="store_true", default=False)
+    argparser.add_argument("--fail-fast", help="Terminate all executions on the first unexpected failure",
+                           action="store_true", default=False)
     argparser.add_argument("--folder", help="Use an existing folder, instead of building dxCompiler")
-    argparser.add_argument("--lazy", help="Only compile workflows that are unbuilt",
+    argparser.add_argument("--history", help="Print the slowest tests in the local timing history, and exit",
+                           action="store_true", default=False)
+    argparser.add_argument("--history-db", help="The local timing history database")
+    argparser.add_argument("--lazy", help="Only compile workflows whose sources, imports or flags changed",
                            action="store_true", default=False)
+    argparser.add_argument("--launch-jobs", help="Number of executions to launch concurrently",
+                           type=int, default=8)
     argparser.add_argument("--list", "--test-list", help="Print a list of available tests",
                            action="store_true",
                            dest="test_list",
                            default=False)
+    argparser.add_argument("--baseline",
+                           help="A results file of a previous run. Fail if a test's compile or execution "
+                                "time regressed by more than --max-slowdown")
     argparser.add_argument("--clean", help="Remove build directory in the project after running tests",
                            action="store_true", default=False)
     argparser.add_argument("--delay-compile-errors", help="Compile all tests before failing on any errors",
                            action="store_true", default=False)
+    argparser.add_argument("--junit-xml", help="Write the results of the tests to this JUnit XML file")
+    argparser.add_argument("--max-slowdown", help="The slowdown allowed with --baseline, e.g. 20%%",
+                           default="20%")
+    argparser.add_argument("--min-slowdown-seconds",
+                           help="With --baseline, times that grew by less than this many seconds are not "
+                                "regressions, whatever --max-slowdown (default: %(default)s)",
+                           type=float, default=test_report.DEFAULT_MIN_REGRESSION_SECONDS)
+    argparser.add_argument("--merge-results", help="Merge the result files of several shards, and exit",
+                           nargs="+", metavar="RESULTS_FILE")
     argparser.add_argument("--locked", help="Generate locked-down workflows",
                            action="store_true", default=False)
+    argparser.add_argument("--no-history", help="Do not use or record the local timing history",
+                           action="store_true", default=False)
     argparser.add_argument("--project", help="DNAnexus project ID",
                            default="dxCompiler_playground")
     argparser.add_argument("--project-wide-reuse", help="look for existing applets in the entire project",
                            action="store_true", default=False)
     argparser.add_argument("--stream-all-files", help="Stream all input files with dxfs2",
                            action="store_true", default=False)
+    argparser.add_argument("--results-file", help="Write the results and timings of the tests to this JSON file")
     argparser.add_argument("--runtime-debug-level",
                            help="printing verbosity of task/workflow runner, {0,1,2}")
+    argparser.add_argument("--shard",
+                           help="Run only shard i of N of the selected tests, given as i/N. Shards are "
+                                "balanced by the timings in --timings, or dealt round-robin")
+    argparser.add_argument("--timings", help="A results file of a previous run, used to balance shards; "
+                                             "all the shards must be given the same file")
     argparser.add_argument("--test", help="Run a test, or a subgroup of tests",
                            action="append", default=[])
     argparser.add_argument("--unlocked", help="Generate only unlocked workflows",
                            action="store_true", default=False)
     argparser.add_argument("--verbose", help="Verbose compilation",
                            action="store_true", default=False)
+    argparser.add_argument("--verify-jobs", help="Number of output files to read concurrently when verifying results",
+                           type=int, default=8)
     argparser.add_argument("--verbose-key", help="Verbose compilation",
                            action="append", default=[])
     args = argparser.parse_args()
 
     print("top_dir={} test_dir={}".format(top_dir, test_dir))
+    max_slowdown = test_report.parse_slowdown(args.max_slowdown)
+
+    history_db = args.history_db or test_history.default_history_path(top_dir)
+    if args.history:
+        history = test_history.TestHistory(history_db)
+        history.print_report()
+        history.close()
+        exit(0)
+
+    if args.merge_results:
+        merged = test_report.TestReport.merge(
+            [test_report.TestReport.load(path) for path in args.merge_results]
+        )
+        if args.results_file:
+            merged.save(args.results_file)
+        merged.print_summary()
+        exit(1 if merged.failures() else 0)
 
     register_all_tests(args.verbose)
     if args.test_list:
         print_test_list()
+        test_files.save()
         exit(0)
     test_names = []
     if len(args.test) == 0:
-        args.test = 'M'
+        args.test = ['L'] if args.affected_since else ['M']
     for t in args.test:
         test_names += choose_tests(t)
+    if args.affected_since:
+        test_names = select_affected_tests(test_names, args.affected_since)
+    shard_suffix = ""
+    if args.shard:
+        shard_index, shard_count = parse_shard(args.shard)
+        # all the shards must compute the same partition, so the tests are only
+        # balanced from a timings file they share, not from the local history
+        durations = None
+        if args.timings:
+            durations = test_report.TestReport.load(args.timings).durations()
+        test_names = test_report.shard_tests(test_names, shard_index, shard_count, durations)
+        shard_suffix = "/shard_{}_of_{}".format(shard_index, shard_count)
+        print("Shard {}: {} tests".format(args.shard, len(test_names)))
+    test_files.save()
+    if len(test_names) == 0:
+        print("No tests to run")
+        exit(0)
+    if not args.no_history:
+        # launch the tests that took longest in past runs first
+        history = test_history.TestHistory(history_db)
+        test_names = history.longest_first(test_names)
+        history.close()
     print("Running tests {}".format(test_names))
     version_id = util.get_version_id(top_dir)
 
@@ -886,8 +1253,9 @@ def main():
         # Use existing prebuilt base folder
         base_folder = args.folder
         util.create_build_subdirs(project, base_folder)
-    applet_folder = base_folder + "/applets"
-    test_folder = base_folder + "/test"
+    # each shard compiles and runs in its own subfolders
+    applet_folder = base_folder + "/applets" + shard_suffix
+    test_folder = base_folder + "/test" + shard_suffix
     print("project: {} ({})".format(project.name, project.get_id()))
     print("folder: {}".format(base_folder))
 
@@ -895,8 +1263,11 @@ def main():
         "aws:us-east-1" :  project.name + ":" + base_folder
     }
 
-    # build the dxCompiler jar file, only on us-east-1
-    assets = util.build(project, base_folder, version_id, top_dir, test_dict)
+    # build the dxCompiler jar file, only on us-east-1. The shards share the
+    # runtime assets of the base folder: the first one builds them, and the
+    # others wait for them
+    assets = util.build(project, base_folder, version_id, top_dir, test_dict,
+                        wait_for_assets=bool(args.shard) and shard_index > 1)
     print("assets: {}".format(assets))
 
     if args.unlocked:
@@ -933,6 +1304,8 @@ def main():
     if "call_native_app" in test_names:
         native_call_app_setup(project, version_id, args.verbose)
 
+    started = time.time()
+    report = test_report.TestReport(git_revision.decode("utf-8"), [args.shard] if args.shard else [])
     try:
         # Compile the WDL files to dx:workflows and dx:applets
         runnable = compile_tests_to_project(project,
@@ -941,12 +1314,32 @@ def main():
                                             compiler_flags,
                                             version_id,
                                             args.lazy,
-                                            args.delay_compile_errors)
+                                            args.delay_compile_errors,
+                                            args.compile_jobs,
+                                            args.compile_batch,
+                                            report,
+                                            [ad.asset_id for ad in assets.values()])
         if not args.compile_only:
-            run_test_subset(project, runnable, test_folder, args.debug, args.delay_workspace_destruction)
+            run_test_subset(project, runnable, test_folder, args.debug, args.delay_workspace_destruction,
+                            args.fail_fast, args.verify_jobs, report, args.launch_jobs)
+        if args.baseline:
+            check_performance(report, args.baseline, max_slowdown, args.min_slowdown_seconds)
     finally:
+        if args.results_file:
+            report.save(args.results_file)
+        if args.junit_xml:
+            report.save_junit(args.junit_xml)
+        if not args.no_history:
+            history = test_history.TestHistory(history_db)
+            history.record(report, started)
+            history.close()
         if args.clean:
-            project.remove_folder(base_folder, recurse=True, force=True)
+            if args.shard:
+                # other shards may still be using the base folder
+                for folder in [applet_folder, test_folder]:
+                    project.remove_folder(folder, recurse=True, force=True)
+            else:
+                project.remove_folder(base_folder, recurse=True, force=True)
         print("Completed running tasks in {}".format(args.project))
 
 
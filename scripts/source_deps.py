@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Find the local files that a WDL or CWL source depends on: WDL imports,
+# and the CWL `run:`, `$import` and `$include` references.
+import os
+import re
+import yaml
+
+wdl_import_re = re.compile(r"""^\s*import\s+["']([^"']+)["']""")
+
+
+def _is_url(path):
+    return re.match(r"^[a-zA-Z][a-zA-Z0-9+.-]*://", path) is not None
+
+
+# Resolve a reference made from [source_file]. Relative paths are looked up
+# in the directory of the referring file, and then in the import directories.
+def _resolve(source_file, ref, import_dirs):
+    ref = ref.split("#")[0]
+    if ref.startswith("file://"):
+        ref = ref[len("file://"):]
+    if not ref or _is_url(ref):
+        return None
+    if os.path.isabs(ref):
+        return ref if os.path.exists(ref) else None
+    for base in [os.path.dirname(os.path.abspath(source_file))] + list(import_dirs):
+        path = os.path.normpath(os.path.join(base, ref))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _wdl_references(source_file):
+    refs = []
+    with open(source_file, 'r') as fd:
+        for line in fd:
+            m = re.match(wdl_import_re, line)
+            if m is not None:
+                refs.append(m.group(1))
+    return refs
+
+
+def _cwl_references(source_file):
+    with open(source_file, 'r') as fd:
+        doc = yaml.safe_load(fd)
+    refs = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in ("run", "$import", "$include") and isinstance(value, str):
+                    refs.append(value)
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for item in node:
+                walk(item)
+
+    walk(doc)
+    return refs
+
+
+# The local files directly referenced by [source_file]
+def direct_dependencies(source_file, import_dirs=()):
+    if source_file.endswith(".wdl"):
+        refs = _wdl_references(source_file)
+    elif source_file.endswith(".cwl"):
+        refs = _cwl_references(source_file)
+    else:
+        return []
+    deps = []
+    for ref in refs:
+        path = _resolve(source_file, ref, import_dirs)
+        if path is not None and path not in deps:
+            deps.append(path)
+    return deps
+
+
+# All the local files that [source_file] depends on, directly or
+# indirectly, not including [source_file] itself. The result is sorted.
+def transitive_dependencies(source_file, import_dirs=()):
+    source_file = os.path.normpath(os.path.abspath(source_file))
+    seen = set([source_file])
+    pending = [source_file]
+    while pending:
+        crnt = pending.pop()
+        try:
+            deps = direct_dependencies(crnt, import_dirs)
+        except (OSError, UnicodeDecodeError, yaml.YAMLError):
+            # not a parseable source file (e.g. a CWL $include of a script)
+            continue
+        for dep in deps:
+            if dep not in seen:
+                seen.add(dep)
+                pending.append(dep)
+    seen.remove(source_file)
+    return sorted(seen)
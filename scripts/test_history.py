@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# A local SQLite database with the timings of past test runs: one row per
+# test per run, with the time spent compiling, launching, queueing, running
+# and verifying the test, and the git revision that was tested.
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    git_revision TEXT,
+    shards TEXT
+);
+CREATE TABLE IF NOT EXISTS test_runs (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    tname TEXT NOT NULL,
+    status TEXT NOT NULL,
+    compile_time REAL,
+    launch_latency REAL,
+    queue_time REAL,
+    run_time REAL,
+    verify_time REAL,
+    PRIMARY KEY (run_id, tname)
+);
+CREATE INDEX IF NOT EXISTS test_runs_tname ON test_runs(tname, run_id);
+"""
+
+TIMING_COLUMNS = ("compile_time", "launch_latency", "queue_time", "run_time", "verify_time")
+
+
+def default_history_path(top_dir):
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    dir_hash = hashlib.sha1(os.path.abspath(top_dir).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_home, "dxCompiler", "test_history-{}.sqlite".format(dir_hash))
+
+
+def _total(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _mean(values):
+    return sum(values) / len(values)
+
+
+def _stdev(values):
+    if len(values) < 2:
+        return 0.0
+    m = _mean(values)
+    return math.sqrt(sum((v - m) ** 2 for v in values) / (len(values) - 1))
+
+
+def _row_total(row):
+    return _total(row[c] for c in TIMING_COLUMNS)
+
+
+class TestHistory(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def record(self, report, started=None):
+        """Add a run with one row for every test in [report] (a TestReport).
+        Returns the ID of the run."""
+        if not report.tests:
+            return None
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (started, git_revision, shards) VALUES (?, ?, ?)",
+                (started or time.time(), report.git_revision, ",".join(report.shards))
+            )
+            run_id = cursor.lastrowid
+            for tname, entry in report.tests.items():
+                executions = entry["executions"]
+                self.conn.execute(
+                    "INSERT INTO test_runs (run_id, tname, status, compile_time, launch_latency, "
+                    "queue_time, run_time, verify_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id,
+                     tname,
+                     report.status(entry),
+                     entry["compile_time"],
+                     _total(e.get("launch_time") for e in executions),
+                     _total(e.get("queue_time") for e in executions),
+                     _total(e.get("run_time") for e in executions),
+                     _total(e.get("verify_time") for e in executions))
+                )
+        return run_id
+
+    def _recent_rows(self, window):
+        """The last [window] rows of every test, oldest first"""
+        rows = {}
+        for row in self.conn.execute(
+                "SELECT t.*, r.git_revision FROM test_runs t JOIN runs r USING (run_id) "
+                "ORDER BY t.run_id DESC"):
+            tname_rows = rows.setdefault(row["tname"], [])
+            if len(tname_rows) < window:
+                tname_rows.append(row)
+        return dict((tname, list(reversed(r))) for tname, r in rows.items())
+
+    def durations(self, window=5):
+        """The mean total time of each test over its last [window] runs"""
+        durations = {}
+        for tname, rows in self._recent_rows(window).items():
+            totals = [t for t in (_row_total(row) for row in rows) if t is not None]
+            if totals:
+                durations[tname] = _mean(totals)
+        return durations
+
+    def longest_first(self, test_names, window=5):
+        """
+        [test_names] ordered by their mean total time over their last [window]
+        runs, longest first, so that the slowest tests are launched first.
+        Tests without a history are assumed to take the average time.
+        """
+        test_names = list(dict.fromkeys(test_names))
+        durations = self.durations(window)
+        known = [durations[t] for t in test_names if t in durations]
+        if not known:
+            return test_names
+        default = _mean(known)
+        return sorted(test_names, key=lambda t: -durations.get(t, default))
+
+    def slowest(self, limit=20, window=10):
+        """
+        Statistics for the [limit] slowest tests, by mean total time over their
+        last [window] runs. trend is the relative change of the mean of the
+        newer half of those runs compared to the older half, or None if there
+        are fewer than two runs.
+        """
+        stats = []
+        for tname, rows in self._recent_rows(window).items():
+            totals = [t for t in (_row_total(row) for row in rows) if t is not None]
+            if not totals:
+                continue
+            trend = None
+            if len(totals) >= 2:
+                half = len(totals) // 2
+                older = _mean(totals[:half])
+                if older > 0:
+                    trend = (_mean(totals[half:]) - older) / older
+            stats.append({
+                "tname": tname,
+                "runs": len(totals),
+                "mean": _mean(totals),
+                "stdev": _stdev(totals),
+                "last": totals[-1],
+                "trend": trend,
+                "phases": dict(
+                    (c, _mean(vs)) for c, vs in (
+                        (c, [row[c] for row in rows if row[c] is not None]) for c in TIMING_COLUMNS
+                    ) if vs
+                ),
+                "last_revision": rows[-1]["git_revision"]
+            })
+        stats.sort(key=lambda s: (-s["mean"], s["tname"]))
+        return stats[:limit]
+
+    def print_report(self, limit=20, window=10):
+        stats = self.slowest(limit, window)
+        if not stats:
+            print("No test history in {}".format(self.path))
+            return
+        print("Slowest tests over their last {} runs ({})".format(window, self.path))
+        print("{:<40} {:>4} {:>9} {:>9} {:>9} {:>8}  {}".format(
+            "test", "runs", "mean(s)", "stdev(s)", "last(s)", "trend", "phases (mean s)"))
+        for s in stats:
+            trend = "" if s["trend"] is None else "{:+.0%}".format(s["trend"])
+            phases = " ".join("{}={:.0f}".format(c.split("_")[0], v) for c, v in s["phases"].items())
+            print("{:<40} {:>4} {:>9.1f} {:>9.1f} {:>9.1f} {:>8}  {}".format(
+                s["tname"], s["runs"], s["mean"], s["stdev"], s["last"], trend, phases))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# An on-disk index of the tests under the test directory, so that the test
+# sources do not have to be found and parsed again on every run.
+#
+# - A directory is only listed again if its mtime changed (i.e. files were
+#   added, removed or renamed in it).
+# - A test is only parsed again if its source file, one of its input or
+#   extras files, or the listing of its directory changed.
+# - Tests are parsed lazily, the first time they are looked up.
+from collections.abc import Mapping
+import hashlib
+import json
+import os
+import sys
+
+INDEX_VERSION = 1
+
+
+def default_index_path(test_dir):
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    dir_hash = hashlib.sha1(os.path.abspath(test_dir).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_home, "dxCompiler", "test_index-{}.json".format(dir_hash))
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class TestIndex(Mapping):
+    """
+    A read-only mapping from test name to test description.
+
+    describe(dir_path, tname, ext) parses a test and returns its description,
+    a namedtuple of type desc_type; it raises an exception if the file is not a
+    valid test. is_source(filename) selects the files that may be tests.
+    aux_files(desc) lists the files, other than the source, that the
+    description is derived from. key identifies the code of these functions;
+    an index written with a different key is discarded.
+    """
+    def __init__(self, test_dir, describe, desc_type, is_source, aux_files,
+                 index_path=None, verbose=False, key=None):
+        self.test_dir = os.path.abspath(test_dir)
+        self.key = key
+        self.describe = describe
+        self.desc_type = desc_type
+        self.is_source = is_source
+        self.aux_files = aux_files
+        self.index_path = index_path or default_index_path(test_dir)
+        self.verbose = verbose
+        self.dirty = False
+        self.dirs = {}
+        self.tests = {}
+        self._load()
+        self.dir_mtimes = {}
+        self.sources = self._scan()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r') as fd:
+                index = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if (index.get("version") == INDEX_VERSION and index.get("test_dir") == self.test_dir and
+                index.get("key") == self.key):
+            self.dirs = index["dirs"]
+            self.tests = index["tests"]
+
+    # Find all the test sources. Returns a dictionary from test name to
+    # the source files with that name, in the order they were found.
+    def _scan(self):
+        dirs = {}
+        sources = {}
+        stack = [self.test_dir]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(dir_path)
+            if entry is None or entry["mtime"] != mtime:
+                files = []
+                subdirs = []
+                with os.scandir(dir_path) as it:
+                    for dir_entry in it:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.name)
+                        elif self.is_source(dir_entry.name):
+                            files.append(dir_entry.name)
+                entry = {"mtime": mtime, "sources": sorted(files), "subdirs": sorted(subdirs)}
+                self.dirty = True
+            dirs[dir_path] = entry
+            self.dir_mtimes[dir_path] = mtime
+            for fname in entry["sources"]:
+                sources.setdefault(os.path.splitext(fname)[0], []).append(os.path.join(dir_path, fname))
+            for sub in reversed(entry["subdirs"]):
+                stack.append(os.path.join(dir_path, sub))
+        if set(dirs.keys()) != set(self.dirs.keys()):
+            self.dirty = True
+        self.dirs = dirs
+        return sources
+
+    def _is_current(self, source_file, entry):
+        if entry.get("dir_mtime") != self.dir_mtimes.get(os.path.dirname(source_file)):
+            return False
+        return all(_stamp(path) == stamp for path, stamp in entry["stamps"].items())
+
+    def _resolve(self, tname):
+        """Returns the test description, or None if no source is a valid test.
+        If several sources have the same name, the last valid one is used."""
+        for source_file in reversed(self.sources[tname]):
+            desc = self._resolve_source(tname, source_file)
+            if desc is not None:
+                return desc
+        return None
+
+    def _resolve_source(self, tname, source_file):
+        entry = self.tests.get(source_file)
+        if entry is None or not self._is_current(source_file, entry):
+            dir_path = os.path.dirname(source_file)
+            ext = os.path.splitext(source_file)[1]
+            paths = [source_file]
+            try:
+                desc = self.describe(dir_path, tname, ext)
+                paths += self.aux_files(desc)
+                entry = {"desc": desc._asdict(), "error": None}
+            except Exception as e:
+                entry = {"desc": None, "error": str(e)}
+            entry["dir_mtime"] = self.dir_mtimes.get(dir_path)
+            entry["stamps"] = dict((path, _stamp(path)) for path in paths)
+            self.tests[source_file] = entry
+            self.dirty = True
+            if entry["error"] is not None and self.verbose:
+                print("Skipping test file {} error={}".format(source_file, entry["error"]),
+                      file=sys.stderr)
+        if entry["desc"] is None:
+            return None
+        return self.desc_type(**entry["desc"])
+
+    def __getitem__(self, tname):
+        desc = self._resolve(tname) if tname in self.sources else None
+        if desc is None:
+            raise KeyError(tname)
+        return desc
+
+    def __contains__(self, tname):
+        return tname in self.sources and self._resolve(tname) is not None
+
+    def __iter__(self):
+        for tname in list(self.sources.keys()):
+            if self._resolve(tname) is not None:
+                yield tname
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def save(self):
+        if not self.dirty:
+            return
+        # forget sources that no longer exist
+        current = set(path for paths in self.sources.values() for path in paths)
+        tests = dict((path, entry) for path, entry in self.tests.items() if path in current)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.index_path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump({
+                "version": INDEX_VERSION,
+                "test_dir": self.test_dir,
+                "key": self.key,
+                "dirs": self.dirs,
+                "tests": tests
+            }, fd)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# Results of a test run: the outcome and timing of compiling, running and
+# verifying each test. Reports are saved as JSON, and the reports of
+# several shards of one run can be merged into a single report.
+import json
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+# by default, differences in time smaller than this are not considered
+# regressions, whatever the relative slowdown
+DEFAULT_MIN_REGRESSION_SECONDS = 10
+
+
+def _new_entry():
+    return {
+        "compile_ok": None,
+        "compile_time": None,
+        "executions": []
+    }
+
+
+class TestReport(object):
+    def __init__(self, git_revision=None, shards=None):
+        self.git_revision = git_revision
+        # the shards included in this report, e.g. ["1/4", "2/4"]
+        self.shards = shards or []
+        self.tests = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, tname):
+        return self.tests.setdefault(tname, _new_entry())
+
+    def record_compile(self, tname, ok, seconds):
+        with self.lock:
+            entry = self._entry(tname)
+            entry["compile_ok"] = ok
+            entry["compile_time"] = seconds
+
+    # launch_time: seconds it took to start the execution, including retries
+    # queue_time: seconds from creation until the execution started running
+    # run_time: seconds from then until the execution finished
+    # output_size: total size in bytes of the output files
+    def record_execution(self, tname, input_index, exec_id, state, ok, run_time,
+                         queue_time=None, launch_time=None, instance_type=None, output_size=None):
+        with self.lock:
+            self._entry(tname)["executions"].append({
+                "input_index": input_index,
+                "exec_id": exec_id,
+                "state": state,
+                "ok": ok,
+                "launch_time": launch_time,
+                "queue_time": queue_time,
+                "run_time": run_time,
+                "instance_type": instance_type,
+                "output_size": output_size,
+                "verified": None,
+                "verify_time": None
+            })
+
+    def record_verification(self, tname, exec_id, ok, seconds=None):
+        with self.lock:
+            for execution in self._entry(tname)["executions"]:
+                if execution["exec_id"] == exec_id:
+                    execution["verified"] = ok
+                    execution["verify_time"] = seconds
+
+    @staticmethod
+    def status(entry):
+        if entry["compile_ok"] is False:
+            return "compile_error"
+        if any(not e["ok"] for e in entry["executions"]):
+            return "failed_execution"
+        if any(e["verified"] is False for e in entry["executions"]):
+            return "failed_verification"
+        return "passed"
+
+    def failures(self):
+        return sorted(tname for tname, entry in self.tests.items()
+                      if self.status(entry) != "passed")
+
+    def durations(self):
+        """The total compile and run time of each test, for the tests that have any"""
+        durations = {}
+        for tname, entry in self.tests.items():
+            times = [entry["compile_time"]]
+            for e in entry["executions"]:
+                times += [e.get("queue_time"), e["run_time"]]
+            times = [t for t in times if t is not None]
+            if times:
+                durations[tname] = sum(times)
+        return durations
+
+    def to_json(self):
+        return {
+            "git_revision": self.git_revision,
+            "shards": self.shards,
+            "tests": dict(
+                (tname, dict(entry, status=self.status(entry)))
+                for tname, entry in sorted(self.tests.items())
+            )
+        }
+
+    def to_junit(self):
+        """A JUnit XML tree with a test case for the compilation of every
+        test, and one for every execution"""
+        suite = ET.Element("testsuite", name="dxCompiler")
+        num_tests = 0
+        num_failures = 0
+        total_time = 0.0
+        for tname, entry in sorted(self.tests.items()):
+            cases = [("compile", entry["compile_time"],
+                      None if entry["compile_ok"] is not False else "compilation failed")]
+            for e in entry["executions"]:
+                failure = None
+                if not e["ok"]:
+                    failure = "execution {} is {}".format(e["exec_id"], e["state"])
+                elif e["verified"] is False:
+                    failure = "execution {} has wrong outputs".format(e["exec_id"])
+                name = "run" if e["input_index"] is None else "run_input_{}".format(e["input_index"])
+                seconds = sum(t for t in (e.get("queue_time"), e["run_time"]) if t is not None)
+                cases.append((name, seconds, failure))
+            for name, seconds, failure in cases:
+                case = ET.SubElement(suite, "testcase", classname=tname, name=name,
+                                     time="{:.3f}".format(seconds or 0.0))
+                if failure is not None:
+                    ET.SubElement(case, "failure", message=failure)
+                    num_failures += 1
+                num_tests += 1
+                total_time += seconds or 0.0
+        suite.set("tests", str(num_tests))
+        suite.set("failures", str(num_failures))
+        suite.set("time", "{:.3f}".format(total_time))
+        return ET.ElementTree(suite)
+
+    def save_junit(self, path):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        self.to_junit().write(tmp_path, encoding="utf-8", xml_declaration=True)
+        os.replace(tmp_path, path)
+
+    def save(self, path):
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump(self.to_json(), fd, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fd:
+            js = json.load(fd)
+        report = cls(js.get("git_revision"), js.get("shards"))
+        for tname, entry in js["tests"].items():
+            entry = dict(entry)
+            entry.pop("status", None)
+            report.tests[tname] = entry
+        return report
+
+    @classmethod
+    def merge(cls, reports):
+        """Combine reports. If a test appears in several reports, the last one wins."""
+        revisions = set(r.git_revision for r in reports if r.git_revision is not None)
+        merged = cls(",".join(sorted(revisions)) or None,
+                     [shard for r in reports for shard in r.shards])
+        for report in reports:
+            merged.tests.update(report.tests)
+        return merged
+
+    def print_summary(self):
+        counts = {}
+        for entry in self.tests.values():
+            status = self.status(entry)
+            counts[status] = counts.get(status, 0) + 1
+        print("{} tests: {}".format(
+            len(self.tests),
+            ", ".join("{} {}".format(n, status) for status, n in sorted(counts.items()))
+        ))
+        for tname in self.failures():
+            print("  {}: {}".format(tname, self.status(self.tests[tname])))
+
+
+# Split [test_names] into [count] shards, and return shard number [index]
+# (1-based). Shards are balanced by the expected duration of each test: a
+# test is assigned to the least loaded shard, longest tests first. Tests
+# without a known duration are assumed to take the average time. If no
+# durations are known, the tests are dealt round-robin.
+def shard_tests(test_names, index, count, durations=None):
+    if not 1 <= index <= count:
+        raise ValueError("shard {} is not in the range 1..{}".format(index, count))
+    test_names = list(dict.fromkeys(test_names))
+    known = dict((t, durations[t]) for t in test_names if durations and t in durations)
+    if not known:
+        return [t for i, t in enumerate(test_names) if i % count == index - 1]
+    default = sum(known.values()) / len(known)
+    weights = dict((t, known.get(t, default)) for t in test_names)
+    loads = [0.0] * count
+    assignment = {}
+    for t in sorted(test_names, key=lambda t: (-weights[t], t)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        loads[shard] += weights[t]
+        assignment[t] = shard
+    return [t for t in test_names if assignment[t] == index - 1]
+
+
+# Parse a slowdown threshold, given either as a percentage ("20%") or as a
+# fraction ("0.2")
+def parse_slowdown(value):
+    m = re.match(r"^\s*([0-9.]+)\s*%\s*$", value)
+    try:
+        return float(m.group(1)) / 100 if m is not None else float(value)
+    except ValueError:
+        raise ValueError("Invalid slowdown {}, expected e.g. 20%".format(value))
+
+
+def _execution_time(entry):
+    times = [e["run_time"] for e in entry["executions"] if e["ok"] and e["run_time"] is not None]
+    return sum(times) if times else None
+
+
+# Compare the compile and execution times of the tests in [report] with
+# those in [baseline]. Returns a list of (test name, phase, baseline seconds,
+# seconds) for every time that grew by more than [max_slowdown] (a fraction,
+# ignored when the baseline is 0) and by at least [min_seconds].
+# Queue time is not compared, it depends on the load of the platform.
+def find_regressions(report, baseline, max_slowdown, min_seconds=DEFAULT_MIN_REGRESSION_SECONDS):
+    regressions = []
+    for tname, entry in sorted(report.tests.items()):
+        base_entry = baseline.tests.get(tname)
+        if base_entry is None:
+            continue
+        phases = [
+            ("compile", base_entry["compile_time"], entry["compile_time"]),
+            ("execution", _execution_time(base_entry), _execution_time(entry))
+        ]
+        for phase, before, after in phases:
+            if before is None or after is None:
+                continue
+            if after - before < min_seconds:
+                continue
+            # a zero baseline has no relative slowdown, only the absolute one counts
+            if before == 0 or after > before * (1 + max_slowdown):
+                regressions.append((tname, phase, before, after))
+    return regressions
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 from collections import namedtuple
+import concurrent.futures
 import dxpy
+import errno
+import fcntl
+import functools
+import hashlib
 import json
 import os
-from pathlib import Path
 import pwd
+import random
 import re
 import shutil
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
+import urllib.error
+import urllib.request
 
 AssetDesc = namedtuple('AssetDesc', 'region asset_id project')
 
@@ -23,6 +33,19 @@ max_num_retries = 5
 # - asset name = "dx{}rt".format(lang.upper())
 languages = ["Wdl", "Cwl"]
 
+# The sbt subprojects whose sources go into each jar
+jar_subprojects = dict(
+    [("dxCompiler", ["core", "compiler"])] +
+    [("dxExecutor{}".format(lang), ["core", "executorCommon", "executor{}".format(lang)]) for lang in languages]
+)
+
+# The property of a runtime asset record that holds the fingerprint of the
+# sources and dependencies it was built from
+ASSET_FINGERPRINT_PROPERTY = "source_fingerprint"
+# How long, and how often, to check for runtime assets built by another process
+ASSET_WAIT_TIMEOUT = 60 * 60
+ASSET_WAIT_INTERVAL = 30
+
 
 def info(msg, ex=None):
     print(msg, file=sys.stderr)
@@ -30,6 +53,196 @@ def info(msg, ex=None):
         traceback.print_exception(*ex)
 
 
+# API errors worth retrying: throttling, server errors and network failures
+def is_transient_error(e):
+    if isinstance(e, dxpy.exceptions.DXAPIError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (OSError, dxpy.exceptions.ServiceUnavailable))
+
+
+# Call fn(), retrying transient errors up to [attempts] times. The delay
+# before retry i is drawn uniformly from [0, min(max_delay, base_delay * 2^i)]
+# (exponential backoff with full jitter), so that concurrent callers do not
+# retry in lockstep.
+def with_backoff(fn, what, attempts=max_num_retries, base_delay=1, max_delay=60,
+                 is_transient=is_transient_error):
+    for i in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if i == attempts - 1 or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** i))
+            info("Error {} (try {}): {}; retrying in {:.1f} seconds".format(what, i + 1, e, delay))
+            time.sleep(delay)
+
+
+# The output of `java -version`, and the feature version of the JVM (8, 11,
+# ...), or (None, None) if java is not available
+@functools.lru_cache(maxsize=None)
+def java_version():
+    try:
+        proc = subprocess.run(["java", "-version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return None, None
+    output = proc.stdout.decode("utf-8", errors="replace").strip()
+    m = re.search(r'version "(\d+)(?:\.(\d+))?', output)
+    if m is None:
+        return output, None
+    feature = int(m.group(1))
+    if feature == 1 and m.group(2) is not None:
+        # 1.8 is java 8
+        feature = int(m.group(2))
+    return output, feature
+
+
+# Application class-data sharing (AppCDS) archives. The classes a jar loads
+# during a training run are stored in a <jar>.jsa archive, which the JVM
+# maps into memory at startup instead of loading and verifying them again.
+# An archive is only valid for the exact jar and JVM that created it; this
+# is recorded in <jar>.jsa.json.
+CDS_MIN_JAVA_VERSION = 11
+
+
+def cds_archive_path(jar_path):
+    return os.path.splitext(os.path.abspath(jar_path))[0] + ".jsa"
+
+
+def _cds_stamp(jar_path):
+    st = os.stat(jar_path)
+    return {"jar": os.path.abspath(jar_path),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "java": java_version()[0]}
+
+
+# Create a CDS archive for [jar_path] from the classes loaded by running
+# `java -jar jar_path <args>` for each of the [training_args]. Training runs
+# may fail, the classes they loaded are used anyway. Returns the path of
+# the archive, or None if the JVM does not support AppCDS or the dump failed.
+def create_cds_archive(jar_path, training_args):
+    _, feature = java_version()
+    if feature is None or feature < CDS_MIN_JAVA_VERSION:
+        info("Java {} does not support application class-data sharing, not creating an archive for {}"
+             .format(feature, jar_path))
+        return None
+    jar_path = os.path.abspath(jar_path)
+    archive = cds_archive_path(jar_path)
+    stamp_path = archive + ".json"
+    for path in (archive, stamp_path):
+        if os.path.exists(path):
+            os.remove(path)
+    with tempfile.TemporaryDirectory(prefix="cds_") as tmp_dir:
+        classes = []
+        for i, args in enumerate(training_args):
+            class_list = os.path.join(tmp_dir, "training{}.lst".format(i))
+            subprocess.run(["java", "-XX:DumpLoadedClassList={}".format(class_list), "-jar", jar_path] + args,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if os.path.exists(class_list):
+                with open(class_list) as fd:
+                    classes += [line.strip() for line in fd if line.strip()]
+        class_list = os.path.join(tmp_dir, "classes.lst")
+        with open(class_list, "w") as fd:
+            fd.write("\n".join(dict.fromkeys(classes)) + "\n")
+        # the archive only speeds up startup, so failing to create it is not an error
+        proc = subprocess.run(["java", "-Xshare:dump",
+                               "-XX:SharedClassListFile={}".format(class_list),
+                               "-XX:SharedArchiveFile={}".format(archive),
+                               "-cp", jar_path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        info("Could not create class-data sharing archive {} (exit code {}): {}".format(
+            archive, proc.returncode, proc.stderr.decode("utf-8", errors="replace").strip()))
+        if os.path.exists(archive):
+            os.remove(archive)
+        return None
+    with open(stamp_path, "w") as fd:
+        json.dump(_cds_stamp(jar_path), fd)
+    info("Created class-data sharing archive {} ({} classes)".format(archive, len(set(classes))))
+    return archive
+
+
+# The command line that runs [jar_path], using its CDS archive if there is
+# one that was created for this jar and this JVM
+def java_command(jar_path):
+    jar_path = os.path.abspath(jar_path)
+    archive = cds_archive_path(jar_path)
+    try:
+        with open(archive + ".json") as fd:
+            stamp = json.load(fd)
+    except (OSError, ValueError):
+        stamp = None
+    if stamp is not None and os.path.exists(archive) and stamp == _cds_stamp(jar_path):
+        return ["java", "-XX:SharedArchiveFile={}".format(archive), "-Xshare:auto", "-jar", jar_path]
+    return ["java", "-jar", jar_path]
+
+
+_CDS_TRAINING_WDL = """version 1.0
+
+task greet {
+  input {
+    String name
+    Int n = 1
+  }
+  command <<<
+    echo "hello ~{name}" > out.txt
+  >>>
+  output {
+    File out = "out.txt"
+    Int m = n + 1
+  }
+  runtime {
+    docker: "ubuntu:20.04"
+  }
+}
+
+workflow training {
+  input {
+    Array[String] names = ["a", "b"]
+    Boolean flag = true
+  }
+  scatter (name in names) {
+    call greet { input: name = name }
+  }
+  if (flag) {
+    call greet as again { input: name = "again", n = length(greet.m) }
+  }
+  output {
+    Array[File] outs = greet.out
+    Int? m = again.m
+  }
+}
+"""
+
+_CDS_TRAINING_CWL = """cwlVersion: v1.2
+class: CommandLineTool
+id: training
+baseCommand: echo
+inputs:
+  message:
+    type: string
+    inputBinding:
+      position: 1
+stdout: out.txt
+outputs:
+  out:
+    type: stdout
+"""
+
+
+# Create the CDS archive of the compiler jar, by compiling a WDL workflow
+# and a CWL tool to IR, which does not require the platform
+def create_compiler_cds_archive(jar_path):
+    with tempfile.TemporaryDirectory(prefix="cds_training_") as tmp_dir:
+        training_args = []
+        for name, source in [("training.wdl", _CDS_TRAINING_WDL), ("training.cwl", _CDS_TRAINING_CWL)]:
+            path = os.path.join(tmp_dir, name)
+            with open(path, "w") as fd:
+                fd.write(source)
+            training_args.append(["compile", path, "-compileMode", "IR", "-quiet"])
+        return create_cds_archive(jar_path, training_args)
+
+
 # Extract version_id from configuration file
 def get_version_id(top_dir):
     appl_conf_path = os.path.join(top_dir, "core", "src", "main", "resources", "application.conf")
@@ -43,19 +256,58 @@ def get_version_id(top_dir):
     raise Exception("version ID not found in {}".format(appl_conf_path))
 
 
-def find_asset(project, folder, language):
-    # get asset_id
-    asset_name = "dx{}rt".format(language.upper())
-    assets = list(dxpy.search.find_data_objects(classname="record",
+# Find the assets of several languages in [folder] with a single listing.
+# Returns a dictionary from language to asset record, or None.
+def find_assets(project, folder, langs=None):
+    langs = langs or languages
+    asset_names = dict(("dx{}rt".format(lang.upper()), lang) for lang in langs)
+    pattern = "^({})$".format("|".join(re.escape(name) for name in asset_names))
+    found = dict((lang, []) for lang in langs)
+    for result in dxpy.search.find_data_objects(classname="record",
                                                 project=project.get_id(),
-                                                name=asset_name,
+                                                name=pattern,
+                                                name_mode="regexp",
                                                 folder=folder,
-                                                return_handler=True))
-    if len(assets) == 0:
-        return None
-    if len(assets) == 1:
-        return assets[0]
-    raise Exception("More than one asset with name {} found in {}:{}".format(asset_name, project, folder))
+                                                describe={"fields": {"name": True}}):
+        found[asset_names[result["describe"]["name"]]].append(
+            dxpy.DXRecord(result["id"], project=result["project"]))
+    assets = {}
+    for (lang, records) in found.items():
+        if len(records) > 1:
+            raise Exception("More than one asset with name dx{}rt found in {}:{}"
+                            .format(lang.upper(), project, folder))
+        assets[lang] = records[0] if records else None
+    return assets
+
+
+def find_asset(project, folder, language):
+    return find_assets(project, folder, [language])[language]
+
+
+# Compile several source files with a single compiler process. Each entry
+# is a dictionary with the keys "source", and optionally "flags", "folder"
+# and "project". Returns a list of result records, one per entry and in
+# the same order, each with a "status" of "success" or "failure", a
+# "result" (the executable IDs) or an "error", and the compile time of the
+# entry in "seconds".
+def compile_batch(top_dir, version_id, entries, verbose=False):
+    with tempfile.NamedTemporaryFile("w", prefix="compile_manifest_", suffix=".json",
+                                     delete=False) as fd:
+        json.dump(entries, fd, indent=4)
+        manifest = fd.name
+    try:
+        cmdline = java_command(os.path.join(top_dir, "dxCompiler-{}.jar".format(version_id)))
+        cmdline += ["compile-batch", manifest]
+        if verbose:
+            cmdline.append("-verbose")
+        info(" ".join(cmdline))
+        output = subprocess.check_output(cmdline)
+    finally:
+        os.remove(manifest)
+    results = json.loads(output)
+    if len(results) != len(entries):
+        raise Exception("expected {} compile results, got {}".format(len(entries), len(results)))
+    return results
 
 
 def create_build_subdirs(project, base_folder):
@@ -74,94 +326,349 @@ def create_build_dirs(project, version_id):
     return base_folder
 
 
-def get_project(project_name):
-    """Try to find the project with the given name or id."""
+# Project resolution is memoized: the ID and region of every project name
+# that was resolved are kept in memory, and on disk for PROJECT_CACHE_TTL
+# seconds, so that the scripts do not search for the same projects over and
+# over. resolve_projects() resolves many names in one search. The same name
+# refers to different projects on different API servers and for different
+# users, so the entries on disk are kept per (API server, user) context.
+PROJECT_CACHE_TTL = 60 * 60
 
-    # First, see if the project is a project-id.
+
+def default_project_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "dxCompiler", "projects.json")
+
+
+# The API server and user that project names are resolved for, or None if
+# they cannot be determined
+def _api_context():
     try:
-        project = dxpy.DXProject(project_name)
-        return project
+        user = dxpy.whoami()
     except dxpy.DXError:
-        pass
+        return None
+    return "{}://{}:{}/{}".format(dxpy.APISERVER_PROTOCOL, dxpy.APISERVER_HOST, dxpy.APISERVER_PORT, user)
+
+
+class ProjectResolver(object):
+    def __init__(self, path=None, ttl=PROJECT_CACHE_TTL, context=None):
+        self.path = path or default_project_cache_path()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # entries are only persisted when the context is known
+        self.context = context or _api_context()
+        # project name or ID -> {"id", "region", "time"}
+        self.entries = {}
+        # the names and IDs whose entries were read from disk, and may be stale
+        self.from_disk = set()
+        if self.context is not None:
+            now = time.time()
+            self.entries = dict((name, entry) for name, entry in self._read_contexts().get(self.context, {}).items()
+                                if now - entry["time"] < self.ttl)
+            self.from_disk = set(self.entries.keys())
+
+    def _read_contexts(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as fd:
+                return json.load(fd).get("contexts", {})
+        except (OSError, ValueError):
+            return {}
 
-    project = dxpy.find_projects(name=project_name, return_handler=True, level="VIEW")
-    project = [p for p in project]
-    if len(project) == 0:
+    def _lookup(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def _search(self, names):
+        # one regular expression that matches all the names exactly
+        pattern = "^({})$".format("|".join(re.escape(name) for name in names))
+        found = {}
+        for result in dxpy.find_projects(name=pattern, name_mode="regexp", level="VIEW",
+                                         describe={"fields": {"name": True, "region": True}}):
+            found.setdefault(result["describe"]["name"], []).append(result)
+        return found
+
+    def resolve(self, names):
+        """Resolve project names (or IDs) in bulk. Returns a dictionary from
+        name to {"id", "region"}, without the names that were not found."""
+        names = list(dict.fromkeys(names))
+        missing = [name for name in names if self._lookup(name) is None]
+        ids = [name for name in missing if name.startswith("project-")]
+        by_name = [name for name in missing if not name.startswith("project-")]
+        now = time.time()
+        new_entries = {}
+        for project_id in ids:
+            try:
+                region = dxpy.api.project_describe(project_id, {"fields": {"region": True}})["region"]
+            except dxpy.DXError:
+                continue
+            new_entries[project_id] = {"id": project_id, "region": region, "time": now}
+        if by_name:
+            found = self._search(by_name)
+            for name in by_name:
+                results = found.get(name, [])
+                if len(results) > 1:
+                    raise Exception('Found more than 1 project matching {0}'.format(name))
+                if len(results) == 1:
+                    entry = {"id": results[0]["id"], "region": results[0]["describe"]["region"], "time": now}
+                    # the project can also be looked up by its ID
+                    new_entries[name] = new_entries[entry["id"]] = entry
+        if new_entries:
+            with self.lock:
+                self.entries.update(new_entries)
+            self.save()
+        resolved = {}
+        for name in names:
+            entry = self._lookup(name)
+            if entry is not None:
+                resolved[name] = {"id": entry["id"], "region": entry["region"]}
+        return resolved
+
+    def forget(self, name):
+        """Drop the entry of a project name or ID, and the entries that refer
+        to the same project. Returns True if the entry came from disk, i.e.
+        resolving the name again may give a different project."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return False
+            stale = [key for key, other in self.entries.items() if other["id"] == entry["id"]]
+            was_on_disk = name in self.from_disk
+            for key in stale:
+                del self.entries[key]
+                self.from_disk.discard(key)
+        self.save()
+        return was_on_disk
+
+    def region(self, project_id):
+        resolved = self.resolve([project_id]).get(project_id)
+        if resolved is None:
+            return dxpy.describe(project_id)["region"]
+        return resolved["region"]
+
+    def save(self):
+        if self.context is None:
+            return
+        # one thread at a time reads, merges and writes the file; the
+        # temporary file is unique, so other processes never write to it
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            contexts = self._read_contexts()
+            contexts[self.context] = dict(self.entries)
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path), prefix="projects.",
+                                             suffix=".tmp", delete=False) as fd:
+                json.dump({"contexts": contexts}, fd)
+            os.replace(fd.name, self.path)
+
+
+_project_resolver = None
+
+
+def project_resolver():
+    global _project_resolver
+    if _project_resolver is None:
+        _project_resolver = ProjectResolver()
+    return _project_resolver
+
+
+# Resolve many project names (or IDs) in one pass, e.g. all the projects of
+# a region-to-project dictionary, so that later get_project() calls are
+# answered from memory
+def resolve_projects(project_names):
+    return project_resolver().resolve(project_names)
+
+
+def get_project(project_name):
+    """Try to find the project with the given name or id."""
+    resolved = project_resolver().resolve([project_name]).get(project_name)
+    if resolved is None:
         info('Did not find project {0}'.format(project_name))
         return None
-    elif len(project) == 1:
-        return project[0]
-    else:
-        raise Exception('Found more than 1 project matching {0}'.format(project_name))
+    return dxpy.DXProject(resolved["id"])
 
 
-# download dxda for linux, and place it in the resources
-# sub-directory.
-def _download_dxda_into_resources(top_dir, dxda_version):
-    # TODO: if dxda_version is None, fetch latest
-    dxda_dir = os.path.join(top_dir, "applet_resources", "dxda", dxda_version)
-    dxda_exe = os.path.join(dxda_dir, "dx-download-agent")
+# Call fn(project) on the project named [project_name]. If the project was
+# resolved from the on-disk cache and no longer exists, the name is
+# resolved again, and fn called once more. Returns None if there is no
+# such project.
+def with_project(project_name, fn):
+    project = get_project(project_name)
+    if project is None:
+        return None
+    try:
+        return fn(project)
+    except dxpy.exceptions.ResourceNotFound:
+        if not project_resolver().forget(project_name):
+            raise
+        info("Project {} no longer exists, resolving it again".format(project_name))
+        project = get_project(project_name)
+        return fn(project) if project is not None else None
 
-    if not os.path.exists(dxda_exe):
-        os.makedirs(dxda_dir, exist_ok=True)
-        os.chdir(dxda_dir)
-        try:
-            # download dxda release, and place it in the resources directory
-            if dxda_version.startswith("v"):
-                # A proper download-agent release, it starts with a "v"
-
-                    subprocess.check_call([
-                        "wget",
-                        "https://github.com/dnanexus/dxda/releases/download/{}/dx-download-agent-linux".format(dxda_version),
-                        "-O",
-                        "dx-download-agent"])
-            else:
-                # A snapshot of the download-agent development branch
-                snapshot_dxda_tar = "resources/dx-download-agent-linux.tar"
-                command = """sudo docker run --rm --entrypoint=\'\' dnanexus/dxda:{} cat /builds/dx-download-agent-linux.tar > {}""".format(
-                    dxda_version, snapshot_dxda_tar)
-                p = subprocess.Popen(command, universal_newlines=True, shell=True,
-                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                text = p.stdout.read()
-                retcode = p.wait()
-                info("downloading dxda {} {}".format(retcode, text))
-                subprocess.check_call(["tar", "-C", "resources", "-xvf", snapshot_dxda_tar])
-                os.rename("resources/dx-download-agent-linux/dx-download-agent",
-                          "dx-download-agent")
-                os.remove(snapshot_dxda_tar)
-                shutil.rmtree("resources/dx-download-agent-linux")
-        except subprocess.CalledProcessError as e:
-            print(e.stdout)
-            print(e.stderr)
-            raise e
-        # make sure the binary is executable
-        os.chmod("dx-download-agent", 0o775)
-
-    return dxda_exe
-
-
-def _download_dxfuse_to_resources(top_dir, dxfuse_version):
-    # TODO: if dxfuse_version is None, fetch latest
-    dxfuse_dir = os.path.join(top_dir, "applet_resources", "dxfuse", dxfuse_version)
-    dxfuse_exe = os.path.join(dxfuse_dir, "dxfuse")
-
-    if not os.path.exists(dxfuse_exe):
-        os.makedirs(dxfuse_dir, exist_ok=True)
-        info("downloading dxfuse {} to {}".format(dxfuse_version, dxfuse_exe))
-        try:
-            subprocess.check_call([
-                "wget",
-                "https://github.com/dnanexus/dxfuse/releases/download/{}/dxfuse-linux".format(dxfuse_version),
-                "-O",
-                dxfuse_exe])
-        except subprocess.CalledProcessError as e:
-            print(e.stdout)
-            print(e.stderr)
-            raise e
 
-        os.chmod(dxfuse_exe, 0o775)
+# The project with the given name or id, checking that a cached project
+# still exists
+def get_live_project(project_name):
+    return with_project(project_name, lambda project: project.describe() and project)
+
+
+# The region of a project
+def get_project_region(project_id):
+    try:
+        return project_resolver().region(project_id)
+    except dxpy.exceptions.ResourceNotFound:
+        if not project_resolver().forget(project_id):
+            raise
+        return project_resolver().region(project_id)
+
+
+# A user-level, content-addressed cache of the binaries bundled in the
+# runtime assets (dxda and dxfuse), shared by all checkouts. Binaries are
+# stored under sha256/<digest>. Their checksums are pinned in
+# bundled_dependencies.json ("sha256": {"dxda": ..., "dxfuse": ...}), next to
+# their versions. A binary without a pinned checksum, e.g. a dxda snapshot,
+# is used with a warning, and cached under unpinned/<name>@<version>, unless
+# REQUIRE_PINNED_ENV is set, as it is for release builds.
+REQUIRE_PINNED_ENV = "DXCOMPILER_REQUIRE_PINNED_BINARIES"
+BUNDLED_BINARIES = {
+    "dxda": ("dx-download-agent",
+             "https://github.com/dnanexus/dxda/releases/download/{}/dx-download-agent-linux"),
+    "dxfuse": ("dxfuse",
+               "https://github.com/dnanexus/dxfuse/releases/download/{}/dxfuse-linux")
+}
+
+
+def default_binary_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "dxCompiler", "binaries")
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Download [url] to [path], resuming from the end of [path] if it exists
+def _resumable_download(url, path):
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    request = urllib.request.Request(url)
+    if offset > 0:
+        request.add_header("Range", "bytes={}-".format(offset))
+    try:
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            # the partial download is already complete
+            return
+        raise
+    with response:
+        # the server may ignore the range, and send the whole file
+        mode = "ab" if response.status == 206 else "wb"
+        with open(path, mode) as fd:
+            shutil.copyfileobj(response, fd, 1 << 20)
+
+
+# Only the errors that may go away when the download is retried: throttling,
+# server errors and network failures, unlike e.g. a release that does not exist
+def _is_transient_download_error(e):
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, (urllib.error.URLError, socket.timeout, ConnectionError))
+
+
+# The binary [name] of [version], fetched into the cache if needed. Fails
+# if its checksum does not match the pinned one, or if there is no pinned
+# checksum and REQUIRE_PINNED_ENV is set.
+def _fetch_bundled_binary(name, version, pinned_sha256=None, cache_dir=None):
+    cache_dir = cache_dir or default_binary_cache_dir()
+    blob_dir = os.path.join(cache_dir, "sha256")
+    unpinned_dir = os.path.join(cache_dir, "unpinned")
+    partial_dir = os.path.join(cache_dir, "partial")
+    for d in (blob_dir, unpinned_dir, partial_dir):
+        os.makedirs(d, exist_ok=True)
+    pin_key = "{}@{}".format(name, version)
+
+    # One process at a time downloads a given binary
+    with open(os.path.join(partial_dir, pin_key + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        expected = pinned_sha256
+        if expected is not None:
+            cached = os.path.join(blob_dir, expected)
+        else:
+            # Without a pin, releases and snapshots (whose tags name a
+            # commit) are cached by version
+            cached = os.path.join(unpinned_dir, pin_key)
+        if os.path.exists(cached):
+            if expected is None:
+                _check_unpinned(name, version, cached)
+            return cached
+
+        partial = os.path.join(partial_dir, pin_key)
+        if version.startswith("v"):
+            # A proper release, it starts with a "v"
+            url = BUNDLED_BINARIES[name][1].format(version)
+            info("downloading {} {} from {}".format(name, version, url))
+            with_backoff(lambda: _resumable_download(url, partial), "downloading {}".format(url),
+                         is_transient=_is_transient_download_error)
+        elif name == "dxda":
+            # A snapshot of the download-agent development branch
+            with tempfile.TemporaryDirectory(dir=partial_dir) as tmp_dir:
+                snapshot_tar = os.path.join(tmp_dir, "dx-download-agent-linux.tar")
+                command = "sudo docker run --rm --entrypoint='' dnanexus/dxda:{} " \
+                          "cat /builds/dx-download-agent-linux.tar > {}".format(version, snapshot_tar)
+                subprocess.check_call(command, shell=True)
+                subprocess.check_call(["tar", "-C", tmp_dir, "-xf", snapshot_tar])
+                os.replace(os.path.join(tmp_dir, "dx-download-agent-linux", "dx-download-agent"), partial)
+        else:
+            raise Exception("{} version {} is not a release".format(name, version))
+
+        if expected is not None:
+            digest = _sha256_file(partial)
+            if digest != expected:
+                os.remove(partial)
+                raise Exception("checksum mismatch for {} {}: expected sha256 {}, got {}".format(
+                    name, version, expected, digest))
+        os.chmod(partial, 0o775)
+        os.replace(partial, cached)
+        if expected is None:
+            _check_unpinned(name, version, cached)
+        return cached
+
 
-    return dxfuse_exe
+# Warn about a binary that has no pinned checksum, or fail if
+# REQUIRE_PINNED_ENV is set. Either way, print the pin to add.
+def _check_unpinned(name, version, path):
+    message = "no pinned checksum for {} {}, add \"{}\": \"{}\" under \"sha256\" " \
+              "in bundled_dependencies.json".format(name, version, name, _sha256_file(path))
+    if os.environ.get(REQUIRE_PINNED_ENV):
+        raise Exception("{} ({} is set)".format(message, REQUIRE_PINNED_ENV))
+    info("WARNING: using an unverified binary, {}".format(message))
+
+
+# Fetch the bundled binaries concurrently. Returns a dictionary from the
+# name of each executable, as installed in the asset, to its cached path.
+def _fetch_bundled_binaries(dependencies, cache_dir=None):
+    pinned = dependencies.get("sha256", {})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(BUNDLED_BINARIES)) as executor:
+        futures = dict(
+            (exe_name, executor.submit(_fetch_bundled_binary, name, dependencies[name],
+                                       pinned.get(name), cache_dir))
+            for (name, (exe_name, _)) in BUNDLED_BINARIES.items()
+        )
+        return dict((exe_name, future.result()) for (exe_name, future) in futures.items())
+
+
+# Hard-link [src] to [dst], or copy it when they are on different file systems
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
 
 
 def _create_asset_spec(version_id, top_dir, language, dependencies=None):
@@ -185,19 +692,17 @@ def _create_asset_spec(version_id, top_dir, language, dependencies=None):
         fd.write(json.dumps(asset_spec, indent=4))
 
 
-# Build a dx-asset from the runtime library.
-# Go to the applet_resources directory, before running "dx"
+# Build a dx-asset from the runtime library, staged in the
+# applet_resources/<LANGUAGE> directory. The working directory is left
+# alone, so that the assets of several languages can be built concurrently.
 def _build_asset(top_dir, language, destination):
-    crnt_work_dir = os.getcwd()
-    # build the platform asset
-    os.chdir(os.path.join(os.path.abspath(top_dir), "applet_resources"))
+    asset_dir = os.path.join(os.path.abspath(top_dir), "applet_resources", language.upper())
     try:
-        subprocess.check_call(["dx", "build_asset", language.upper(), "--destination", destination])
+        subprocess.check_call(["dx", "build_asset", asset_dir, "--destination", destination])
     except subprocess.CalledProcessError as e:
         print(e.stdout)
         print(e.stderr)
         raise e
-    os.chdir(crnt_work_dir)
 
 
 def _make_prerequisites(project, folder, version_id, top_dir, language, resources, dependencies=None, env_vars=None):
@@ -207,8 +712,8 @@ def _make_prerequisites(project, folder, version_id, top_dir, language, resource
     os.makedirs(language_resources_dir, exist_ok=True)
 
     # Link in the shared resources
-    for res in resources:
-        os.link(res, os.path.join(language_resources_dir, Path(res).name))
+    for (name, res) in resources.items():
+        _link_or_copy(res, os.path.join(language_resources_dir, name))
 
     # Link in executor-specific resources, if any
     lang_resources_dir = os.path.join(top_dir, "executor{}".format(language), "applet_resources")
@@ -222,24 +727,27 @@ def _make_prerequisites(project, folder, version_id, top_dir, language, resource
     # Create the .env file if necessary
     if env_vars:
         dot_env = "\n".join("{}={}".format(key, val) for key, val in env_vars.items())
-        # files in home dir are not included in the final asset
-        dot_env_file = os.path.join(lang_resources_dir, "home", "dnanexus", ".env")
+        # the resources are unpacked in / on the asset builder, where the
+        # Makefile runs in the home dir; files in the home dir are not
+        # included in the final asset
+        dot_env_dir = os.path.join(language_dir, "resources", "home", "dnanexus")
+        os.makedirs(dot_env_dir, exist_ok=True)
+        dot_env_file = os.path.join(dot_env_dir, ".env")
         with open(dot_env_file, "wt") as out:
             out.write(dot_env)
 
     # Create an asset from the executor jar file and its dependencies,
     # this speeds up applet creation.
     destination = "{}:{}/dx{}rt".format(project.get_id(), folder, language.upper())
-    for i in range(0, max_num_retries):
-        try:
-            info("Creating a runtime asset for {} (try {})".format(language, i))
-            _build_asset(top_dir, language, destination)
-            break
-        except:
-            info("Error creating runtime asset; sleeping for 5 seconds before trying again", sys.exc_info())
-            time.sleep(5)
-    else:
-        raise Exception("Failed to build the {} runtime asset".format(language))
+    info("Creating a runtime asset for {}".format(language))
+    start = time.time()
+    try:
+        with_backoff(lambda: _build_asset(top_dir, language, destination),
+                     "creating the {} runtime asset".format(language),
+                     base_delay=5, is_transient=lambda e: True)
+    except Exception as e:
+        raise Exception("Failed to build the {} runtime asset".format(language)) from e
+    info("Created the {} runtime asset in {:.0f} seconds".format(language, time.time() - start))
 
     # make sure the asset exists and is findable
     asset = find_asset(project, folder, language)
@@ -277,22 +785,79 @@ def _gen_config_file(top_dir, project_dict):
     info("Built configuration regions [{}] into {}".format(all_regions_str, rt_conf_path))
 
 
-# Build a fat jar file using sbt-assembly.
+# Add the contents of the files under [path] (relative to [top_dir]) to
+# the hash [h], in a stable order. sbt output directories are skipped.
+def _hash_tree(h, top_dir, path):
+    root = os.path.join(top_dir, path)
+    if os.path.isfile(root):
+        paths = [root]
+    else:
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d not in ("target", "project"))
+            paths += [os.path.join(dirpath, name) for name in sorted(filenames)]
+    for file_path in paths:
+        h.update(os.path.relpath(file_path, top_dir).encode("utf-8") + b"\0")
+        with open(file_path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(1 << 20), b""):
+                h.update(chunk)
+
+
+# A fingerprint of everything that goes into the jar [prefix]: the build
+# definition and the main sources of its subprojects
+def _jar_fingerprint(top_dir, prefix):
+    h = hashlib.sha256()
+    for path in ["build.sbt", "project"]:
+        _hash_tree(h, top_dir, path)
+    for subproject in jar_subprojects[prefix]:
+        _hash_tree(h, top_dir, os.path.join(subproject, "src", "main"))
+    return h.hexdigest()
+
+
+# A fingerprint of everything that goes into the runtime asset of [language]
+def _asset_fingerprint(top_dir, version_id, language, jar_fingerprint, dependencies):
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        "version": version_id,
+        "jar": jar_fingerprint,
+        "dxda": dependencies.get("dxda"),
+        "dxfuse": dependencies.get("dxfuse"),
+        "execDepends": dependencies.get("execDepends", {}).get(language.lower()),
+        "env": dependencies.get("env", {}).get(language.lower())
+    }, sort_keys=True).encode("utf-8"))
+    _hash_tree(h, top_dir, os.path.join("executor{}".format(language), "applet_resources"))
+    return h.hexdigest()
+
+
+# The fingerprint of the sources [jar_path] was built from, or None
+def read_fingerprint(jar_path):
+    try:
+        with open(jar_path + ".fingerprint") as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+# Build fat jar files using sbt-assembly, for the jars in [prefixes] only.
+# sbt compiles incrementally, the build is only cleaned first if [clean].
 # Make sure to run with the working directory being the top dir of the project.
-def _sbt_assembly(top_dir):
+def _sbt_assembly(top_dir, prefixes, clean=False):
     os.chdir(os.path.abspath(top_dir))
-    jar_paths = dict(
+    all_jar_paths = dict(
         ("dxExecutor{}".format(lang), os.path.join(
             top_dir, "applet_resources", lang.upper(), "resources", "dxExecutor{}.jar".format(lang)
         )) for lang in languages
     )
-    jar_paths.update({"dxCompiler": os.path.join(top_dir, "applet_resources", "dxCompiler.jar")})
+    all_jar_paths.update({"dxCompiler": os.path.join(top_dir, "applet_resources", "dxCompiler.jar")})
+    jar_paths = dict((prefix, all_jar_paths[prefix]) for prefix in prefixes)
     for jar_path in jar_paths.values():
         if os.path.exists(jar_path):
             os.remove(jar_path)
     try:
-        subprocess.check_call(["sbt", "clean"])
-        subprocess.check_call(["sbt", "assembly"])
+        if clean:
+            subprocess.check_call(["sbt", "clean"])
+        subprocess.check_call(["sbt"] + ["{}/assembly".format(jar_subprojects[prefix][-1])
+                                         for prefix in prefixes])
     except subprocess.CalledProcessError as e:
         print(e.stdout)
         print(e.stderr)
@@ -303,51 +868,157 @@ def _sbt_assembly(top_dir):
     return jar_paths
 
 
-def build(project, folder, version_id, top_dir, path_dict, dependencies=None, force=False):
-    assets = dict((lang, find_asset(project, folder, lang)) for lang in languages)
-    build_assets = force or not all(assets.values())
+# Assemble the jars whose sources changed since they were last built, or
+# all of them (from a clean build) if [force]. The jars are placed in the
+# top level directory, next to a file with the fingerprint of their sources.
+# Returns the fingerprints.
+def _build_jars(top_dir, version_id, force=False):
+    fingerprints = dict((prefix, _jar_fingerprint(top_dir, prefix)) for prefix in jar_subprojects)
+    top_jars = dict((prefix, os.path.join(top_dir, "{}-{}.jar".format(prefix, version_id)))
+                    for prefix in jar_subprojects)
+    stale = [
+        prefix for prefix in jar_subprojects
+        if force or not os.path.exists(top_jars[prefix]) or read_fingerprint(top_jars[prefix]) != fingerprints[prefix]
+    ]
+    if not stale:
+        info("All jars are up to date")
+        return fingerprints
 
-    if build_assets:
-        for lang in languages:
-            language_dir = os.path.join(top_dir, "applet_resources", lang.upper())
-            if os.path.exists(language_dir):
-                shutil.rmtree(language_dir)
+    info("Building {}".format(", ".join(stale)))
+    jar_paths = _sbt_assembly(top_dir, stale, clean=force)
+    info("jar_paths: {}".format(jar_paths))
+    for (prefix, jar_path) in jar_paths.items():
+        # Move the file to the top level directory
+        shutil.move(jar_path, top_jars[prefix])
+        with open(top_jars[prefix] + ".fingerprint", "w") as fd:
+            fd.write(fingerprints[prefix])
 
-        if dependencies is None:
-            with open(os.path.join(top_dir, "scripts/bundled_dependencies.json"), "rt") as inp:
-                dependencies = json.load(inp)
+    if "dxCompiler" in stale:
+        # speed up the startup of the compiler in the scripts
+        create_compiler_cds_archive(top_jars["dxCompiler"])
+    return fingerprints
 
-        # get a copy of the download agent (dxda)
-        dxda_exe = _download_dxda_into_resources(top_dir, dependencies["dxda"])
-        # get a copy of the dxfuse executable
-        dxfuse_exe = _download_dxfuse_to_resources(top_dir, dependencies["dxfuse"])
-        resources = [dxda_exe, dxfuse_exe]
 
-        # Create a configuration file
-        _gen_config_file(top_dir, path_dict)
-        jar_paths = _sbt_assembly(top_dir)
-        info("jar_paths: {}".format(jar_paths))
+# Delete an asset record, and the archive it refers to
+def remove_asset(project, asset):
+    ids = [asset.get_id()]
+    archive = asset.get_details().get("archiveFileId")
+    if archive is not None:
+        ids.append(archive["$dnanexus_link"])
+    project.remove_objects(ids)
 
-        exec_depends = dependencies.get("execDepends", {})
-        env_vars = dependencies.get("env", {})
+
+# Wait for another process to build the runtime assets of [fingerprints],
+# a dictionary from language to fingerprint, in [folder]. Returns a
+# dictionary from language to asset.
+def _wait_for_assets(project, folder, fingerprints):
+    info("Waiting for the {} runtime assets to be built".format(", ".join(fingerprints)))
+    deadline = time.time() + ASSET_WAIT_TIMEOUT
+    while True:
+        existing_assets = find_assets(project, folder, list(fingerprints))
         assets = dict(
-            (lang, _make_prerequisites(
-                project, folder, version_id, top_dir, lang, resources,
-                exec_depends.get(lang.lower(), env_vars.get(lang.lower()))
-            ))
-            for lang in languages
+            (lang, asset) for (lang, asset) in existing_assets.items()
+            if asset is not None and
+            asset.get_properties().get(ASSET_FINGERPRINT_PROPERTY) == fingerprints[lang]
         )
+        if len(assets) == len(fingerprints):
+            return assets
+        if time.time() > deadline:
+            raise Exception("Timed out waiting for the {} runtime assets in {}:{}".format(
+                ", ".join(sorted(set(fingerprints) - set(assets))), project.get_id(), folder))
+        time.sleep(ASSET_WAIT_INTERVAL)
+
+
+# Build the compiler jars, and the runtime assets of every language in
+# [folder]. An existing asset that was built from other sources or
+# dependencies, or has no fingerprint (e.g. its build was interrupted), is
+# replaced, unless [keep_existing]: the assets of a release are used by the
+# applets compiled with it, and are kept as they are. With [wait_for_assets],
+# the assets are not built, but awaited from another process building the
+# same sources into the same folder (e.g. the first shard of a test run).
+def build(project, folder, version_id, top_dir, path_dict, dependencies=None, force=False,
+          keep_existing=False, wait_for_assets=False):
+    if dependencies is None:
+        with open(os.path.join(top_dir, "scripts/bundled_dependencies.json"), "rt") as inp:
+            dependencies = json.load(inp)
+
+    # Create a configuration file, and build the jars whose sources changed
+    _gen_config_file(top_dir, path_dict)
+    jar_fingerprints = _build_jars(top_dir, version_id, force)
+
+    # Find the runtime assets that are missing or out of date
+    assets = {}
+    stale = {}
+    existing_assets = find_assets(project, folder)
+    for lang in languages:
+        fingerprint = _asset_fingerprint(top_dir, version_id, lang,
+                                         jar_fingerprints["dxExecutor{}".format(lang)], dependencies)
+        asset = existing_assets[lang]
+        if asset is not None and (keep_existing or not force):
+            if keep_existing or asset.get_properties().get(ASSET_FINGERPRINT_PROPERTY) == fingerprint:
+                assets[lang] = asset
+                continue
+            info("The {} runtime asset {} is out of date".format(lang, asset.get_id()))
+        stale[lang] = fingerprint
+
+    if stale and wait_for_assets:
+        assets.update(_wait_for_assets(project, folder, stale))
+    elif stale:
+        # get the download agent (dxda) and dxfuse executables
+        resources = _fetch_bundled_binaries(dependencies)
 
-        for (prefix, jar_path) in jar_paths.items():
-            # Move the file to the top level directory
-            all_in_one_jar = os.path.join(top_dir, "{}-{}.jar".format(prefix, version_id))
-            shutil.move(jar_path, all_in_one_jar)
+        exec_depends = dependencies.get("execDepends", {})
+        env_vars = dependencies.get("env", {})
+
+        # Each language is staged in its own directory, and its asset is
+        # built by a separate remote job, so they are built concurrently.
+        # The new asset is built in a folder of its own; the asset it
+        # replaces is only removed once the new one has been moved in its
+        # place.
+        def build_language_asset(lang, fingerprint):
+            language_dir = os.path.join(top_dir, "applet_resources", lang.upper())
+            if os.path.exists(language_dir):
+                shutil.rmtree(language_dir)
+            jar_name = "dxExecutor{}.jar".format(lang)
+            os.makedirs(os.path.join(language_dir, "resources"))
+            os.link(os.path.join(top_dir, "dxExecutor{}-{}.jar".format(lang, version_id)),
+                    os.path.join(language_dir, "resources", jar_name))
+            build_folder = "{}/.build_{}".format(folder.rstrip("/"), lang.lower())
+            try:
+                # left over by an interrupted build
+                project.remove_folder(build_folder, recurse=True)
+            except dxpy.exceptions.ResourceNotFound:
+                pass
+            project.new_folder(build_folder, parents=True)
+            try:
+                asset = _make_prerequisites(
+                    project, build_folder, version_id, top_dir, lang, resources,
+                    exec_depends.get(lang.lower()), env_vars.get(lang.lower())
+                )
+                asset.set_properties({ASSET_FINGERPRINT_PROPERTY: fingerprint})
+                archive = asset.get_details()["archiveFileId"]["$dnanexus_link"]
+                project.move(folder, objects=[asset.get_id(), archive])
+                if existing_assets[lang] is not None:
+                    remove_asset(project, existing_assets[lang])
+                project.remove_folder(build_folder, recurse=True)
+                return asset
+            finally:
+                # delete the language-specific dir
+                shutil.rmtree(language_dir)
 
-        # delete the language-specific dirs
-        for lang in languages:
-            shutil.rmtree(os.path.join(top_dir, "applet_resources", lang.upper()))
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            futures = dict(
+                (lang, executor.submit(build_language_asset, lang, fingerprint))
+                for (lang, fingerprint) in stale.items()
+            )
+            for (lang, future) in futures.items():
+                assets[lang] = future.result()
+        info("Built the {} runtime assets in {:.0f} seconds".format(", ".join(stale), time.time() - start))
+    else:
+        info("All runtime assets are up to date")
 
-    region = dxpy.describe(project.get_id())['region']
+    region = get_project_region(project.get_id())
     asset_descs = dict(
         (lang, AssetDesc(region, asset.get_id(), project))
         for (lang, asset) in assets.items()